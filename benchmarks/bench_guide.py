@@ -0,0 +1,274 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for guide construction and grammar generation.
+
+Runs offline: the model is an `OpenAIChatModel` pointed at a dummy provider, which
+`set_guide()` never contacts, and tools are synthetic.
+
+Usage:
+    python benchmarks/bench_guide.py --output results.json
+    python benchmarks/bench_guide.py --quick --compare results.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from collections.abc import Awaitable, Callable, Iterator
+from typing import Any
+
+from pydantic import BaseModel, create_model
+from pydantic_ai import Tool, ToolOutput, _output
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+from pydantic_ai.toolsets import FunctionToolset
+
+from cragents import Anchor, Constrain, CRAgent, Free, Think, UseTools, __version__, vllm_model_profile
+from cragents._types import GenerationSequenceElement, JsonSchema
+from cragents._utils import build_grammar, build_json_schema
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="http://localhost"),
+    profile=vllm_model_profile,
+)
+
+
+# ── synthetic inputs ───────────────────────────────────────────────────────────
+
+
+def nested_json_schema(depth: int) -> JsonSchema:
+    schema: JsonSchema = {
+        "type": "object",
+        "description": "Leaf arguments.",
+        "properties": {"value": {"type": "string", "description": "A value."}, "count": {"type": "integer"}},
+        "required": ["value"],
+    }
+    for level in range(depth - 1):
+        schema = {
+            "type": "object",
+            "description": f"Level {level} arguments.",
+            "properties": {"child": schema, "label": {"type": "string"}},
+            "required": ["child"],
+        }
+    return schema
+
+
+def nested_model(depth: int) -> type[BaseModel]:
+    output_model: type[BaseModel] = create_model("Leaf", value=(str, ...), count=(int, 0))
+    for level in range(depth - 1):
+        output_model = create_model(f"Level{level}", child=(output_model, ...), label=(str, ""))
+    return output_model
+
+
+def synthetic_toolset(num_tools: int, depth: int) -> FunctionToolset[None]:
+    def tool_function(**kwargs: Any) -> str:
+        return ""
+
+    tools = [
+        Tool.from_schema(
+            tool_function, name=f"tool_{i}", description=f"Tool {i}.", json_schema=nested_json_schema(depth)
+        )
+        for i in range(num_tools)
+    ]
+    return FunctionToolset(tools)
+
+
+def generation_sequence(num_constrains: int, think_elements: int) -> list[GenerationSequenceElement]:
+    think: list[Anchor | Constrain | Free] = []
+    for i in range(think_elements):
+        think.append(Anchor(f"Step {i}: "))
+        think.append(Constrain(max_newlines=1 + i % 3, max_char_captures=2))
+    sequence: list[GenerationSequenceElement] = [Think(think)] if think_elements else []
+    for i in range(num_constrains):
+        sequence.append(Anchor(f"Part {i}: "))
+        sequence.append(Constrain(max_newlines=1 + i % 3, max_char_captures=1 + i % 2))
+    sequence.append(UseTools())
+    return sequence
+
+
+# ── measurement ────────────────────────────────────────────────────────────────
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    ordered = sorted(samples)
+
+    def at(q: float) -> float:
+        return ordered[min(len(ordered) - 1, round(q * (len(ordered) - 1)))]
+
+    return {
+        "min": ordered[0],
+        "p50": at(0.5),
+        "p90": at(0.9),
+        "p99": at(0.99),
+        "max": ordered[-1],
+        "mean": statistics.fmean(ordered),
+    }
+
+
+async def measure(func: Callable[[], Awaitable[Any]], repeat: int) -> dict[str, Any]:
+    await func()  # warm up
+
+    latencies_ms: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func()
+        latencies_ms.append((time.perf_counter() - start) * 1000)
+
+    # allocations are measured on a separate call because tracing skews timings
+    tracemalloc.start()
+    await func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"latency_ms": percentiles(latencies_ms), "alloc_peak_bytes": peak, "alloc_retained_bytes": current}
+
+
+# ── benchmarks ─────────────────────────────────────────────────────────────────
+
+
+def sweep(quick: bool) -> Iterator[dict[str, int]]:
+    num_tools = [1, 10, 100] if quick else [1, 10, 100, 1000]
+    depths = [1, 4] if quick else [1, 4, 8]
+    num_constrains = [1, 10] if quick else [1, 10, 100]
+    think_elements = [0, 4] if quick else [0, 4, 32]
+    for tools in num_tools:
+        for depth in depths:
+            yield {"num_tools": tools, "schema_depth": depth, "num_constrains": 1, "think_elements": 1}
+    for constrains in num_constrains:
+        for elements in think_elements:
+            yield {"num_tools": 1, "schema_depth": 1, "num_constrains": constrains, "think_elements": elements}
+
+
+async def bench_set_guide(params: dict[str, int], repeat: int, cached: bool) -> dict[str, Any]:
+    agent = CRAgent(model, toolsets=[synthetic_toolset(params["num_tools"], params["schema_depth"])])
+    if not cached:
+        agent.grammar_cache = None
+    sequence = generation_sequence(params["num_constrains"], params["think_elements"])
+    result = await measure(lambda: agent.set_guide(sequence), repeat)
+    assert agent.model_settings is not None
+    grammar = agent.model_settings["extra_body"]["structured_outputs"]["grammar"]
+    result["grammar_bytes"] = len(grammar.encode())
+    result["grammar_rules"] = len(grammar.splitlines())
+    return result
+
+
+async def bench_build_grammar(params: dict[str, int], repeat: int) -> dict[str, Any]:
+    agent = CRAgent(model, toolsets=[synthetic_toolset(params["num_tools"], params["schema_depth"])])
+    sequence = generation_sequence(params["num_constrains"], params["think_elements"])
+    processed = await agent._process_generation_sequence(sequence, None)  # pyright: ignore[reportPrivateUsage]
+
+    async def run() -> str:
+        return build_grammar(processed)
+
+    result = await measure(run, repeat)
+    result["grammar_bytes"] = len(build_grammar(processed).encode())
+    return result
+
+
+async def bench_build_json_schema(depth: int, num_outputs: int, repeat: int) -> dict[str, Any]:
+    outputs = [ToolOutput(nested_model(depth), name=f"output_{i}") for i in range(num_outputs)]
+    output_schema = _output.OutputSchema.build(outputs)
+
+    async def run() -> JsonSchema:
+        return build_json_schema(output_schema)
+
+    result = await measure(run, repeat)
+    result["schema_bytes"] = len(json.dumps(build_json_schema(output_schema)).encode())
+    return result
+
+
+async def run_benchmarks(repeat: int, quick: bool) -> list[dict[str, Any]]:
+    results: list[dict[str, Any]] = []
+
+    def record(name: str, params: dict[str, int], result: dict[str, Any]) -> None:
+        results.append({"benchmark": name, "params": params, **result})
+        p50 = result["latency_ms"]["p50"]
+        print(f"{name:<20} {json.dumps(params):<90} p50={p50:9.3f} ms", file=sys.stderr)
+
+    for params in sweep(quick):
+        record("set_guide", params, await bench_set_guide(params, repeat, cached=False))
+        cached = await bench_set_guide(params, repeat, cached=True)
+        build = await bench_build_grammar(params, repeat)
+        # a cache hit should cost a small fraction of the build it skips, `--compare` flags the ratio growing
+        cached["build_ratio"] = cached["latency_ms"]["p50"] / max(build["latency_ms"]["p50"], 1e-9)
+        record("set_guide_cached", params, cached)
+        record("build_grammar", params, build)
+
+    for depth in [1, 4] if quick else [1, 4, 8]:
+        for num_outputs in [1, 10] if quick else [1, 10, 50]:
+            params = {"schema_depth": depth, "num_outputs": num_outputs}
+            record("build_json_schema", params, await bench_build_json_schema(depth, num_outputs, repeat))
+
+    return results
+
+
+def compare(results: list[dict[str, Any]], baseline: list[dict[str, Any]], threshold: float) -> int:
+    """Print the p50 ratio against a baseline, return the number of regressions above the threshold.
+
+    Results with a `build_ratio`, the cache hit to build latency ratio, also compare it against the baseline.
+    """
+    previous = {(r["benchmark"], json.dumps(r["params"], sort_keys=True)): r for r in baseline}
+    regressions = 0
+    for result in results:
+        key = (result["benchmark"], json.dumps(result["params"], sort_keys=True))
+        if key not in previous:
+            continue
+        ratios = {"p50": result["latency_ms"]["p50"] / max(previous[key]["latency_ms"]["p50"], 1e-9)}
+        if "build_ratio" in result and "build_ratio" in previous[key]:
+            ratios["build_ratio"] = result["build_ratio"] / max(previous[key]["build_ratio"], 1e-9)
+        for metric, ratio in ratios.items():
+            flag = ""
+            if ratio > threshold:
+                regressions += 1
+                flag = "  REGRESSION"
+            print(f"{key[0]:<20} {key[1]:<90} {metric:<12} {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--repeat", type=int, default=50, help="timed calls per benchmark")
+    parser.add_argument("--quick", action="store_true", help="run a smaller sweep")
+    parser.add_argument("--compare", help="compare p50 latency against a previous results file")
+    parser.add_argument("--threshold", type=float, default=1.25, help="p50 ratio counted as a regression")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmarks(args.repeat, args.quick))
+    report = {
+        "cragents_version": __version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        return 1 if compare(results, baseline, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
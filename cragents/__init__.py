@@ -13,95 +13,720 @@
 # limitations under the License.
 
 
-import copy
-from collections.abc import Sequence
+import contextlib
+import dataclasses
+import functools
+import time
+from collections.abc import AsyncIterable, AsyncIterator, Callable, Iterable, Sequence
+from typing import Any
 
-from pydantic_ai import Agent, RunContext, RunUsage
+import anyio
+from pydantic_ai import Agent, AgentRunResult, AgentRunResultEvent, RunContext, RunUsage
+from pydantic_ai.messages import AgentStreamEvent, ModelRequest, PartStartEvent, UserContent
+from pydantic_ai.models import ModelRequestParameters
 from pydantic_ai.models.openai import OpenAIChatModel, OpenAIChatModelSettings
 from pydantic_ai.output import OutputDataT
-from pydantic_ai.profiles.openai import OpenAIModelProfile
-from pydantic_ai.tools import AgentDepsT
-from pydantic_ai.toolsets import AbstractToolset
+from pydantic_ai.tools import AgentDepsT, ToolDefinition
+from pydantic_ai.toolsets import AbstractToolset, CombinedToolset
 
+from cragents._backends import GuidedModelProfile, grammar_backends, model_grammar_backend
+from cragents._batch import BatchResult, GuideWarmup, map_concurrently
+from cragents._cache import GrammarCache, ToolSchemaMemo, default_grammar_cache, static_toolsets_key
+from cragents._check import GuideChecker
+from cragents._gbnf import GBNFBackend, XGrammarBackend
+from cragents._grammar import GrammarBackend, LarkBackend
+from cragents._guide import CompiledGuide, Guide, compile_guide, load_guides, save_guides
+from cragents._ladder import GuideLadder, LoadSignal, VLLMMetricsLoad
+from cragents._observe import BuildTimings, GuideBuildMetrics, GuideObserver, GuideRunMetrics, SegmentMetrics
+from cragents._prefill import PrefillChatModel
+from cragents._replay import ReplayTransport
+from cragents._schedule import GuideSchedule, ScheduledModel
+from cragents._select import GuideSelector, GuideStats, SelectedRun
+from cragents._speculative import SpeculativeToolset
+from cragents._stream import GuideSegment, GuideSegmentDelta, GuideStreamEvent, GuideStreamParser
+from cragents._tokens import TokenCounter, TokenEstimate
 from cragents._types import (
     Anchor,
     Constrain,
     Free,
+    FrozenJson,
     GenerationSequenceElement,
+    GrammarBudget,
+    GrammarStats,
     JsonSchema,
     Think,
     UseTools,
 )
 from cragents._utils import (
     build_json_schema,
-    make_guided_extra_body,
+    grammar_stats,
+    make_guided_build,
+    minimization_stats,
 )
 from cragents._version import __version__
 
-__all__ = ("__version__", "CRAgent", "Anchor", "Constrain", "Free", "Think", "UseTools", "vllm_model_profile")
-
+__all__ = (
+    "__version__",
+    "CRAgent",
+    "Anchor",
+    "BatchResult",
+    "CompiledGuide",
+    "Constrain",
+    "Free",
+    "GBNFBackend",
+    "GrammarBackend",
+    "GrammarBudget",
+    "GrammarCache",
+    "GrammarStats",
+    "GuideBuildMetrics",
+    "GuideChecker",
+    "GuideLadder",
+    "GuideObserver",
+    "GuideRunMetrics",
+    "GuideSchedule",
+    "GuideSelector",
+    "GuideSegment",
+    "GuideSegmentDelta",
+    "GuideStats",
+    "GuideStreamEvent",
+    "GuideStreamParser",
+    "GuideWarmup",
+    "GuidedModelProfile",
+    "LarkBackend",
+    "LoadSignal",
+    "PrefillChatModel",
+    "ReplayTransport",
+    "ScheduledModel",
+    "SegmentMetrics",
+    "SelectedRun",
+    "Think",
+    "TokenCounter",
+    "TokenEstimate",
+    "UseTools",
+    "VLLMMetricsLoad",
+    "XGrammarBackend",
+    "compile_guide",
+    "default_grammar_cache",
+    "grammar_backends",
+    "llama_cpp_model_profile",
+    "load_guides",
+    "save_guides",
+    "sglang_model_profile",
+    "vllm_model_profile",
+)
 
-vllm_model_profile = OpenAIModelProfile(
+vllm_model_profile = GuidedModelProfile(
     openai_supports_strict_tool_definition=False,
     openai_supports_tool_choice_required=False,
     supports_json_object_output=False,
     supports_json_schema_output=True,
 )
+llama_cpp_model_profile = dataclasses.replace(vllm_model_profile, grammar_backend=grammar_backends["llama_cpp"])
+sglang_model_profile = dataclasses.replace(vllm_model_profile, grammar_backend=grammar_backends["sglang"])
+
+# user prompt of `CRAgent.warm_guides` requests, the grammar is compiled whatever the prompt
+_WARMUP_PROMPT = "Hi"
 
 
 class CRAgent(Agent[AgentDepsT, OutputDataT]):
-    """Pydantic AI Agent with one extra method: `set_guide`."""
+    """Pydantic AI Agent that can guide model output with a generation sequence, see `set_guide`.
+
+    Grammars are emitted for the inference server given by the model's `GuidedModelProfile`, vLLM by default.
+    Guides are built through `grammar_cache`, set it to `None` to rebuild the grammar on every call.
+    Set `minimize_schemas` to strip annotations from tool schemas and hoist repeated subschemas into `$defs`,
+    and `grammar_budget` to check the size of every grammar that is built.
+    Set `prefill_guide_prefix` to send the fixed start of guides as an assistant prefill, see `PrefillChatModel`.
+    Set `speculative_tools` to start tool calls in `run_stream_segments` as soon as their arguments are complete.
+    Add `observers` to receive guide build metrics, and run metrics of `run_stream_segments` runs, other runs
+    do not report them.
+    Set `guide_ladder` to pick a guide for each run from the current load, see `GuideLadder`.
+    """
+
+    grammar_cache: GrammarCache | None = default_grammar_cache
+    minimize_schemas: bool = False
+    grammar_budget: GrammarBudget | None = None
+    prefill_guide_prefix: bool = False
+    speculative_tools: bool = False
+    observers: Sequence[GuideObserver] = ()
+    guide_ladder: GuideLadder | None = None
+    _guide_sequence: Sequence[GenerationSequenceElement] | None = None
+    _guide_build_metrics: GuideBuildMetrics | None = None
 
-    async def _build_toolset_json_schemas(
+    @functools.cached_property
+    def _return_json_schema(self) -> JsonSchema:
+        return build_json_schema(self._output_schema)
+
+    @functools.cached_property
+    def _tool_schema_memo(self) -> ToolSchemaMemo:
+        return ToolSchemaMemo()
+
+    async def _build_toolset_tool_defs(
         self, ctx: RunContext[AgentDepsT], toolset: AbstractToolset[AgentDepsT]
-    ) -> list[JsonSchema]:
-        schemas: list[JsonSchema] = []
+    ) -> tuple[ToolDefinition, ...]:
         tools = await toolset.get_tools(ctx)
-        for tool in tools.values():
-            schema = tool.tool_def.parameters_json_schema
-            schemas.append(schema)
+        return tuple(tool.tool_def for tool in tools.values())
+
+    async def _build_tool_schemas(
+        self,
+        model: OpenAIChatModel,
+        deps: AgentDepsT,
+        timings: BuildTimings,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> FrozenJson | None:
+        """Arguments schema of each tool offered to the model, `None` when the agent has no tools at all."""
+        start = time.perf_counter()
+        toolsets = self.toolsets
+        static = None
+        if self._prepare_tools is None and self._prepare_output_tools is None and tool_filter is None:
+            output_toolsets = [self._output_toolset] if self._output_toolset is not None else []
+            static = static_toolsets_key([*toolsets, *output_toolsets])
+            # static toolsets are not listed again, a repeated guide costs a few lookups
+            if static is not None and (schemas := self._tool_schema_memo.static_tools(static[0])) is not None:
+                timings.toolsets_seconds += time.perf_counter() - start
+                return schemas
+        ctx = RunContext(deps=deps, model=model, usage=RunUsage())
+        tool_defs_by_index: list[tuple[ToolDefinition, ...]] = [() for _ in toolsets]
+
+        async def resolve(index: int, toolset: AbstractToolset[AgentDepsT]) -> None:
+            tool_defs_by_index[index] = await self._build_toolset_tool_defs(ctx, toolset)
+
+        async with anyio.create_task_group() as tg:
+            for index, toolset in enumerate(toolsets):
+                tg.start_soon(resolve, index, toolset)
+
+        function_tool_defs = [tool_def for tool_defs in tool_defs_by_index for tool_def in tool_defs]
+        output_tool_defs: list[ToolDefinition] = []
+        if self._output_toolset is not None:
+            output_tool_defs = [tool.tool_def for tool in (await self._output_toolset.get_tools(ctx)).values()]
+        if not function_tool_defs and not output_tool_defs:
+            timings.toolsets_seconds += time.perf_counter() - start
+            return None
+
+        # offer the model the same tools as a run does
+        if self._prepare_tools is not None:
+            function_tool_defs = await self._prepare_tools(ctx, function_tool_defs) or []
+        if self._prepare_output_tools is not None:
+            output_tool_defs = await self._prepare_output_tools(ctx, output_tool_defs) or []
+        tool_defs = [*function_tool_defs, *output_tool_defs]
+        if tool_filter is not None:
+            tool_defs = [tool_def for tool_def in tool_defs if tool_filter(tool_def)]
+        timings.toolsets_seconds += time.perf_counter() - start
+        if not tool_defs:
+            raise ValueError("No tools left for UseTools, check prepare_tools and tool_filter.")
+
+        start = time.perf_counter()
+        # schemas are frozen once and the mapping is reused while the tools are unchanged
+        schemas = self._tool_schema_memo.tools(tool_defs)
+        if static is not None:
+            self._tool_schema_memo.remember_static_tools(*static, schemas)
+        timings.schema_seconds += time.perf_counter() - start
         return schemas
 
-    async def set_guide(
+    async def _process_generation_sequence(
+        self,
+        generation_sequence: Sequence[GenerationSequenceElement],
+        deps: AgentDepsT,
+        timings: BuildTimings | None = None,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> list[GenerationSequenceElement]:
+        if not isinstance(self.model, OpenAIChatModel):
+            raise RuntimeError("OpenAIChatModel required.")
+
+        timings = timings or BuildTimings()
+        unresolved = [
+            isinstance(element, UseTools) and element.json_schema is None and element.tools is None
+            for element in generation_sequence
+        ]
+        tools = await self._build_tool_schemas(self.model, deps, timings, tool_filter) if any(unresolved) else None
+        processed_gen_seq: list[GenerationSequenceElement] = []
+        for element, needs_tools in zip(generation_sequence, unresolved, strict=True):
+            # elements are frozen, resolved ones are shared rather than copied
+            if isinstance(element, UseTools) and needs_tools:
+                if tools is not None:
+                    element = dataclasses.replace(element, tools=tools)
+                else:
+                    # an agent without tools keeps the tool call schema of its output type
+                    start = time.perf_counter()
+                    element = dataclasses.replace(element, json_schema=self._return_json_schema)
+                    timings.schema_seconds += time.perf_counter() - start
+            processed_gen_seq.append(element)
+        return processed_gen_seq
+
+    async def build_guide(
+        self,
+        generation_sequence: Guide,
+        deps: AgentDepsT = None,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> JsonSchema:
+        """Build the request `extra_body` that tells the model to follow a sequence of constraints on its output.
+
+        Agent state is not modified, so guides can be built concurrently.
+        Toolsets are resolved concurrently, each tool schema is frozen once and reused while the toolset returns it.
+        A `UseTools` without a schema allows the tools the agent offers the model after `prepare_tools` and
+        `prepare_output_tools`, each tool name tied to its own arguments.
+
+        Args:
+            generation_sequence: a sequence of elements that influence model output, or a compiled guide
+            deps: dependencies for Pydantic AI dependency injection system, can change tool calls
+            tool_filter: keep only the tools it returns true for, narrows `UseTools` resolved from the agent's tools
+        """
+        extra_body, _ = await self._build_guide(generation_sequence, deps, tool_filter)
+        return extra_body
+
+    async def _build_guide(
+        self,
+        generation_sequence: Guide,
+        deps: AgentDepsT,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> tuple[JsonSchema, GuideBuildMetrics]:
+        timings = BuildTimings()
+        cache_hit = None
+        start = time.perf_counter()
+        backend = self._grammar_backend()
+        if isinstance(generation_sequence, CompiledGuide):
+            if generation_sequence.backend.name != backend.name:
+                raise ValueError(
+                    f"Guide was compiled for the {generation_sequence.backend.name!r} grammar backend, "
+                    f"the model uses {backend.name!r}."
+                )
+            self._check_prefill_model(generation_sequence.prefill is not None)
+            extra_body = generation_sequence.extra_body
+            stats = grammar_stats(generation_sequence.grammar)
+        else:
+            processed_gen_seq = await self._process_generation_sequence(generation_sequence, deps, timings, tool_filter)
+            self._check_prefill_model(self.prefill_guide_prefix)
+            start = time.perf_counter()
+            hits = self.grammar_cache.hits if self.grammar_cache is not None else 0
+            extra_body, stats = make_guided_build(
+                processed_gen_seq,
+                cache=self.grammar_cache,
+                minimize=self.minimize_schemas,
+                budget=self.grammar_budget,
+                prefill=self.prefill_guide_prefix,
+                backend=backend,
+            )
+            if self.grammar_cache is not None:
+                cache_hit = self.grammar_cache.hits > hits
+
+        metrics = GuideBuildMetrics(
+            toolsets_seconds=timings.toolsets_seconds,
+            schema_seconds=timings.schema_seconds,
+            grammar_seconds=time.perf_counter() - start,
+            grammar=stats,
+            cache_hit=cache_hit,
+        )
+        for observer in self.observers:
+            observer.guide_built(metrics)
+        return extra_body, metrics
+
+    def _grammar_backend(self) -> GrammarBackend:
+        if not isinstance(self.model, OpenAIChatModel):
+            raise RuntimeError("OpenAIChatModel required.")
+        return model_grammar_backend(self.model)
+
+    def _check_prefill_model(self, prefill: bool) -> None:
+        if prefill and not isinstance(self.model, PrefillChatModel):
+            raise RuntimeError("PrefillChatModel required to prefill the guide prefix.")
+
+    async def compile_guide(
+        self,
+        generation_sequence: Sequence[GenerationSequenceElement],
+        deps: AgentDepsT = None,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> CompiledGuide:
+        """Resolve tool schemas and build the grammar once, see `cragents.compile_guide`.
+
+        Args:
+            generation_sequence: a sequence of elements that influence model output
+            deps: dependencies for Pydantic AI dependency injection system, can change tool calls
+            tool_filter: keep only the tools it returns true for, narrows `UseTools` resolved from the agent's tools
+        """
+        processed_gen_seq = await self._process_generation_sequence(generation_sequence, deps, tool_filter=tool_filter)
+        return compile_guide(
+            processed_gen_seq,
+            minimize=self.minimize_schemas,
+            budget=self.grammar_budget,
+            prefill=self.prefill_guide_prefix,
+            backend=self._grammar_backend(),
+        )
+
+    async def guide_stats(
         self,
         generation_sequence: Sequence[GenerationSequenceElement],
         deps: AgentDepsT = None,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> tuple[GrammarStats, GrammarStats]:
+        """Measure the grammar for a generation sequence before and after schema minimization.
+
+        Args:
+            generation_sequence: a sequence of elements that influence model output
+            deps: dependencies for Pydantic AI dependency injection system, can change tool calls
+            tool_filter: keep only the tools it returns true for, narrows `UseTools` resolved from the agent's tools
+        """
+        processed_gen_seq = await self._process_generation_sequence(generation_sequence, deps, tool_filter=tool_filter)
+        return minimization_stats(processed_gen_seq, self._grammar_backend())
+
+    async def check_guide(
+        self,
+        generation_sequence: Guide,
+        deps: AgentDepsT = None,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> GuideChecker:
+        """Resolve tool schemas and check a guide without an inference server, see `GuideChecker`.
+
+        Args:
+            generation_sequence: a sequence of elements that influence model output, or a compiled guide
+            deps: dependencies for Pydantic AI dependency injection system, can change tool calls
+            tool_filter: keep only the tools it returns true for, narrows `UseTools` resolved from the agent's tools
+
+        Raises:
+            ValueError: when the grammar or a tool schema is invalid
+        """
+        if isinstance(generation_sequence, CompiledGuide):
+            return GuideChecker(generation_sequence)
+        processed_gen_seq = await self._process_generation_sequence(generation_sequence, deps, tool_filter=tool_filter)
+        return GuideChecker(processed_gen_seq)
+
+    async def guide_settings(
+        self,
+        generation_sequence: Guide,
+        deps: AgentDepsT = None,
+        model_settings: OpenAIChatModelSettings | None = None,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> OpenAIChatModelSettings:
+        """Build model settings that guide a single run.
+
+        Pass the result to `run`, `run_stream` or `iter` as `model_settings`. Run settings take precedence over
+        agent settings, so concurrent runs can use different guides with one agent.
+
+        Args:
+            generation_sequence: a sequence of elements that influence model output, or a compiled guide
+            deps: dependencies for Pydantic AI dependency injection system, can change tool calls
+            model_settings: other settings for the run, these are copied and not modified
+            tool_filter: keep only the tools it returns true for, narrows `UseTools` resolved from the agent's tools
+        """
+        settings, _ = await self._guide_settings(generation_sequence, deps, model_settings, tool_filter)
+        return settings
+
+    async def _guide_settings(
+        self,
+        generation_sequence: Guide,
+        deps: AgentDepsT,
+        model_settings: OpenAIChatModelSettings | None,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> tuple[OpenAIChatModelSettings, GuideBuildMetrics]:
+        extra_body, metrics = await self._build_guide(generation_sequence, deps, tool_filter)
+        settings = OpenAIChatModelSettings(**model_settings) if model_settings else OpenAIChatModelSettings()
+        settings["extra_body"] = extra_body
+        return settings, metrics
+
+    async def set_guide(
+        self,
+        generation_sequence: Guide,
+        deps: AgentDepsT = None,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
     ) -> None:
         """The agent will tell the model to follow a sequence of constraints on its output.
 
+        The guide applies to every run of the agent, use `guide_settings` to guide a single run.
+
         Args:
             generation_sequence: a sequence of elements that influence model output
             deps: dependencies for Pydantic AI dependency injection system, can change tool calls
+            tool_filter: keep only the tools it returns true for, narrows `UseTools` resolved from the agent's tools
+        """
+        extra_body, metrics = await self._build_guide(generation_sequence, deps, tool_filter)
+
+        if self.model_settings is None:
+            self.model_settings = OpenAIChatModelSettings()
+        self.model_settings["extra_body"] = extra_body
+        self._guide_sequence = _guide_generation_sequence(generation_sequence)
+        self._guide_build_metrics = metrics
+
+    def scheduled_model(self, schedule: GuideSchedule, deps: AgentDepsT = None) -> ScheduledModel:
+        """Wrap the agent's model to guide each request of a run with the guide the schedule gives for it.
+
+        Pass the result as the `model` of a single run, for example `agent.run(prompt, model=scheduled)`.
+
+        Args:
+            schedule: the guide of each model request
+            deps: dependencies for Pydantic AI dependency injection system, can change tool calls
         """
         if not isinstance(self.model, OpenAIChatModel):
             raise RuntimeError("OpenAIChatModel required.")
+        return ScheduledModel(self.model, self, schedule, deps)
+
+    async def run_stream_segments(
+        self,
+        user_prompt: str | Sequence[UserContent] | None = None,
+        *,
+        guide: Guide | GuideSchedule | None = None,
+        deps: AgentDepsT = None,
+        model_settings: OpenAIChatModelSettings | None = None,
+        toolsets: Sequence[AbstractToolset[AgentDepsT]] | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[AgentStreamEvent | AgentRunResultEvent[Any] | GuideStreamEvent]:
+        """Run the agent and stream events, along with guide segments as soon as each one is complete.
 
-        processed_gen_seq: Sequence[GenerationSequenceElement] = []
-        for element in generation_sequence:
-            element = copy.copy(element)
-            if isinstance(element, UseTools) and element.json_schema is None:
-                return_schema = build_json_schema(self._output_schema)
-
-                toolsets_schemas: list[JsonSchema] = []
-                ctx = RunContext(deps=deps, model=self.model, usage=RunUsage())
-                for toolset in self.toolsets:
-                    # schema can be empty so we need this check
-                    if toolset_schema := await self._build_toolset_json_schemas(ctx, toolset):
-                        toolsets_schemas += toolset_schema
-
-                if toolsets_schemas:
-                    json_schema = {}
-                    if "anyOf" in return_schema:
-                        json_schema["anyOf"] = toolsets_schemas + return_schema["anyOf"]
-                    else:
-                        json_schema = {"anyOf": toolsets_schemas + [return_schema]}
+        Works like `run_stream_events`, with `GuideSegment` and `GuideSegmentDelta` events added as the output of
+        each model response is matched against the guide, see `GuideStreamParser`.
+
+        With `speculative_tools` set, function tools start running while the model is still generating, as soon as
+        their call is complete, and calls still running are cancelled if the run fails. Only enable it for tools
+        that are safe to run when the agent does not end up using the result, for example when the run ends early.
+
+        Args:
+            user_prompt: user input to start the run with
+            guide: guide for this run only, or a schedule with a guide for each model request,
+                defaults to a rung of `guide_ladder` or the guide given to `set_guide`
+            deps: dependencies for Pydantic AI dependency injection system, can change tool calls
+            model_settings: other settings for the run
+            toolsets: additional toolsets for the run
+            kwargs: passed to `run_stream_events`
+
+        Raises:
+            ValueError: when model output does not follow the guide
+        """
+        if guide is None and self.guide_ladder is not None:
+            async with self.guide_ladder.rung() as rung:
+                async for event in self.run_stream_segments(
+                    user_prompt, guide=rung, deps=deps, model_settings=model_settings, toolsets=toolsets, **kwargs
+                ):
+                    yield event
+            return
+
+        generation_sequence: Sequence[GenerationSequenceElement] | ScheduledModel
+        if isinstance(guide, GuideSchedule):
+            # guides are built for each model request
+            generation_sequence = kwargs["model"] = self.scheduled_model(guide, deps)
+            build_metrics = None
+        elif guide is not None:
+            model_settings, build_metrics = await self._guide_settings(guide, deps, model_settings)
+            generation_sequence = _guide_generation_sequence(guide)
+        elif self._guide_sequence is not None:
+            generation_sequence = self._guide_sequence
+            build_metrics = self._guide_build_metrics
+        else:
+            raise RuntimeError("No guide, call set_guide or pass a guide.")
+
+        speculative_toolset = None
+        if self.speculative_tools:
+            # the toolset runs tool calls for the agent, so every tool must go through it
+            speculative_toolset = SpeculativeToolset(CombinedToolset([*self.toolsets, *(toolsets or [])]))
+            toolsets = None
+
+        async for event in self._run_stream_segments(
+            generation_sequence,
+            speculative_toolset,
+            build_metrics,
+            user_prompt,
+            deps=deps,
+            model_settings=model_settings,
+            toolsets=toolsets,
+            **kwargs,
+        ):
+            yield event
+
+    async def _guided_run_events(
+        self,
+        speculative_toolset: SpeculativeToolset | None,
+        user_prompt: str | Sequence[UserContent] | None,
+        **kwargs: Any,
+    ) -> AsyncIterator[AgentStreamEvent | AgentRunResultEvent[Any]]:
+        if speculative_toolset is None:
+            async for event in self.run_stream_events(user_prompt, **kwargs):
+                yield event
+            return
+
+        send_stream, receive_stream = anyio.create_memory_object_stream[AgentStreamEvent | AgentRunResultEvent[Any]]()
+        error: Exception | None = None
+
+        async def event_stream_handler(_: RunContext[AgentDepsT], events: AsyncIterable[AgentStreamEvent]) -> None:
+            async for event in events:
+                await send_stream.send(event)
+
+        async def run() -> None:
+            nonlocal error
+            async with send_stream:
+                try:
+                    result = await self.run(user_prompt, event_stream_handler=event_stream_handler, **kwargs)
+                except Exception as e:
+                    # raised again outside the task group, which would wrap it in an exception group
+                    error = e
                 else:
-                    json_schema = return_schema
-                element.json_schema = json_schema
-            processed_gen_seq.append(element)
+                    await send_stream.send(AgentRunResultEvent(result))
 
-        extra_body = make_guided_extra_body(processed_gen_seq)
+        async with anyio.create_task_group() as tg:
+            # the agent's own tools must only run through the speculative toolset, the override is set while the
+            # run's task is started, which copies it, so it never leaks into the caller's context between events
+            with self.override(tools=[], toolsets=[speculative_toolset]):
+                tg.start_soon(run)
+            async with receive_stream:
+                async for event in receive_stream:
+                    try:
+                        yield event
+                    except GeneratorExit:
+                        # the caller stopped early, cancel the run
+                        tg.cancel_scope.cancel()
+                        return
+        if error is not None:
+            raise error
 
-        if self.model_settings is None:
-            self.model_settings = OpenAIChatModelSettings()
-        self.model_settings["extra_body"] = extra_body
+    async def _run_stream_segments(
+        self,
+        generation_sequence: Sequence[GenerationSequenceElement] | ScheduledModel,
+        speculative_toolset: SpeculativeToolset | None,
+        build_metrics: GuideBuildMetrics | None,
+        user_prompt: str | Sequence[UserContent] | None,
+        **kwargs: Any,
+    ) -> AsyncIterator[AgentStreamEvent | AgentRunResultEvent[Any] | GuideStreamEvent]:
+        start = time.perf_counter()
+        responses = 0
+        segments: list[SegmentMetrics] = []
+
+        def measured(events: list[GuideStreamEvent]) -> list[GuideStreamEvent]:
+            segments.extend(SegmentMetrics.from_segment(event) for event in events if isinstance(event, GuideSegment))
+            return events
+
+        def response_parser() -> GuideStreamParser | None:
+            if not isinstance(generation_sequence, ScheduledModel):
+                return GuideStreamParser(generation_sequence)
+            # the response follows the guide of the request that was just made, if any
+            sequence = generation_sequence.sequences[-1] if generation_sequence.sequences else None
+            return GuideStreamParser(sequence) if sequence is not None else None
+
+        parser = None
+        async for event in self._guided_run_events(speculative_toolset, user_prompt, **kwargs):
+            if speculative_toolset is not None and not isinstance(event, AgentRunResultEvent):
+                speculative_toolset.speculator.feed_event(event)
+            # every model response starts over from the beginning of the guide
+            if isinstance(event, PartStartEvent) and event.index == 0:
+                responses += 1
+                if parser is not None and parser.started:
+                    for segment_event in measured(parser.close()):
+                        yield segment_event
+                parser = response_parser()
+            if isinstance(event, AgentRunResultEvent) and parser is not None and parser.started:
+                for segment_event in measured(parser.close()):
+                    yield segment_event
+            yield event
+            if parser is not None and not isinstance(event, AgentRunResultEvent):
+                for segment_event in measured(parser.feed_event(event)):
+                    yield segment_event
+
+        metrics = GuideRunMetrics(
+            build=build_metrics,
+            responses=responses,
+            segments=tuple(segments),
+            duration_seconds=time.perf_counter() - start,
+        )
+        for observer in self.observers:
+            observer.run_finished(metrics)
+
+    async def run_batch(
+        self,
+        prompts: Iterable[str | Sequence[UserContent]],
+        *,
+        guide: Guide | GuideSchedule | None = None,
+        concurrency: int = 16,
+        deps: AgentDepsT = None,
+        model_settings: OpenAIChatModelSettings | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[BatchResult]:
+        """Run the agent on many prompts with one guide, yielding results in completion order.
+
+        The guide is built once and every run goes through the model's HTTP client, so connections to the
+        inference server are reused. At most `concurrency` runs are in flight, keep it high enough to fill the
+        server's batch. Prompts are read lazily, so large inputs can be streamed in.
+
+        A failed run does not stop the batch, its exception is returned in `BatchResult.error`.
+        When stopping early, close the iterator, for example with `contextlib.aclosing`, to cancel runs in flight.
+
+        Args:
+            prompts: user prompts, each starts a run
+            guide: guide for the runs, or a schedule with a guide for each model request,
+                defaults to a rung of `guide_ladder` picked for each run, or the guide given to `set_guide`
+            concurrency: upper bound on runs in flight
+            deps: dependencies for Pydantic AI dependency injection system, can change tool calls
+            model_settings: other settings for the runs
+            kwargs: passed to `run`
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1.")
+        ladder = self.guide_ladder if guide is None else None
+        if guide is not None and not isinstance(guide, GuideSchedule):
+            model_settings, _ = await self._guide_settings(guide, deps, model_settings)
+
+        async def run(prompt: str | Sequence[UserContent]) -> AgentRunResult[Any]:
+            if isinstance(guide, GuideSchedule):
+                model = self.scheduled_model(guide, deps)
+                return await self.run(prompt, deps=deps, model=model, model_settings=model_settings, **kwargs)
+            if ladder is None:
+                return await self.run(prompt, deps=deps, model_settings=model_settings, **kwargs)
+            async with ladder.rung() as rung:
+                settings, _ = await self._guide_settings(rung, deps, model_settings)
+                return await self.run(prompt, deps=deps, model_settings=settings, **kwargs)
+
+        async def run_indexed(index: int, prompt: str | Sequence[UserContent]) -> BatchResult:
+            try:
+                return BatchResult(index, result=await run(prompt))
+            except Exception as e:
+                return BatchResult(index, error=e)
+
+        async with contextlib.aclosing(map_concurrently(prompts, run_indexed, concurrency)) as results:
+            async for batch_result in results:
+                yield batch_result
+
+    async def warm_guides(
+        self,
+        guides: Iterable[Guide],
+        *,
+        concurrency: int = 8,
+        deps: AgentDepsT = None,
+        model_settings: OpenAIChatModelSettings | None = None,
+        tool_filter: Callable[[ToolDefinition], bool] | None = None,
+    ) -> AsyncIterator[GuideWarmup]:
+        """Prime the inference server's grammar cache, yielding the latency of each guide in completion order.
+
+        The first request with a new grammar waits for the server to compile it. Each guide is sent in a minimal
+        request with `max_tokens=1`, at most `concurrency` at a time, so that cost is paid before traffic arrives,
+        for example at startup and after deploys or scale-ups. The latency of a cold request is mostly compilation.
+
+        A failed guide does not stop the others, its exception is returned in `GuideWarmup.error`.
+        When stopping early, close the iterator, for example with `contextlib.aclosing`, to cancel requests in flight.
+
+        Args:
+            guides: guides to warm up, generation sequences or compiled guides
+            concurrency: upper bound on requests in flight
+            deps: dependencies for Pydantic AI dependency injection system, can change tool calls
+            model_settings: other settings for the requests
+            tool_filter: keep only the tools it returns true for, narrows `UseTools` resolved from the agent's tools
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1.")
+        if not isinstance(self.model, OpenAIChatModel):
+            raise RuntimeError("OpenAIChatModel required.")
+        model = self.model
+
+        async def warm(guide: Guide) -> float:
+            settings, _ = await self._guide_settings(guide, deps, model_settings, tool_filter)
+            settings["max_tokens"] = 1
+            start = time.perf_counter()
+            await model.request([ModelRequest.user_text_prompt(_WARMUP_PROMPT)], settings, ModelRequestParameters())
+            return time.perf_counter() - start
+
+        async def warm_indexed(index: int, guide: Guide) -> GuideWarmup:
+            try:
+                return GuideWarmup(index, latency_seconds=await warm(guide))
+            except Exception as e:
+                return GuideWarmup(index, error=e)
+
+        async with contextlib.aclosing(map_concurrently(guides, warm_indexed, concurrency)) as warmups:
+            async for warmup in warmups:
+                yield warmup
+
+
+def _guide_generation_sequence(guide: Guide) -> Sequence[GenerationSequenceElement]:
+    if isinstance(guide, CompiledGuide):
+        return guide.generation_sequence
+    return list(guide)
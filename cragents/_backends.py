@@ -0,0 +1,51 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+
+from pydantic_ai.models import Model
+from pydantic_ai.profiles.openai import OpenAIModelProfile
+
+from ._gbnf import GBNFBackend, XGrammarBackend
+from ._grammar import LARK, GrammarBackend
+
+grammar_backends: dict[str, GrammarBackend] = {
+    backend.name: backend for backend in (LARK, GBNFBackend(), XGrammarBackend())
+}
+
+
+def get_grammar_backend(name: str) -> GrammarBackend:
+    """Look up a backend in `grammar_backends` by name."""
+    try:
+        return grammar_backends[name]
+    except KeyError:
+        raise ValueError(f"Unknown grammar backend {name!r}, add it to cragents.grammar_backends.") from None
+
+
+@dataclasses.dataclass(kw_only=True)
+class GuidedModelProfile(OpenAIModelProfile):
+    """OpenAI model profile for an inference server that accepts grammars.
+
+    Args:
+        grammar_backend: emits guides in the grammar syntax of the server
+    """
+
+    grammar_backend: GrammarBackend = LARK
+
+
+def model_grammar_backend(model: Model) -> GrammarBackend:
+    """The backend from the model's profile, vLLM with llguidance Lark grammars by default."""
+    profile = model.profile
+    return profile.grammar_backend if isinstance(profile, GuidedModelProfile) else LARK
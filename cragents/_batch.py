@@ -0,0 +1,95 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+from collections.abc import AsyncGenerator, Awaitable, Callable, Iterable
+from typing import Any, TypeVar
+
+import anyio
+from anyio.abc import ObjectSendStream
+from pydantic_ai import AgentRunResult
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclasses.dataclass(frozen=True)
+class BatchResult:
+    """Outcome of one prompt of `CRAgent.run_batch`.
+
+    Args:
+        index: position of the prompt in the input
+        result: the run result, `None` when the run failed
+        error: the exception the run raised, `None` when the run succeeded
+    """
+
+    index: int
+    result: AgentRunResult[Any] | None = None
+    error: Exception | None = None
+
+    @property
+    def output(self) -> Any:
+        """Output of the run, raises the run's exception if it failed."""
+        if self.error is not None:
+            raise self.error
+        assert self.result is not None
+        return self.result.output
+
+
+@dataclasses.dataclass(frozen=True)
+class GuideWarmup:
+    """Outcome of one guide of `CRAgent.warm_guides`.
+
+    Args:
+        index: position of the guide in the input
+        latency_seconds: duration of the warm-up request, mostly grammar compilation when the server had not
+            seen the grammar yet, `None` when it failed
+        error: the exception building the guide or sending the request raised, `None` when it succeeded
+    """
+
+    index: int
+    latency_seconds: float | None = None
+    error: Exception | None = None
+
+
+async def map_concurrently(
+    items: Iterable[T], fn: Callable[[int, T], Awaitable[R]], concurrency: int
+) -> AsyncGenerator[R]:
+    """Call `fn` with the index of each item and the item, at most `concurrency` at a time.
+
+    Results are yielded in completion order. Closing the iterator early, for example with `contextlib.aclosing`,
+    cancels the calls in flight.
+    """
+    # workers share one iterator, so items are not read ahead of the calls
+    indexed_items = enumerate(items)
+    send_stream, receive_stream = anyio.create_memory_object_stream[R](concurrency)
+
+    async def worker(send: ObjectSendStream[R]) -> None:
+        async with send:
+            for index, item in indexed_items:
+                await send.send(await fn(index, item))
+
+    async with anyio.create_task_group() as tg:
+        async with send_stream:
+            for _ in range(concurrency):
+                tg.start_soon(worker, send_stream.clone())
+        async with receive_stream:
+            async for result in receive_stream:
+                try:
+                    yield result
+                except GeneratorExit:
+                    # the caller stopped early, cancel calls in flight
+                    tg.cancel_scope.cancel()
+                    return
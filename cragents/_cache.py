@@ -0,0 +1,241 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+import hashlib
+import json
+from collections import OrderedDict
+from collections.abc import Callable, Hashable, Sequence
+from typing import Any, TypeVar, cast
+
+from pydantic_ai import _output
+from pydantic_ai.tools import Tool, ToolDefinition
+from pydantic_ai.toolsets import AbstractToolset, FunctionToolset
+
+from ._types import (
+    Anchor,
+    Constrain,
+    Free,
+    FrozenJson,
+    GenerationSequenceElement,
+    JsonSchema,
+    Think,
+    UseTools,
+    freeze_json,
+)
+
+ELEMENT_TYPES: dict[str, type[GenerationSequenceElement]] = {
+    element_type.__name__: element_type for element_type in (Anchor, Constrain, Free, Think, UseTools)
+}
+ELEMENT_TYPES_TUPLE = tuple(ELEMENT_TYPES.values())
+
+T = TypeVar("T")
+
+
+def serialize_element(element: GenerationSequenceElement) -> dict[str, Any]:
+    """Convert a generation sequence element to plain JSON data tagged with its type."""
+    data: dict[str, Any] = {"type": type(element).__name__}
+    for field in dataclasses.fields(element):
+        if not field.init:
+            continue
+        value = getattr(element, field.name)
+        if isinstance(element, Think) and field.name == "sequence":
+            value = [serialize_element(think_element) for think_element in element.sequence]
+        data[field.name] = value
+    return data
+
+
+def deserialize_element(data: dict[str, Any]) -> GenerationSequenceElement:
+    """Inverse of `serialize_element`."""
+    fields = dict(data)
+    type_name = fields.pop("type")
+    if type_name not in ELEMENT_TYPES:
+        raise ValueError(f"Unknown generation sequence element type: {type_name!r}.")
+    if type_name == "Think":
+        fields["sequence"] = [deserialize_element(think_element) for think_element in fields["sequence"]]
+    return ELEMENT_TYPES[type_name](**fields)
+
+
+def _key(value: Any) -> Hashable:
+    if isinstance(value, FrozenJson):
+        return value.canonical
+    if isinstance(value, tuple):
+        return tuple(_key(item) for item in cast(tuple[Any, ...], value))
+    if isinstance(value, ELEMENT_TYPES_TUPLE):
+        fields = dataclasses.fields(value)
+        return (type(value).__name__, *(_key(getattr(value, field.name)) for field in fields if field.init))
+    # the type keeps `1` and `True` apart
+    return (value.__class__.__name__, value)
+
+
+def element_key(element: GenerationSequenceElement) -> Hashable:
+    """Content key of an element, compares schemas by their canonical JSON, which is computed once per schema."""
+    return _key(element)
+
+
+def hash_generation_sequence(generation_sequence: Sequence[GenerationSequenceElement], options: object = None) -> str:
+    """Canonical content hash of a generation sequence, including any resolved tool schemas.
+
+    Args:
+        generation_sequence: the sequence to hash
+        options: build options that change the result, hashed through their `repr`
+    """
+    data: list[Any] = [serialize_element(element) for element in generation_sequence]
+    if options is not None:
+        data.append(repr(options))
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class GrammarCache:
+    """Bounded LRU cache of built guides keyed on generation sequence content.
+
+    Cached values are shared between callers and must be treated as read-only.
+
+    Args:
+        maxsize: upper bound on the number of cached entries, least recently used entries are evicted first
+    """
+
+    def __init__(self, maxsize: int = 128) -> None:
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1.")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, Any] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get_or_build(
+        self,
+        generation_sequence: Sequence[GenerationSequenceElement],
+        build: Callable[[Sequence[GenerationSequenceElement]], T],
+        options: object = None,
+    ) -> T:
+        """Return the cached value for the sequence and build options, calling `build` on a miss.
+
+        Schemas are keyed by their canonical JSON, which frozen schemas compute once, so a hit serializes nothing.
+        """
+        key = (tuple(element_key(element) for element in generation_sequence), options)
+        if (value := self._entries.get(key)) is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return cast(T, value)
+
+        self.misses += 1
+        value = build(generation_sequence)
+        self._entries[key] = value
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        """Drop all entries and reset the counters."""
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+default_grammar_cache = GrammarCache()
+
+
+def static_toolsets_key(toolsets: Sequence[AbstractToolset[Any]]) -> tuple[Hashable, tuple[object, ...]] | None:
+    """Identity key of toolsets that return the same tools on every call, `None` when any toolset can change them.
+
+    Function toolsets whose tools have no `prepare` function and output toolsets only change when their tools are
+    replaced. Also returns the objects the key identifies, to keep alive so that their ids are not reused.
+    """
+    key: list[Hashable] = []
+    sources: list[object] = []
+    for toolset in toolsets:
+        if type(toolset).get_tools is _output.OutputToolset.get_tools:
+            key.append(id(toolset))
+            sources.append(toolset)
+        elif type(toolset).get_tools is FunctionToolset.get_tools:
+            tools = list(cast(FunctionToolset[Any], toolset).tools.values())
+            if any(
+                tool.prepare is not None or type(tool).prepare_tool_def is not Tool.prepare_tool_def for tool in tools
+            ):
+                return None
+            key.append((id(toolset), *(id(tool) for tool in tools)))
+            sources.extend((toolset, *tools))
+        else:
+            return None
+    return tuple(key), tuple(sources)
+
+
+class ToolSchemaMemo:
+    """Frozen tool schemas, memoized by the identity of the parameter schemas they were frozen from.
+
+    Toolsets build new tool definitions on every call but hand out the same parameter schema objects, so each
+    schema is frozen, and its canonical JSON computed, once. The tools mapping is reused while the tool names and
+    schemas are unchanged, so a guide with the same tools costs no serialization. The mapping of static toolsets,
+    see `static_toolsets_key`, is remembered so that their tools are not listed again.
+
+    Args:
+        maxsize: upper bound on the number of memoized schemas and tools mappings each
+    """
+
+    def __init__(self, maxsize: int = 4096) -> None:
+        self.maxsize = maxsize
+        self.frozen = 0
+        # the source schema is kept alive, so its id is not reused while the entry exists
+        self._schemas: OrderedDict[int, tuple[JsonSchema, FrozenJson]] = OrderedDict()
+        self._tools: OrderedDict[tuple[tuple[str, int], ...], FrozenJson] = OrderedDict()
+        self._static: OrderedDict[Hashable, tuple[tuple[object, ...], FrozenJson]] = OrderedDict()
+
+    def schema(self, schema: JsonSchema) -> FrozenJson:
+        """The frozen copy of a schema, frozen on first sight."""
+        if (entry := self._schemas.get(id(schema))) is not None and entry[0] is schema:
+            self._schemas.move_to_end(id(schema))
+            return entry[1]
+        self.frozen += 1
+        frozen = freeze_json(schema)
+        self._put(self._schemas, id(schema), (schema, frozen))
+        return frozen
+
+    def tools(self, tool_defs: Sequence[ToolDefinition]) -> FrozenJson:
+        """Frozen mapping of tool names to their frozen parameter schemas."""
+        schemas = [(tool_def.name, self.schema(tool_def.parameters_json_schema)) for tool_def in tool_defs]
+        key = tuple((name, id(schema)) for name, schema in schemas)
+        if (tools := self._tools.get(key)) is not None:
+            self._tools.move_to_end(key)
+            return tools
+        tools = FrozenJson(dict(schemas))
+        self._put(self._tools, key, tools)
+        return tools
+
+    def static_tools(self, key: Hashable) -> FrozenJson | None:
+        """The tools mapping remembered for a `static_toolsets_key`, `None` if there is none."""
+        if (entry := self._static.get(key)) is None:
+            return None
+        self._static.move_to_end(key)
+        return entry[1]
+
+    def remember_static_tools(self, key: Hashable, sources: tuple[object, ...], tools: FrozenJson) -> None:
+        """Remember the tools mapping of static toolsets, `sources` are kept alive with it."""
+        self._put(self._static, key, (sources, tools))
+
+    def _put(self, entries: OrderedDict[Any, Any], key: Any, value: Any) -> None:
+        entries[key] = value
+        if len(entries) > self.maxsize:
+            entries.popitem(last=False)
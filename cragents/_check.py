@@ -0,0 +1,359 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline checks: guides are validated without an inference server, and outputs are matched against them."""
+
+import json
+import operator
+import re
+from collections.abc import Iterator, Sequence
+from typing import Any, cast
+
+from ._grammar import (
+    AnyText,
+    Newline,
+    Node,
+    Paragraphs,
+    Text,
+    Token,
+    ToolCall,
+    ToolChoice,
+    compile_grammar,
+    lower,
+    optimize,
+)
+from ._guide import CompiledGuide, check_resolved
+from ._schema import SUBSCHEMA_KEYWORDS, SUBSCHEMA_LIST_KEYWORDS, SUBSCHEMA_MAP_KEYWORDS, resolve_ref
+from ._types import GenerationSequenceElement
+
+_TYPE_NAMES = frozenset({"string", "integer", "number", "boolean", "null", "object", "array"})
+_NUMBER_BOUNDS = {
+    "minimum": operator.ge,
+    "maximum": operator.le,
+    "exclusiveMinimum": operator.gt,
+    "exclusiveMaximum": operator.lt,
+}
+_STRING_BOUNDS = {"minLength": operator.ge, "maxLength": operator.le}
+_ARRAY_BOUNDS = {"minItems": operator.ge, "maxItems": operator.le}
+_JSON_DECODER = json.JSONDecoder()
+# whitespace JSON allows between tokens
+_WS = r"[ \t\n\r]*"
+_OPEN_TOOL_CHOICE = re.compile(rf'\{{{_WS}"name"{_WS}:{_WS}("(?:[^"\\]|\\.)*"){_WS},{_WS}"arguments"{_WS}:{_WS}')
+_CLOSE_TOOL_CHOICE = re.compile(rf"{_WS}\}}\n")
+_CLOSE_CALL = re.compile(r"\}\n")
+
+
+# ── JSON schema ────────────────────────────────────────────────────────────────
+
+
+def _as_list(value: Any) -> list[Any]:
+    return cast(list[Any], value) if isinstance(value, list) else [value]
+
+
+def _check_keywords(schema: dict[str, Any], root: Any, path: str) -> None:
+    for type_name in _as_list(schema.get("type", [])):
+        if type_name not in _TYPE_NAMES:
+            raise ValueError(f"Unknown type {type_name!r} at {path}.")
+    required = schema.get("required", [])
+    if not isinstance(required, list) or not all(isinstance(name, str) for name in _as_list(required)):
+        raise ValueError(f"required must be a list of strings at {path}.")
+    if not isinstance(schema.get("enum", []), list):
+        raise ValueError(f"enum must be a list at {path}.")
+    if "pattern" in schema:
+        try:
+            re.compile(schema["pattern"])
+        except (re.error, TypeError) as e:
+            raise ValueError(f"Invalid pattern at {path}: {e}.") from None
+    if "$ref" in schema:
+        resolve_ref(schema["$ref"], root)
+
+
+def _check_schema(schema: Any, root: Any, path: str) -> None:
+    if isinstance(schema, bool):
+        return
+    if not isinstance(schema, dict):
+        raise ValueError(f"Schema at {path} must be an object or a boolean.")
+    schema = cast(dict[str, Any], schema)
+    _check_keywords(schema, root, path)
+    # sorted, so the first invalid subschema reported does not depend on set order
+    for keyword in sorted(SUBSCHEMA_KEYWORDS):
+        if keyword in schema:
+            if isinstance(schema[keyword], list):
+                # legacy `items` and `additionalItems` can hold a list of subschemas
+                for index, subschema in enumerate(cast(list[Any], schema[keyword])):
+                    _check_schema(subschema, root, f"{path}/{keyword}/{index}")
+            else:
+                _check_schema(schema[keyword], root, f"{path}/{keyword}")
+    for keyword in sorted(SUBSCHEMA_LIST_KEYWORDS):
+        if keyword in schema:
+            if not isinstance(schema[keyword], list):
+                raise ValueError(f"{keyword} must be a list at {path}.")
+            for index, subschema in enumerate(_as_list(schema[keyword])):
+                _check_schema(subschema, root, f"{path}/{keyword}/{index}")
+    for keyword in sorted(SUBSCHEMA_MAP_KEYWORDS):
+        if keyword in schema:
+            if not isinstance(schema[keyword], dict):
+                raise ValueError(f"{keyword} must be an object at {path}.")
+            subschemas = cast(dict[str, Any], schema[keyword])
+            for name, subschema in subschemas.items():
+                _check_schema(subschema, root, f"{path}/{keyword}/{name}")
+
+
+def check_json_schema(schema: Any) -> None:
+    """Check that a JSON schema is well formed and that every `$ref` resolves.
+
+    Raises:
+        ValueError: when the schema is invalid
+    """
+    _check_schema(schema, schema, "#")
+
+
+def _is_type(instance: Any, type_name: str) -> bool:
+    if type_name == "integer":
+        return (isinstance(instance, int) and not isinstance(instance, bool)) or (
+            isinstance(instance, float) and instance.is_integer()
+        )
+    if type_name == "number":
+        return isinstance(instance, int | float) and not isinstance(instance, bool)
+    python_types = {"string": str, "boolean": bool, "null": type(None), "object": dict, "array": list}
+    return isinstance(instance, python_types[type_name])
+
+
+def _value_error(instance: Any, schema: dict[str, Any], path: str) -> str | None:
+    types = schema.get("type")
+    if types is not None and not any(_is_type(instance, type_name) for type_name in _as_list(types)):
+        return f"{path} must be of type {types}"
+    if "enum" in schema and instance not in schema["enum"]:
+        return f"{path} must be one of {schema['enum']}"
+    if "const" in schema and instance != schema["const"]:
+        return f"{path} must be {schema['const']!r}"
+    if isinstance(instance, str) and "pattern" in schema and re.search(schema["pattern"], instance) is None:
+        return f"{path} must match {schema['pattern']!r}"
+    return _bound_error(instance, schema, path)
+
+
+def _bound_error(instance: Any, schema: dict[str, Any], path: str) -> str | None:
+    if isinstance(instance, str):
+        value, bounds = len(instance), _STRING_BOUNDS
+    elif isinstance(instance, list):
+        value, bounds = len(instance), _ARRAY_BOUNDS  # pyright: ignore[reportUnknownArgumentType]
+    elif isinstance(instance, int | float) and not isinstance(instance, bool):
+        value, bounds = instance, _NUMBER_BOUNDS
+    else:
+        return None
+    for keyword, within in bounds.items():
+        if keyword in schema and not within(value, schema[keyword]):
+            return f"{path} violates {keyword} {schema[keyword]}"
+    return None
+
+
+def _container_error(instance: Any, schema: dict[str, Any], root: Any, path: str) -> str | None:
+    if isinstance(instance, dict):
+        properties: dict[str, Any] = schema.get("properties", {})
+        for name in schema.get("required", []):
+            if name not in instance:
+                return f"{path} is missing required property {name!r}"
+        for name, value in instance.items():  # pyright: ignore[reportUnknownVariableType]
+            subschema = properties.get(name, schema.get("additionalProperties", True))  # pyright: ignore[reportUnknownArgumentType]
+            if error := _instance_error(value, subschema, root, f"{path}/{name}"):
+                return error
+    if isinstance(instance, list):
+        prefix: list[Any] = schema.get("prefixItems", [])
+        for index, value in enumerate(instance):  # pyright: ignore[reportUnknownVariableType, reportUnknownArgumentType]
+            subschema = prefix[index] if index < len(prefix) else schema.get("items", True)
+            if error := _instance_error(value, subschema, root, f"{path}/{index}"):
+                return error
+    return None
+
+
+def _combinator_error(instance: Any, schema: dict[str, Any], root: Any, path: str) -> str | None:
+    for subschema in schema.get("allOf", []):
+        if error := _instance_error(instance, subschema, root, path):
+            return error
+    if "anyOf" in schema and all(_instance_error(instance, s, root, path) for s in schema["anyOf"]):
+        return f"{path} does not match any schema in anyOf"
+    if "oneOf" in schema:
+        matches = sum(_instance_error(instance, s, root, path) is None for s in schema["oneOf"])
+        if matches != 1:
+            return f"{path} matches {matches} schemas in oneOf, exactly one must match"
+    if "not" in schema and _instance_error(instance, schema["not"], root, path) is None:
+        return f"{path} must not match {schema['not']}"
+    return None
+
+
+def _instance_error(instance: Any, schema: Any, root: Any, path: str) -> str | None:
+    if schema is True:
+        return None
+    if schema is False:
+        return f"{path} is not allowed"
+    if "$ref" in schema and (error := _instance_error(instance, resolve_ref(schema["$ref"], root), root, path)):
+        return error
+    return (
+        _value_error(instance, schema, path)
+        or _container_error(instance, schema, root, path)
+        or _combinator_error(instance, schema, root, path)
+    )
+
+
+# ── output matching ────────────────────────────────────────────────────────────
+
+
+def _describe(node: Node) -> str:
+    if isinstance(node, Text | Token):
+        return repr(node.text if isinstance(node, Text) else node.token)
+    if isinstance(node, Newline):
+        return "a newline"
+    if isinstance(node, Paragraphs):
+        return f"up to {node.max_newlines} paragraphs of up to {node.max_char_captures} {node.chars_to_capture!r}"
+    if isinstance(node, AnyText):
+        return "text" if node.max_chars is None else f"up to {node.max_chars} characters"
+    return "a tool call"
+
+
+def _name_pattern(function_name: str) -> str:
+    """Convert the Lark tool name rule to a Python regex."""
+    if len(function_name) > 1 and function_name.startswith("/") and function_name.endswith("/"):
+        return function_name[1:-1]
+    names = re.findall(r'"((?:[^"\\]|\\.)*)"', function_name)
+    if not names:
+        raise ValueError(f"Unsupported tool name rule {function_name!r}.")
+    return "|".join(re.escape(json.loads(f'"{name}"')) for name in names)
+
+
+class _Match:
+    """Backtracking match of a text against nodes, failures are memoized so each position is tried once per node.
+
+    The reported failure is the one of the latest node, so text matched by `Free` does not hide the real mismatch.
+    """
+
+    def __init__(self, nodes: Sequence[Node], patterns: dict[Node, re.Pattern[str]], text: str) -> None:
+        self.nodes = nodes
+        self.patterns = patterns
+        self.text = text
+        self.failed: set[tuple[int, int]] = set()
+        self.furthest = (-1, -1, "")
+
+    def fail(self, index: int, pos: int, reason: str) -> None:
+        if (index, pos) >= self.furthest[:2]:
+            self.furthest = (index, pos, reason)
+
+    def ends(self, index: int, pos: int) -> Iterator[int]:
+        """Positions where the node can end when it starts at `pos`, longest first."""
+        text, node = self.text, self.nodes[index]
+        if isinstance(node, Text | Token | Newline):
+            literal = node.text if isinstance(node, Text) else node.token if isinstance(node, Token) else "\n"
+            if text.startswith(literal, pos):
+                yield pos + len(literal)
+        elif isinstance(node, AnyText):
+            stop = len(text) if node.max_chars is None else min(len(text), pos + node.max_chars)
+            yield from range(stop, pos - 1, -1)
+        elif isinstance(node, Paragraphs):
+            ends: list[int] = []
+            end = pos
+            while len(ends) < node.max_newlines and (match := self.patterns[node].match(text, end)):
+                end = match.end()
+                ends.append(end)
+            yield from reversed(ends)
+        elif isinstance(node, ToolCall) and (match := self.patterns[node].match(text, pos)) is not None:
+            yield from self.tool_call_end(index, node.schema, match.end(), _CLOSE_CALL)
+        elif isinstance(node, ToolChoice) and (match := _OPEN_TOOL_CHOICE.match(text, pos)) is not None:
+            # Lark writes a tool choice as one `%json` object, which allows JSON whitespace between its keys,
+            # the arguments are checked against the schema of the tool that was named
+            if (schema := dict(node.tools).get(name := json.loads(match.group(1)))) is None:
+                self.fail(index, match.start(1), f"tool call names an unknown tool {name!r}")
+            else:
+                yield from self.tool_call_end(index, schema, match.end(), _CLOSE_TOOL_CHOICE)
+
+    def tool_call_end(self, index: int, schema: str, pos: int, close: re.Pattern[str]) -> Iterator[int]:
+        try:
+            arguments, end = _JSON_DECODER.raw_decode(self.text, pos)
+        except json.JSONDecodeError as e:
+            self.fail(index, pos, f"tool call arguments are not valid JSON: {e.msg}")
+            return
+        if error := _instance_error(arguments, root := json.loads(schema), root, "arguments"):
+            self.fail(index, pos, f"tool call {error}")
+        elif (match := close.match(self.text, end)) is not None:
+            yield match.end()
+
+    def run(self, index: int, pos: int) -> bool:
+        if index == len(self.nodes):
+            if pos == len(self.text):
+                return True
+            self.fail(index, pos, "expected the end of the output")
+            return False
+        if (index, pos) in self.failed:
+            return False
+        if any(self.run(index + 1, end) for end in self.ends(index, pos)):
+            return True
+        self.fail(index, pos, f"expected {_describe(self.nodes[index])}")
+        self.failed.add((index, pos))
+        return False
+
+
+class GuideChecker:
+    """Check a guide offline, then match outputs against it without an inference server.
+
+    Creating a checker builds and validates the grammar and checks every tool schema, so misconfigured guides
+    fail in CI or at startup. Outputs are matched the way the grammar constrains them, special tokens are
+    expected as text. Use `CRAgent.check_guide` to resolve tool schemas from an agent's tools.
+
+    Args:
+        guide: a generation sequence with tool schemas resolved, or a compiled guide
+
+    Raises:
+        ValueError: when the guide is invalid
+    """
+
+    def __init__(self, guide: Sequence[GenerationSequenceElement] | CompiledGuide) -> None:
+        generation_sequence = guide.generation_sequence if isinstance(guide, CompiledGuide) else guide
+        check_resolved(generation_sequence)
+        self.nodes = optimize(lower(generation_sequence))
+        if isinstance(guide, CompiledGuide):
+            guide.backend.validate(guide.grammar, self.nodes)
+        else:
+            compile_grammar(generation_sequence)
+
+        self._patterns: dict[Node, re.Pattern[str]] = {}
+        for node in self.nodes:
+            if isinstance(node, Paragraphs):
+                chars = re.escape(node.chars_to_capture)
+                self._patterns[node] = re.compile(rf"(?:[^{chars}\n]+[{chars}]){{1,{node.max_char_captures}}}\n\n")
+            elif isinstance(node, ToolCall):
+                check_json_schema(json.loads(node.schema))
+                name = _name_pattern(node.function_name)
+                self._patterns[node] = re.compile(rf'\{{"name": "(?:{name})", "arguments": ')
+            elif isinstance(node, ToolChoice):
+                for schema in dict.fromkeys(schema for _, schema in node.tools):
+                    check_json_schema(json.loads(schema))
+
+    def check(self, text: str) -> None:
+        """Check that the guide allows the output.
+
+        Raises:
+            ValueError: with the position where the output stops matching
+        """
+        match = _Match(self.nodes, self._patterns, text)
+        if not match.run(0, 0):
+            _, pos, reason = match.furthest
+            raise ValueError(
+                f"Output does not match the guide at position {pos}: {reason}, got {text[pos : pos + 20]!r}."
+            )
+
+    def matches(self, text: str) -> bool:
+        """Whether the guide allows the output."""
+        try:
+            self.check(text)
+        except ValueError:
+            return False
+        return True
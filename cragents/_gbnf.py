@@ -0,0 +1,354 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""GBNF emission for llama.cpp, also used for XGrammar EBNF, which has the same syntax."""
+
+import json
+import re
+from collections.abc import Sequence
+from typing import Any, cast
+
+from ._grammar import (
+    AnyText,
+    GrammarBackend,
+    Newline,
+    Node,
+    Paragraphs,
+    Text,
+    Token,
+    ToolCall,
+    ToolChoice,
+    open_tool_call,
+    tool_schema_rules,
+)
+from ._schema import ANNOTATION_KEYWORDS, merge_schema_defs, ref_names, resolve_ref
+
+FREE_DEF = r"free ::= [^\x00]*"
+
+JSON_DEFS = (
+    r'ws ::= " "?',
+    r'json-char ::= [^"\\\x00-\x1f] | "\\" ( ["\\/bfnrt] | "u" [0-9a-fA-F]{4} )',
+    r'json-string ::= "\"" json-char* "\""',
+    r'json-integer ::= "-"? ( "0" | [1-9] [0-9]* )',
+    r'json-number ::= json-integer ( "." [0-9]+ )? ( [eE] [-+]? [0-9]+ )?',
+    r'json-boolean ::= "true" | "false"',
+    r'json-value ::= json-object | json-array | json-string | json-number | json-boolean | "null"',
+    r'json-object ::= "{" ws ( json-member ( "," ws json-member )* )? "}"',
+    r'json-member ::= json-string ":" ws json-value',
+    r'json-array ::= "[" ws ( json-value ( "," ws json-value )* )? "]"',
+)
+
+_ESCAPES = {'"': '\\"', "\\": "\\\\", "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_CLASS_ESCAPES = {"\\": "\\\\", "[": "\\[", "]": "\\]", "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+_PRIMITIVES = {
+    "string": "json-string",
+    "integer": "json-integer",
+    "number": "json-number",
+    "boolean": "json-boolean",
+    "null": '"null"',
+}
+_UNSUPPORTED_KEYWORDS = ("pattern", "patternProperties", "prefixItems", "not", "if", "dependentSchemas")
+# a tool name regex made of character classes and plain characters, each with an optional quantifier
+_NAME_REGEX_PART = re.compile(r"(\[(?:[^\]\\]|\\.)+\]|[A-Za-z0-9_-])([+*?]|\{\d+(?:,\d*)?\})?")
+
+
+def literal(text: str) -> str:
+    """GBNF string literal."""
+    escaped = [_ESCAPES.get(char) or (f"\\x{ord(char):02x}" if ord(char) < 0x20 else char) for char in text]
+    return f'"{"".join(escaped)}"'
+
+
+def _char_class(chars: str, negate: bool = False) -> str:
+    # a trailing "-" is a literal, anywhere else it makes a range
+    chars = "".join(sorted(dict.fromkeys(chars), key=lambda char: char == "-"))
+    escaped = [_CLASS_ESCAPES.get(char) or (f"\\x{ord(char):02x}" if ord(char) < 0x20 else char) for char in chars]
+    return f"[{'^' if negate else ''}{''.join(escaped)}]"
+
+
+def _function_name(function_name: str) -> str:
+    # `ToolCall.function_name` is a Lark expression, a regex or an alternation of quoted names
+    if not (function_name.startswith("/") and function_name.endswith("/")):
+        return function_name
+    regex = function_name[1:-1]
+    parts = list(_NAME_REGEX_PART.finditer(regex))
+    if "".join(part.group(0) for part in parts) != regex:
+        raise ValueError(f"tool_name_regex {function_name!r} can not be written in GBNF, use tool_names instead.")
+    return " ".join(
+        (part.group(1) if part.group(1).startswith("[") else literal(part.group(1))) + (part.group(2) or "")
+        for part in parts
+    )
+
+
+def _repeat(count_min: int, count_max: int | None) -> str:
+    if count_max is None:
+        return "*" if count_min == 0 else "+" if count_min == 1 else f"{{{count_min},}}"
+    return f"{{{count_min},{count_max}}}"
+
+
+class _JsonSchemaRules:
+    """Emit GBNF rules for the values a JSON schema accepts.
+
+    Supports the keywords Pydantic generates for tool arguments. Value bounds such as `minimum` and `format` are not
+    enforced, keywords that can not be written in GBNF raise `ValueError`.
+    """
+
+    def __init__(self, root: Any, name: str, defs: list[str], names: dict[str, str] | None = None) -> None:
+        self.root = root
+        self.name = name
+        self.defs = defs
+        # schemas whose `$defs` share one namespace can share rules too
+        self._names: dict[str, str] = {} if names is None else names
+        self._count = 0
+
+    def _new_rule(self, suffix: str | None = None) -> str:
+        self._count += 1
+        return f"{self.name}-{self._count}" if suffix is None else f"{self.name}-{self._count}-{suffix}"
+
+    def _rule(self, key: str, suffix: str | None, body: Any) -> str:
+        # the name is reserved before the body is emitted, so recursive schemas terminate
+        if (name := self._names.get(key)) is None:
+            name = self._names[key] = self._new_rule(suffix)
+            self.defs.append(f"{name} ::= {self.expression(body)}")
+        return name
+
+    def symbol(self, schema: Any) -> str:
+        """A rule name or a short expression for a schema."""
+        if schema is True or schema == {}:
+            return "json-value"
+        if not isinstance(schema, dict):
+            raise ValueError(f"Invalid JSON schema {schema!r}.")
+        schema = cast(dict[str, Any], schema)
+        keywords = set(schema) - ANNOTATION_KEYWORDS
+        if keywords == {"type"} and isinstance(schema["type"], str) and schema["type"] in _PRIMITIVES:
+            return _PRIMITIVES[schema["type"]]
+        if keywords == {"$ref"}:
+            ref: str = schema["$ref"]
+            suffix = re.sub(r"[^a-zA-Z0-9]+", "-", ref.rsplit("/", 1)[-1]).strip("-") or None
+            return self._rule(f"$ref:{ref}", suffix, resolve_ref(ref, self.root))
+        return self._rule(json.dumps(schema, sort_keys=True), None, schema)
+
+    def expression(self, schema: Any) -> str:
+        """GBNF expression for the values a schema accepts."""
+        if schema is True or schema == {} or not isinstance(schema, dict):
+            return self.symbol(schema)
+        schema = cast(dict[str, Any], schema)
+        for keyword in _UNSUPPORTED_KEYWORDS:
+            if keyword in schema:
+                raise ValueError(f"JSON schema keyword {keyword!r} can not be written in GBNF.")
+        if "$ref" in schema:
+            return self.symbol({"$ref": schema["$ref"]})
+        if "const" in schema:
+            return literal(json.dumps(schema["const"], ensure_ascii=False))
+        if "enum" in schema:
+            values = cast(list[Any], schema["enum"])
+            return f"( {' | '.join(literal(json.dumps(value, ensure_ascii=False)) for value in values)} )"
+        for keyword in ("anyOf", "oneOf", "allOf"):
+            if keyword in schema:
+                subschemas = cast(list[Any], schema[keyword])
+                if keyword == "allOf" and len(subschemas) != 1:
+                    raise ValueError("JSON schema allOf with more than one schema can not be written in GBNF.")
+                return f"( {' | '.join(self.symbol(subschema) for subschema in subschemas)} )"
+        types = schema.get("type", "object" if "properties" in schema else None)
+        if types is None:
+            return "json-value"
+        if isinstance(types, list):
+            return f"( {' | '.join(self._typed(schema, type_name) for type_name in cast(list[str], types))} )"
+        return self._typed(schema, cast(str, types))
+
+    def _typed(self, schema: dict[str, Any], type_name: str) -> str:
+        if type_name == "string" and ("minLength" in schema or "maxLength" in schema):
+            return f'"\\"" json-char{_repeat(schema.get("minLength", 0), schema.get("maxLength"))} "\\""'
+        if type_name == "array":
+            return self._array(schema)
+        if type_name == "object":
+            return self._object(schema)
+        if type_name not in _PRIMITIVES:
+            raise ValueError(f"Unknown JSON schema type {type_name!r}.")
+        return _PRIMITIVES[type_name]
+
+    def _array(self, schema: dict[str, Any]) -> str:
+        item = self.symbol(schema.get("items", True))
+        min_items: int = schema.get("minItems", 0)
+        max_items: int | None = schema.get("maxItems")
+        if max_items == 0:
+            return '"[" ws "]"'
+        rest = _repeat(max(min_items - 1, 0), None if max_items is None else max_items - 1)
+        items = f'{item} ( "," ws {item} ){rest}'
+        return f'"[" ws {items} "]"' if min_items else f'"[" ws ( {items} )? "]"'
+
+    def _object(self, schema: dict[str, Any]) -> str:
+        properties = cast(dict[str, Any], schema.get("properties", {}))
+        if not properties:
+            additional = schema.get("additionalProperties", True)
+            if additional is False:
+                return '"{" ws "}"'
+            value = self.symbol(additional)
+            member = f'json-string ":" ws {value}'
+            return f'"{{" ws ( {member} ( "," ws {member} )* )? "}}"'
+        required = set(cast(list[str], schema.get("required", [])))
+        members = [
+            (f"{literal(json.dumps(name, ensure_ascii=False) + ':')} ws {self.symbol(value)}", name in required)
+            for name, value in properties.items()
+        ]
+        return f'"{{" ws {self._members(members, 0, False, {})} "}}"'
+
+    def _members(
+        self, members: list[tuple[str, bool]], index: int, preceded: bool, memo: dict[tuple[int, bool], str]
+    ) -> str:
+        # properties in schema order, a comma goes before every property that follows another one
+        if index == len(members):
+            return ""
+        if (name := memo.get((index, preceded))) is not None:
+            return name
+        member, required = members[index]
+        separator = '"," ws ' if preceded else ""
+        present = f"{separator}{member} {self._members(members, index + 1, True, memo)}".strip()
+        if required:
+            return present
+        absent = self._members(members, index + 1, preceded, memo)
+        expression = f"( {present} | {absent} )" if absent else f"( {present} )?"
+        # optional properties branch, so shared tails become rules to keep the grammar linear in size
+        name = memo[(index, preceded)] = self._new_rule()
+        self.defs.append(f"{name} ::= {expression}")
+        return name
+
+
+class _Emitter:
+    """Emit GBNF symbols for nodes, identical nodes share one set of rules."""
+
+    def __init__(self) -> None:
+        self.defs: list[str] = []
+        self.uses_json = False
+        self._names: dict[Node, str] = {}
+        self._paragraphs = 0
+        self._tool_calls = 0
+
+    def symbol(self, node: Node) -> str:
+        if isinstance(node, Text):
+            return literal(node.text)
+        if isinstance(node, Token):
+            # special tokens are matched by their text
+            return literal(node.token)
+        if isinstance(node, Newline):
+            return literal("\n")
+        if isinstance(node, AnyText) and node.max_chars is None:
+            return "free"
+        if (name := self._names.get(node)) is None:
+            name = self._names[node] = self._define(node)
+        return name
+
+    def _define(self, node: Paragraphs | AnyText | ToolCall | ToolChoice) -> str:
+        if isinstance(node, AnyText):
+            name = f"free-{node.max_chars}"
+            self.defs.append(f"{name} ::= [^\\x00]{{0,{node.max_chars}}}")
+            return name
+
+        if isinstance(node, Paragraphs):
+            self._paragraphs += 1
+            uid = self._paragraphs
+            capture = " | ".join([literal(x) for x in node.chars_to_capture])
+            self.defs.append(f"block-{uid} ::= p-{uid}{{1,{node.max_newlines}}}")
+            self.defs.append(f"p-{uid} ::= s-{uid}{{1,{node.max_char_captures}}} {literal(chr(10) * 2)}")
+            self.defs.append(f"s-{uid} ::= {_char_class(node.chars_to_capture + chr(10), negate=True)}+ ( {capture} )")
+            return f"block-{uid}"
+
+        # the first tool call keeps the unnumbered names
+        self._tool_calls += 1
+        self.uses_json = True
+        suffix = f"-{self._tool_calls}" if self._tool_calls > 1 else ""
+        if isinstance(node, ToolChoice):
+            schema_rules = tool_schema_rules(node, f"tool{suffix}-args-")
+            close_call = literal("}\n")
+            alternatives = [
+                f"{literal(open_tool_call(tool_name))} {schema_rules[schema]} {close_call}"
+                for tool_name, schema in node.tools
+            ]
+            self.defs.append(f"tool-call{suffix} ::= {' | '.join(alternatives)}")
+            # equal definitions get one name across tools and are written once,
+            # schemas with references outside their `$defs` keep their own rules
+            merged = merge_schema_defs({rule: json.loads(schema) for schema, rule in schema_rules.items()})
+            shared_names: dict[str, str] = {}
+            for rule, parsed in merged.items():
+                names = shared_names if None not in ref_names(parsed, set()) else None
+                self.defs.append(f"{rule} ::= {_JsonSchemaRules(parsed, rule, self.defs, names).expression(parsed)}")
+            return f"tool-call{suffix}"
+
+        name, name_rule, schema_rule = f"tool-call{suffix}", f"function-name{suffix}", f"tool-schema{suffix}"
+        open_call, close_call = literal('{"name": "'), literal('", "arguments": ')
+        self.defs.append(f"{name} ::= {open_call} {name_rule} {close_call} {schema_rule} {literal('}' + chr(10))}")
+        self.defs.append(f"{name_rule} ::= {_function_name(node.function_name)}")
+        schema = json.loads(node.schema)
+        self.defs.append(f"{schema_rule} ::= {_JsonSchemaRules(schema, schema_rule, self.defs).expression(schema)}")
+        return name
+
+
+def emit_gbnf(nodes: Sequence[Node]) -> str:
+    """Lower nodes to GBNF grammar text."""
+    emitter = _Emitter()
+    root = " ".join([emitter.symbol(node) for node in nodes]) or '""'
+    return "\n".join([f"root ::= {root}", *emitter.defs, FREE_DEF, *(JSON_DEFS if emitter.uses_json else ())])
+
+
+_RULE_DEF = re.compile(r"([a-zA-Z][a-zA-Z0-9-]*) ::= (.*)")
+# parts of a rule body that are not references to other rules
+_NON_REFERENCES = re.compile(r'"(?:[^"\\]|\\.)*"|\[(?:[^\]\\]|\\.)*\]|\{\d+(?:,\d*)?\}')
+_REFERENCE = re.compile(r"[a-zA-Z][a-zA-Z0-9-]*")
+
+
+def validate_gbnf(grammar: str) -> None:
+    """Check that every rule is well formed, defined once, and only references defined rules.
+
+    Raises:
+        ValueError: when the grammar is invalid
+    """
+    bodies: dict[str, str] = {}
+    for line in grammar.splitlines():
+        if not line.strip():
+            continue
+        if (match := _RULE_DEF.fullmatch(line)) is None:
+            raise ValueError(f"Invalid grammar line: {line!r}.")
+        name, body = match.groups()
+        if name in bodies:
+            raise ValueError(f"Grammar rule {name!r} is defined more than once.")
+        bodies[name] = body
+
+    if "root" not in bodies:
+        raise ValueError("Grammar has no root rule.")
+    for name, body in bodies.items():
+        for reference in _REFERENCE.findall(_NON_REFERENCES.sub(" ", body)):
+            if reference not in bodies:
+                raise ValueError(f"Grammar rule {name!r} references undefined {reference!r}.")
+
+
+class GBNFBackend(GrammarBackend):
+    """GBNF grammars for the llama.cpp server, sent in the request `grammar` field."""
+
+    name = "llama_cpp"
+    grammar_path = ("grammar",)
+    # llama.cpp continues a final assistant message on its own
+    continue_final_message = False
+
+    def emit(self, nodes: Sequence[Node]) -> str:
+        return emit_gbnf(nodes)
+
+    def validate(self, grammar: str, nodes: Sequence[Node]) -> None:
+        validate_gbnf(grammar)
+
+
+class XGrammarBackend(GBNFBackend):
+    """EBNF grammars for SGLang with the XGrammar backend, sent in the request `ebnf` field."""
+
+    name = "sglang"
+    grammar_path = ("ebnf",)
+    continue_final_message = True
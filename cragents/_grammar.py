@@ -0,0 +1,446 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Grammar compiler: generation sequences are lowered to a flat list of nodes, optimized, then emitted by a backend."""
+
+import abc
+import dataclasses
+import json
+import re
+from collections.abc import Callable, Iterable, Mapping, Sequence
+
+from ._schema import merge_schema_defs, ref_names
+from ._types import Anchor, Constrain, Free, GenerationSequenceElement, JsonSchema, Think, UseTools
+
+DEFAULT_DEFS = (
+    "FREE: /[\\S\\s]*/",
+    "NL: /\\n/",
+)
+
+
+# ── intermediate representation ────────────────────────────────────────────────
+
+
+@dataclasses.dataclass(frozen=True)
+class Text:
+    """Exact text, from `Anchor`."""
+
+    text: str
+
+
+@dataclasses.dataclass(frozen=True)
+class Token:
+    """Special token, such as the `Think` and `UseTools` start and stop tokens."""
+
+    token: str
+
+
+@dataclasses.dataclass(frozen=True)
+class Newline:
+    """A single newline."""
+
+
+@dataclasses.dataclass(frozen=True)
+class Paragraphs:
+    """Paragraphs of sentences, from `Constrain`."""
+
+    max_newlines: int
+    max_char_captures: int
+    chars_to_capture: str
+
+
+@dataclasses.dataclass(frozen=True)
+class AnyText:
+    """Unconstrained text, from `Free`."""
+
+    max_chars: int | None
+
+
+@dataclasses.dataclass(frozen=True)
+class ToolCall:
+    """A tool call object, from `UseTools`."""
+
+    function_name: str
+    schema: str
+
+
+@dataclasses.dataclass(frozen=True)
+class ToolChoice:
+    """A tool call object whose arguments follow the schema of the named tool, from `UseTools.tools`."""
+
+    tools: tuple[tuple[str, str], ...]
+
+
+Node = Text | Token | Newline | Paragraphs | AnyText | ToolCall | ToolChoice
+
+
+def open_tool_call(tool_name: str) -> str:
+    """Start of a tool call object up to the arguments, with the tool name written as JSON."""
+    return f'{{"name": {json.dumps(tool_name, ensure_ascii=False)}, "arguments": '
+
+
+def tool_schema_rules(node: ToolChoice, prefix: str) -> dict[str, str]:
+    """Rule names of the argument schemas of a tool choice, tools with the same schema share a rule."""
+    rules: dict[str, str] = {}
+    for _, schema in node.tools:
+        rules.setdefault(schema, f"{prefix}{len(rules) + 1}")
+    return rules
+
+
+def tool_call_schema(node: ToolChoice) -> JsonSchema | None:
+    """One schema for the whole tool call object, with the `$defs` of all tools merged and written once.
+
+    Each distinct arguments schema is a branch that names the tools using it. Returns `None` when an arguments
+    schema references anything outside its own `$defs`, since the references would not resolve in the branch.
+    """
+    tool_names: dict[str, list[str]] = {}
+    for tool_name, schema in node.tools:
+        tool_names.setdefault(schema, []).append(tool_name)
+    parsed: dict[str, JsonSchema] = {schema: json.loads(schema) for schema in tool_names}
+    if any(not ref_names(schema, set()) <= set(schema.get("$defs", {})) for schema in parsed.values()):
+        return None
+
+    defs: JsonSchema = {}
+    branches: list[JsonSchema] = []
+    for schema, arguments in merge_schema_defs(parsed).items():
+        arguments = dict(arguments)
+        # merged definitions with the same name are equal, so every tool can use the one copy
+        defs.update(arguments.pop("$defs", {}))
+        names = tool_names[schema]
+        branches.append(
+            {
+                "type": "object",
+                "properties": {
+                    "name": {"const": names[0]} if len(names) == 1 else {"enum": names},
+                    "arguments": arguments,
+                },
+                "required": ["name", "arguments"],
+                "additionalProperties": False,
+            }
+        )
+    call: JsonSchema = branches[0] if len(branches) == 1 else {"anyOf": branches}
+    if defs:
+        call["$defs"] = defs
+    return call
+
+
+def _allowed_tools(element: UseTools) -> Mapping[str, JsonSchema]:
+    tools = element.tools or {}
+    if element.tool_names:
+        return {name: schema for name, schema in tools.items() if name in element.tool_names}
+    regex = element.tool_name_regex
+    if len(regex) > 1 and regex.startswith("/") and regex.endswith("/"):
+        return {name: schema for name, schema in tools.items() if re.fullmatch(regex[1:-1], name)}
+    return tools
+
+
+def _lower_element(element: GenerationSequenceElement) -> Iterable[Node]:
+    if isinstance(element, Anchor):
+        yield Text(element.text)
+    elif isinstance(element, Constrain):
+        yield Paragraphs(element.max_newlines, element.max_char_captures, element.chars_to_capture)
+    elif isinstance(element, Free):
+        yield AnyText(element.max_chars)
+    elif isinstance(element, Think):
+        yield Token(element.start_token)
+        yield Newline()
+        for think_element in element.sequence:
+            yield from _lower_element(think_element)
+        yield Token(element.stop_token)
+    elif element.tools is not None:
+        # each tool name is tied to its own arguments
+        tools = _allowed_tools(element)
+        yield Token(element.start_token)
+        yield ToolChoice(tuple((name, json.dumps(schema)) for name, schema in tools.items()))
+        yield Token(element.stop_token)
+    else:
+        if not element.tool_names:
+            function_name = element.tool_name_regex
+        else:
+            tool_names = [f'"{tool_name}"' for tool_name in element.tool_names]
+            function_name = f"({' | '.join(tool_names)})"
+        yield Token(element.start_token)
+        yield ToolCall(function_name, json.dumps(element.json_schema))
+        yield Token(element.stop_token)
+
+
+def lower(generation_sequence: Sequence[GenerationSequenceElement]) -> list[Node]:
+    """Flatten a generation sequence, `Think` included, into the nodes of the start rule."""
+    return [node for element in generation_sequence for node in _lower_element(element)]
+
+
+# ── passes ─────────────────────────────────────────────────────────────────────
+
+
+def fold_empty(nodes: Sequence[Node]) -> list[Node]:
+    """Drop nodes that can only generate empty text: empty anchors and constraints allowing no paragraphs."""
+    return [
+        node
+        for node in nodes
+        if not (isinstance(node, Text) and not node.text)
+        and not (isinstance(node, Paragraphs) and (node.max_newlines < 1 or node.max_char_captures < 1))
+        and not (isinstance(node, AnyText) and node.max_chars == 0)
+    ]
+
+
+def merge_texts(nodes: Sequence[Node]) -> list[Node]:
+    """Join adjacent exact texts into one."""
+    merged: list[Node] = []
+    for node in nodes:
+        if isinstance(node, Text) and merged and isinstance(previous := merged[-1], Text):
+            merged[-1] = Text(previous.text + node.text)
+        else:
+            merged.append(node)
+    return merged
+
+
+PASSES: tuple[Callable[[Sequence[Node]], list[Node]], ...] = (fold_empty, merge_texts)
+
+
+def optimize(nodes: Sequence[Node]) -> list[Node]:
+    result = list(nodes)
+    for grammar_pass in PASSES:
+        result = grammar_pass(result)
+    return result
+
+
+def split_prefix(nodes: Sequence[Node]) -> tuple[str, list[Node]]:
+    """Split the leading nodes that can only generate one text from the rest.
+
+    At least one node is kept, so the rest always makes a grammar.
+    """
+    prefix: list[str] = []
+    for index, node in enumerate(nodes[:-1]):
+        if isinstance(node, Text):
+            prefix.append(node.text)
+        elif isinstance(node, Token):
+            prefix.append(node.token)
+        elif isinstance(node, Newline):
+            prefix.append("\n")
+        else:
+            return "".join(prefix), list(nodes[index:])
+    return "".join(prefix), list(nodes[-1:])
+
+
+# ── emission ───────────────────────────────────────────────────────────────────
+
+
+class _Emitter:
+    """Emit grammar symbols for nodes, identical nodes share one set of rules."""
+
+    def __init__(self) -> None:
+        self.defs: list[str] = []
+        self._names: dict[Node, str] = {}
+        self._paragraphs = 0
+        self._tool_calls = 0
+
+    def symbol(self, node: Node) -> str:
+        if isinstance(node, Text):
+            return json.dumps(node.text, ensure_ascii=False)
+        if isinstance(node, Token):
+            return node.token
+        if isinstance(node, Newline):
+            return "NL"
+        if isinstance(node, AnyText) and node.max_chars is None:
+            return "FREE"
+        if (name := self._names.get(node)) is None:
+            name = self._names[node] = self._define(node)
+        return name
+
+    def _define(self, node: Paragraphs | AnyText | ToolCall | ToolChoice) -> str:
+        if isinstance(node, AnyText):
+            name = f"FREE_{node.max_chars}"
+            self.defs.append(f"{name}: /[\\S\\s]{{0,{node.max_chars}}}/")
+            return name
+
+        if isinstance(node, Paragraphs):
+            self._paragraphs += 1
+            uid = self._paragraphs
+            capture = " | ".join([f'"{x}"' for x in node.chars_to_capture])
+            self.defs.append(f"block_{uid}: p_{uid}{{1,{node.max_newlines}}}")
+            self.defs.append(f"p_{uid}: s_{uid}{{1,{node.max_char_captures}}} NL NL")
+            self.defs.append(f"s_{uid}[lazy]: /[^{re.escape(node.chars_to_capture)}\\n]+/ ( {capture} )")
+            return f"block_{uid}"
+
+        # the first tool call keeps the unnumbered names
+        self._tool_calls += 1
+        suffix = f"_{self._tool_calls}" if self._tool_calls > 1 else ""
+        if isinstance(node, ToolChoice) and (call := tool_call_schema(node)) is not None:
+            # vLLM compiles each `%json` on its own, so one object schema is the only way to share `$defs`
+            self.defs.append(f"tool_call{suffix}: tool_object{suffix} {json.dumps(chr(10))}")
+            self.defs.append(f"tool_object{suffix}: %json {json.dumps(call)}")
+            return f"tool_call{suffix}"
+        if isinstance(node, ToolChoice):
+            schema_rules = tool_schema_rules(node, f"tool{suffix}_args_")
+            close_call = json.dumps("}\n")
+            alternatives = [
+                f"{json.dumps(open_tool_call(tool_name), ensure_ascii=False)} {schema_rules[schema]} {close_call}"
+                for tool_name, schema in node.tools
+            ]
+            self.defs.append(f"tool_call{suffix}: {' | '.join(alternatives)}")
+            self.defs.extend(f"{rule}: %json {schema}" for schema, rule in schema_rules.items())
+            return f"tool_call{suffix}"
+
+        name, name_rule, schema_rule = f"tool_call{suffix}", f"FUNCTION_NAME{suffix}", f"tool_schema{suffix}"
+        self.defs.append(f'{name}: "{{\\"name\\": \\"" {name_rule} "\\", \\"arguments\\": " {schema_rule} "}}\\n"')
+        self.defs.append(f"{schema_rule}: %json {node.schema}")
+        self.defs.append(f"{name_rule}: {node.function_name}")
+        return name
+
+
+def emit(nodes: Sequence[Node]) -> str:
+    """Lower nodes to Lark grammar text."""
+    emitter = _Emitter()
+    start = " ".join([emitter.symbol(node) for node in nodes])
+    return "\n".join([f"start: {start}".strip(), *emitter.defs, *DEFAULT_DEFS])
+
+
+# ── validation ─────────────────────────────────────────────────────────────────
+
+_RULE_DEF = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)(?:\[lazy\])?: ?(.*)")
+# parts of a rule body that are not references to other rules
+_NON_REFERENCES = re.compile(r'%json .*|"(?:[^"\\]|\\.)*"|/(?:[^/\\\n]|\\.)+/|<[^<>\s]+>|\{\d+(?:,\d+)?\}')
+_REFERENCE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def validate_nodes(nodes: Sequence[Node]) -> None:
+    """Check nodes for values that can not be turned into a valid grammar.
+
+    Raises:
+        ValueError: when a node is invalid
+    """
+    for node in nodes:
+        if isinstance(node, Paragraphs) and not node.chars_to_capture:
+            raise ValueError("Constrain chars_to_capture must not be empty.")
+        if isinstance(node, Token) and (not node.token or any(char.isspace() for char in node.token)):
+            raise ValueError(f"Invalid special token {node.token!r}, tokens must not be empty or contain spaces.")
+        if isinstance(node, ToolChoice) and not node.tools:
+            raise ValueError("UseTools allows none of its tools, check tool_names and tool_name_regex.")
+
+
+def validate_grammar(grammar: str, tokens: Iterable[str] = ()) -> None:
+    """Check that every rule is well formed, defined once, and only references defined rules.
+
+    Args:
+        grammar: Lark grammar text
+        tokens: special tokens used in the grammar that are not written as `<...>`
+
+    Raises:
+        ValueError: when the grammar is invalid
+    """
+    custom_tokens = sorted(set(tokens), key=len, reverse=True)
+    bodies: dict[str, str] = {}
+    for line in grammar.splitlines():
+        if not line.strip():
+            continue
+        if (match := _RULE_DEF.fullmatch(line)) is None:
+            raise ValueError(f"Invalid grammar line: {line!r}.")
+        name, body = match.groups()
+        if name in bodies:
+            raise ValueError(f"Grammar rule {name!r} is defined more than once.")
+        bodies[name] = body
+
+    if "start" not in bodies:
+        raise ValueError("Grammar has no start rule.")
+    for name, body in bodies.items():
+        body = _NON_REFERENCES.sub(" ", body)
+        for token in custom_tokens:
+            body = body.replace(token, " ")
+        for reference in _REFERENCE.findall(body):
+            if reference not in bodies:
+                raise ValueError(f"Grammar rule {name!r} references undefined {reference!r}.")
+
+
+# ── backends ───────────────────────────────────────────────────────────────────
+
+
+class GrammarBackend(abc.ABC):
+    """Emits nodes in the grammar syntax of an inference server, and places the grammar in its requests.
+
+    Attributes:
+        name: identifies the backend in compiled guides and cache keys
+        grammar_path: keys of the grammar in the request `extra_body`
+        continue_final_message: whether the server needs `continue_final_message` to continue a prefill
+    """
+
+    name: str
+    grammar_path: tuple[str, ...]
+    continue_final_message: bool = True
+
+    @abc.abstractmethod
+    def emit(self, nodes: Sequence[Node]) -> str:
+        """Lower nodes to grammar text."""
+
+    def validate(self, grammar: str, nodes: Sequence[Node]) -> None:
+        """Check emitted grammar text, raise `ValueError` when it is invalid."""
+
+    def grammar_body(self, grammar: str) -> JsonSchema:
+        """Request fields that carry the grammar."""
+        body: JsonSchema = {self.grammar_path[-1]: grammar}
+        for key in reversed(self.grammar_path[:-1]):
+            body = {key: body}
+        return body
+
+    def request_grammar(self, extra_body: JsonSchema) -> str:
+        """Read the grammar back from a request `extra_body`."""
+        value = extra_body
+        for key in self.grammar_path:
+            value = value[key]
+        return value  # pyright: ignore[reportReturnType]
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}()"
+
+
+class LarkBackend(GrammarBackend):
+    """Lark grammars for vLLM with the llguidance structured outputs backend."""
+
+    name = "vllm"
+    grammar_path = ("structured_outputs", "grammar")
+
+    def emit(self, nodes: Sequence[Node]) -> str:
+        return emit(nodes)
+
+    def validate(self, grammar: str, nodes: Sequence[Node]) -> None:
+        validate_grammar(grammar, tokens=[node.token for node in nodes if isinstance(node, Token)])
+
+
+LARK = LarkBackend()
+
+
+def compile_grammar(
+    generation_sequence: Sequence[GenerationSequenceElement],
+    prefill: bool = False,
+    backend: GrammarBackend = LARK,
+) -> str:
+    """Lower, optimize, emit and validate the grammar for a generation sequence.
+
+    Args:
+        generation_sequence: a sequence of elements that influence model output
+        prefill: leave out the fixed start of the sequence, see `prefill_text`
+        backend: the grammar syntax to emit
+    """
+    nodes = optimize(lower(generation_sequence))
+    if prefill:
+        _, nodes = split_prefix(nodes)
+    validate_nodes(nodes)
+    grammar = backend.emit(nodes)
+    backend.validate(grammar, nodes)
+    return grammar
+
+
+def prefill_text(generation_sequence: Sequence[GenerationSequenceElement]) -> str:
+    """The fixed start of a generation sequence: leading anchors, special tokens and newlines."""
+    prefix, _ = split_prefix(optimize(lower(generation_sequence)))
+    return prefix
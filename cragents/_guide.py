@@ -0,0 +1,186 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+import hashlib
+import json
+import os
+from collections.abc import Mapping, Sequence
+from types import MappingProxyType
+from typing import Any
+
+from ._backends import get_grammar_backend
+from ._cache import deserialize_element, serialize_element
+from ._grammar import LARK, GrammarBackend, prefill_text
+from ._types import GenerationSequenceElement, GrammarBudget, JsonSchema, UseTools
+from ._utils import build_guided_grammar, grammar_stats, guided_extra_body
+from ._version import __version__
+
+GUIDE_FORMAT = "cragents.guide"
+GUIDE_FORMAT_VERSION = 1
+
+
+@dataclasses.dataclass(frozen=True, eq=False)
+class CompiledGuide:
+    """A guide with its grammar already built, ready to be used by any agent or saved to disk.
+
+    Guides are compared and hashed by `hash`, the SHA-256 of the grammar.
+
+    Args:
+        generation_sequence: the generation sequence with tool schemas resolved
+        grammar: grammar text sent to the inference server
+        hash: SHA-256 hex digest of the grammar, and of the prefill if there is one
+        metadata: information about how the guide was built, such as grammar size, cragents version, prefill and
+            grammar backend
+    """
+
+    generation_sequence: tuple[GenerationSequenceElement, ...]
+    grammar: str
+    hash: str
+    metadata: Mapping[str, Any]
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CompiledGuide):
+            return NotImplemented
+        return self.hash == other.hash
+
+    def __hash__(self) -> int:
+        return hash(self.hash)
+
+    @property
+    def extra_body(self) -> JsonSchema:
+        """Request `extra_body` for the guide, a new dict on every access."""
+        return guided_extra_body(self.grammar, self.prefill, self.backend)
+
+    @property
+    def prefill(self) -> str | None:
+        """Fixed start of the guide that is sent as an assistant prefill instead of being in the grammar."""
+        return self.metadata.get("prefill")
+
+    @property
+    def backend(self) -> GrammarBackend:
+        """The grammar backend the guide was compiled for."""
+        return get_grammar_backend(self.metadata.get("backend", LARK.name))
+
+    def to_dict(self) -> dict[str, Any]:
+        """Convert to JSON serializable data."""
+        return {
+            "format": GUIDE_FORMAT,
+            "format_version": GUIDE_FORMAT_VERSION,
+            "hash": self.hash,
+            "grammar": self.grammar,
+            "generation_sequence": [serialize_element(element) for element in self.generation_sequence],
+            "metadata": dict(self.metadata),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> "CompiledGuide":
+        """Inverse of `to_dict`, the grammar is checked against the stored hash."""
+        if data.get("format") != GUIDE_FORMAT or data.get("format_version") != GUIDE_FORMAT_VERSION:
+            raise ValueError(f"Not a {GUIDE_FORMAT} v{GUIDE_FORMAT_VERSION} document.")
+        grammar = data["grammar"]
+        metadata = data["metadata"]
+        if hash_grammar(grammar, metadata.get("prefill"), metadata.get("backend", LARK.name)) != data["hash"]:
+            raise ValueError("Compiled guide grammar does not match its hash.")
+        return cls(
+            generation_sequence=tuple(deserialize_element(element) for element in data["generation_sequence"]),
+            grammar=grammar,
+            hash=data["hash"],
+            metadata=MappingProxyType(dict(data["metadata"])),
+        )
+
+
+Guide = Sequence[GenerationSequenceElement] | CompiledGuide
+
+
+def hash_grammar(grammar: str, prefill: str | None = None, backend: str = LARK.name) -> str:
+    digest = hashlib.sha256(grammar.encode())
+    if prefill:
+        digest.update(b"\0" + prefill.encode())
+    if backend != LARK.name:
+        # the same grammar text is sent differently to each server
+        digest.update(b"\0backend:" + backend.encode())
+    return digest.hexdigest()
+
+
+def check_resolved(generation_sequence: Sequence[GenerationSequenceElement]) -> None:
+    for element in generation_sequence:
+        if isinstance(element, UseTools) and element.json_schema is None and element.tools is None:
+            raise ValueError("UseTools json_schema is required, use CRAgent.compile_guide to resolve it from tools.")
+
+
+def compile_guide(
+    generation_sequence: Sequence[GenerationSequenceElement],
+    minimize: bool = False,
+    budget: GrammarBudget | None = None,
+    prefill: bool = False,
+    backend: GrammarBackend = LARK,
+) -> CompiledGuide:
+    """Build the grammar for a generation sequence once, so it can be reused without rebuilding.
+
+    Every `UseTools` must have a `json_schema` or `tools`, use `CRAgent.compile_guide` to resolve them from an agent's
+    tools.
+
+    Args:
+        generation_sequence: a sequence of elements that influence model output
+        minimize: strip annotations from tool schemas and hoist repeated subschemas into `$defs`
+        budget: upper bounds on grammar size
+        prefill: leave the fixed start of the guide out of the grammar, to be sent as an assistant prefill
+        backend: the grammar syntax of the inference server, registered in `grammar_backends`
+    """
+    check_resolved(generation_sequence)
+    get_grammar_backend(backend.name)
+    grammar = build_guided_grammar(
+        generation_sequence, minimize=minimize, budget=budget, prefill=prefill, backend=backend
+    )
+    prefix = prefill_text(generation_sequence) if prefill else None
+    stats = grammar_stats(grammar)
+    metadata = {
+        "cragents_version": __version__,
+        "grammar_bytes": stats.size_bytes,
+        "rule_count": stats.rule_count,
+        "minimized": minimize,
+        "prefill": prefix or None,
+        "backend": backend.name,
+    }
+    return CompiledGuide(
+        generation_sequence=tuple(generation_sequence),
+        grammar=grammar,
+        hash=hash_grammar(grammar, prefix, backend.name),
+        metadata=MappingProxyType(metadata),
+    )
+
+
+def save_guides(path: str | os.PathLike[str], guides: Mapping[str, CompiledGuide]) -> None:
+    """Write named compiled guides to a JSON bundle.
+
+    Args:
+        path: file to write
+        guides: compiled guides by name
+    """
+    data = {name: guide.to_dict() for name, guide in guides.items()}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+
+
+def load_guides(path: str | os.PathLike[str]) -> dict[str, CompiledGuide]:
+    """Read named compiled guides from a JSON bundle written by `save_guides`.
+
+    Args:
+        path: file to read
+    """
+    with open(path, encoding="utf-8") as f:
+        data: dict[str, Any] = json.load(f)
+    return {name: CompiledGuide.from_dict(guide) for name, guide in data.items()}
@@ -0,0 +1,153 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import bisect
+import inspect
+import re
+import time
+import warnings
+from collections.abc import AsyncGenerator, Awaitable, Callable, Sequence
+from contextlib import asynccontextmanager
+
+import anyio
+import httpx
+
+from ._guide import Guide
+
+LoadSignal = Callable[[], float | Awaitable[float]]
+
+_SAMPLE = re.compile(r"([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{.*\})?\s+(\S+)")
+
+
+class GuideLadder:
+    """Guides from the most to the least reasoning, one is picked for each run from the current load.
+
+    Set `CRAgent.guide_ladder` to pick a rung for every run of `run_stream_segments` and `run_batch` that has no
+    explicit guide, or use `rung` directly.
+
+    Args:
+        rungs: guides ordered from the one used under low load, such as a full `Think` with `Free`,
+            to the lightest, such as tight `Constrain` bounds or no `Think` at all
+        thresholds: load at which each following rung starts, one fewer than `rungs` and increasing
+        load: returns the current load, can be async, defaults to the number of runs in flight on the ladder
+    """
+
+    def __init__(self, rungs: Sequence[Guide], thresholds: Sequence[float], load: LoadSignal | None = None) -> None:
+        if not rungs:
+            raise ValueError("At least one rung is required.")
+        if len(thresholds) != len(rungs) - 1:
+            raise ValueError("thresholds must have one fewer item than rungs.")
+        if any(low > high for low, high in zip(thresholds, thresholds[1:])):
+            raise ValueError("thresholds must be increasing.")
+        self.rungs = list(rungs)
+        self.thresholds = list(thresholds)
+        self.load = load
+        self.in_flight = 0
+        self.selections = [0] * len(self.rungs)
+
+    async def current_load(self) -> float:
+        if self.load is None:
+            return self.in_flight
+        load = self.load()
+        if inspect.isawaitable(load):
+            load = await load
+        return float(load)
+
+    async def select(self) -> int:
+        """Index of the rung for the current load."""
+        return bisect.bisect_right(self.thresholds, await self.current_load())
+
+    @asynccontextmanager
+    async def rung(self) -> AsyncGenerator[Guide]:
+        """Pick the guide for a run, the run counts as in flight until the context exits."""
+        index = await self.select()
+        self.selections[index] += 1
+        self.in_flight += 1
+        try:
+            yield self.rungs[index]
+        finally:
+            self.in_flight -= 1
+
+
+class VLLMMetricsLoad:
+    """Load signal read from the Prometheus metrics of a vLLM server, by default the number of waiting requests.
+
+    Scrapes are reused for `max_age` seconds, so the server is not read on every run. When a scrape fails,
+    a warning is emitted and the last value is used. Without `client`, one is created on the first scrape and
+    closed by `aclose()` or when leaving `async with`. A client that is passed in is left for the caller to close.
+
+    Args:
+        url: metrics endpoint, such as "http://localhost:8000/metrics"
+        metrics: names of the metrics to add up, samples with any labels are included
+        max_age: seconds a scrape is reused
+        client: HTTP client for the scrapes, for example one with a stub transport
+    """
+
+    def __init__(
+        self,
+        url: str,
+        metrics: Sequence[str] = ("vllm:num_requests_waiting",),
+        max_age: float = 1.0,
+        client: httpx.AsyncClient | None = None,
+    ) -> None:
+        self.url = url
+        self.metrics = frozenset(metrics)
+        self.max_age = max_age
+        self.client = client
+        self._owns_client = client is None
+        self._value = 0.0
+        self._scraped_at: float | None = None
+        self._lock = anyio.Lock()
+
+    async def aclose(self) -> None:
+        """Close the HTTP client created for the scrapes, a later scrape creates a new one."""
+        if self._owns_client and self.client is not None:
+            client, self.client = self.client, None
+            await client.aclose()
+
+    async def __aenter__(self) -> "VLLMMetricsLoad":
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        await self.aclose()
+
+    def parse(self, text: str) -> float:
+        """Add up the samples of `metrics` in a Prometheus text exposition."""
+        total = 0.0
+        for line in text.splitlines():
+            if (match := _SAMPLE.match(line)) is not None and match.group(1) in self.metrics:
+                total += float(match.group(2))
+        return total
+
+    def _fresh(self) -> bool:
+        return self._scraped_at is not None and time.monotonic() - self._scraped_at < self.max_age
+
+    async def __call__(self) -> float:
+        if self._fresh():
+            return self._value
+        async with self._lock:
+            # another run may have scraped while this one waited
+            if self._fresh():
+                return self._value
+            if self.client is None:
+                self.client = httpx.AsyncClient()
+            try:
+                response = await self.client.get(self.url)
+                response.raise_for_status()
+                self._value = self.parse(response.text)
+            except httpx.HTTPError as e:
+                warnings.warn(f"Failed to read vLLM metrics, using the last value: {e}", stacklevel=2)
+            self._scraped_at = time.monotonic()
+        return self._value
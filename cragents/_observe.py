@@ -0,0 +1,116 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+
+from ._stream import GuideSegment, SegmentKind
+from ._types import GrammarStats
+
+
+@dataclasses.dataclass
+class BuildTimings:
+    """Time spent in each phase of a guide build so far."""
+
+    toolsets_seconds: float = 0.0
+    schema_seconds: float = 0.0
+
+
+@dataclasses.dataclass(frozen=True)
+class GuideBuildMetrics:
+    """Timings and size of a guide build.
+
+    Args:
+        toolsets_seconds: time spent resolving tools from toolsets
+        schema_seconds: time spent building the tools and output JSON schema
+        grammar_seconds: time spent building the grammar, or looking it up in the cache
+        grammar: size of the grammar
+        cache_hit: whether the grammar came from the cache, `None` when no cache was used
+    """
+
+    toolsets_seconds: float
+    schema_seconds: float
+    grammar_seconds: float
+    grammar: GrammarStats
+    cache_hit: bool | None
+
+    @property
+    def total_seconds(self) -> float:
+        return self.toolsets_seconds + self.schema_seconds + self.grammar_seconds
+
+
+@dataclasses.dataclass(frozen=True)
+class SegmentMetrics:
+    """Measured length of a guided segment, the text itself is not kept.
+
+    Args:
+        kind: the kind of element that generated the segment
+        index: position of the element in the generation sequence
+        think_index: position of the element inside `Think`, if it is inside `Think`
+        chars: length of the segment text
+        paragraphs: paragraphs generated for a `Constrain`, 0 for other kinds
+    """
+
+    kind: SegmentKind
+    index: int
+    think_index: int | None
+    chars: int
+    paragraphs: int
+
+    @classmethod
+    def from_segment(cls, segment: GuideSegment) -> "SegmentMetrics":
+        paragraphs = segment.text.count("\n\n") if segment.kind == "constrain" else 0
+        return cls(segment.kind, segment.index, segment.think_index, len(segment.text), paragraphs)
+
+
+@dataclasses.dataclass(frozen=True)
+class GuideRunMetrics:
+    """Measurements of a guided `run_stream_segments` run.
+
+    Args:
+        build: metrics of the build of the guide used by the run, `None` when unknown
+        responses: number of model responses in the run
+        segments: segments of every model response, in order
+        duration_seconds: wall time of the run
+    """
+
+    build: GuideBuildMetrics | None
+    responses: int
+    segments: tuple[SegmentMetrics, ...]
+    duration_seconds: float
+
+    @property
+    def thinking_chars(self) -> int:
+        return sum(segment.chars for segment in self.segments if segment.kind == "think")
+
+    @property
+    def constrain_paragraphs(self) -> int:
+        return sum(segment.paragraphs for segment in self.segments)
+
+
+class GuideObserver:
+    """Receives guide metrics, override the methods for the metrics you need.
+
+    Add observers to `CRAgent.observers`. Methods are called inline, so they should return quickly.
+    """
+
+    def guide_built(self, metrics: GuideBuildMetrics) -> None:
+        """Called when a guide is built by `set_guide`, `guide_settings`, `build_guide` or a guided run."""
+
+    def run_finished(self, metrics: GuideRunMetrics) -> None:
+        """Called when a run of `run_stream_segments` finishes without an error.
+
+        Only `run_stream_segments` parses output against the guide, `run`, `run_stream` and `run_batch` do not
+        report run metrics.
+        """
@@ -0,0 +1,133 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import copy
+import dataclasses
+import re
+from collections.abc import AsyncGenerator, AsyncIterable, AsyncIterator
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, cast
+
+from openai.types import chat
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
+from pydantic_ai import ModelMessage, ModelResponse, RunContext, TextPart
+from pydantic_ai.models import ModelRequestParameters, StreamedResponse
+from pydantic_ai.models.openai import OpenAIChatModel, OpenAIStreamedResponse
+from pydantic_ai.settings import ModelSettings
+
+# `extra_body` key holding the prefill, removed before the request is sent
+PREFILL_KEY = "cragents_prefill"
+
+_response_prefill: ContextVar[str | None] = ContextVar("cragents_response_prefill", default=None)
+
+
+def _take_prefill(model_settings: ModelSettings | None) -> tuple[ModelSettings | None, str | None]:
+    extra_body = model_settings.get("extra_body") if model_settings else None
+    if model_settings is None or not isinstance(extra_body, dict) or PREFILL_KEY not in extra_body:
+        return model_settings, None
+    extra_body = copy.copy(cast(dict[str, Any], extra_body))
+    prefill = extra_body.pop(PREFILL_KEY)
+    model_settings = copy.copy(model_settings)
+    model_settings["extra_body"] = extra_body
+    return model_settings, prefill
+
+
+def _with_prefill(messages: list[ModelMessage], prefill: str) -> list[ModelMessage]:
+    return [*messages, ModelResponse(parts=[TextPart(prefill)])]
+
+
+@dataclasses.dataclass
+class _PrefilledStreamedResponse(OpenAIStreamedResponse):
+    # set by `PrefillChatModel.request_stream`, streamed before the chunks of the server
+    prefill: str = dataclasses.field(default="", init=False)
+
+    def _validate_response(self) -> AsyncIterable[ChatCompletionChunk]:
+        return self._prefilled_response()
+
+    async def _prefilled_response(self) -> AsyncIterator[ChatCompletionChunk]:
+        # thinking tags are only recognized as whole deltas
+        thinking_tags = self._model_profile.thinking_tags
+        for content in filter(None, re.split(f"({'|'.join(map(re.escape, thinking_tags))})", self.prefill)):
+            yield ChatCompletionChunk(
+                id="",
+                choices=[ChunkChoice(index=0, delta=ChoiceDelta(content=content))],
+                created=0,
+                model="",
+                object="chat.completion.chunk",
+            )
+        async for chunk in super()._validate_response():
+            yield chunk
+
+
+class PrefillChatModel(OpenAIChatModel):
+    """OpenAI chat model that sends the fixed start of a guide as an assistant prefill.
+
+    With `CRAgent.prefill_guide_prefix`, leading anchors and special tokens of the guide are left out of the
+    grammar and sent as the start of the assistant message instead. The inference server continues that message,
+    so its prefix cache reuses the prefill across requests, and the model does not generate the forced tokens.
+    The prefill is added back to the response, so thinking parts and segments look as if it was generated.
+
+    pydantic-ai has no public hook for this, so the model overrides the private `_process_response` and
+    `_streamed_response_cls` of `OpenAIChatModel`, and its streamed response overrides `_validate_response` and
+    reads `_model_profile`. They can change in any pydantic-ai release, so the supported versions are bounded.
+    """
+
+    async def request(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+    ) -> ModelResponse:
+        model_settings, prefill = _take_prefill(model_settings)
+        if prefill is None:
+            return await super().request(messages, model_settings, model_request_parameters)
+        token = _response_prefill.set(prefill)
+        try:
+            return await super().request(_with_prefill(messages, prefill), model_settings, model_request_parameters)
+        finally:
+            _response_prefill.reset(token)
+
+    @asynccontextmanager
+    async def request_stream(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+        run_context: RunContext[Any] | None = None,
+    ) -> AsyncGenerator[StreamedResponse]:
+        model_settings, prefill = _take_prefill(model_settings)
+        if prefill is not None:
+            messages = _with_prefill(messages, prefill)
+        async with super().request_stream(
+            messages, model_settings, model_request_parameters, run_context
+        ) as response_stream:
+            if prefill is not None and isinstance(response_stream, _PrefilledStreamedResponse):
+                # events are produced lazily, so the prefill is in place before the first one
+                response_stream.prefill = prefill
+            yield response_stream
+
+    def _process_response(self, response: chat.ChatCompletion | str) -> ModelResponse:
+        prefill = _response_prefill.get()
+        if prefill is not None and not isinstance(response, str) and response.choices:
+            message = response.choices[0].message
+            message.content = prefill + (message.content or "")
+        return super()._process_response(response)
+
+    @property
+    def _streamed_response_cls(self) -> type[OpenAIStreamedResponse]:
+        return _PrefilledStreamedResponse
@@ -0,0 +1,241 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import itertools
+import json
+import re
+from collections.abc import AsyncIterator, Callable, Iterable, Iterator, Sequence
+
+import anyio
+import httpx
+
+from ._check import GuideChecker
+from ._grammar import LARK, GrammarBackend, Token, compile_grammar
+from ._guide import CompiledGuide, Guide
+from ._types import JsonSchema
+
+
+class _EventStream(httpx.AsyncByteStream):
+    def __init__(self, events: AsyncIterator[bytes]) -> None:
+        self._events = events
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for event in self._events:
+            yield event
+
+
+def _error(message: str) -> httpx.Response:
+    return httpx.Response(400, json={"object": "error", "message": message, "type": "BadRequestError", "code": 400})
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """In-process stand-in for an OpenAI-compatible inference server, replays outputs that follow the guide.
+
+    Give it to the `httpx.AsyncClient` of the model's OpenAI client to run agents end to end without a GPU.
+    The request grammar picks the registered guide, the output is checked against it with `GuideChecker` and
+    rejected with a 400 response when it does not match, the way a server would never produce it.
+    Tool calls are returned as `tool_calls`, like the vLLM hermes tool parser, outputs are cut at `max_tokens`,
+    and streams are sent one token at a time with the configured latency, to load test concurrency, streaming
+    and parsing.
+
+    Args:
+        outputs: raw completions with special tokens as text, replayed in turn and starting over after the last
+            one, or a function of the request body that returns the completion
+        guides: guides the requests are built from, compiled guides or generation sequences with tool schemas
+        backend: the grammar backend the requests are built for
+        time_to_first_token: seconds before the first token of a response
+        token_latency: seconds between tokens
+        chars_per_token: characters of output per token
+        tool_call_tokens: start and stop tokens of tool calls in the output
+
+    Attributes:
+        requests: bodies of the chat completion requests received
+    """
+
+    def __init__(
+        self,
+        outputs: Sequence[str] | Callable[[JsonSchema], str],
+        guides: Iterable[Guide] = (),
+        backend: GrammarBackend = LARK,
+        time_to_first_token: float = 0.0,
+        token_latency: float = 0.0,
+        chars_per_token: int = 4,
+        tool_call_tokens: tuple[str, str] = ("<tool_call>", "</tool_call>"),
+    ) -> None:
+        if chars_per_token < 1:
+            raise ValueError("chars_per_token must be at least 1.")
+        if not callable(outputs) and not outputs:
+            raise ValueError("At least one output is required.")
+        self._outputs = outputs if callable(outputs) else itertools.cycle(outputs)
+        self.backend = backend
+        self.time_to_first_token = time_to_first_token
+        self.token_latency = token_latency
+        self.chars_per_token = chars_per_token
+        start, stop = tool_call_tokens
+        self._tool_call = re.compile(rf"{re.escape(start)}\s*(.*?)\s*{re.escape(stop)}", re.DOTALL)
+        self._checkers: dict[str, GuideChecker] = {}
+        self.requests: list[JsonSchema] = []
+        for guide in guides:
+            self.add_guide(guide)
+
+    def add_guide(self, guide: Guide) -> None:
+        """Accept requests built from this guide, with or without the prefill."""
+        if isinstance(guide, CompiledGuide):
+            if guide.backend.name != self.backend.name:
+                raise ValueError(f"Guide was compiled for the {guide.backend.name!r} grammar backend.")
+            self._checkers[guide.grammar] = GuideChecker(guide)
+            return
+        checker = GuideChecker(guide)
+        for prefill in (False, True):
+            self._checkers[compile_grammar(guide, prefill, self.backend)] = checker
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method != "POST" or not request.url.path.endswith("/chat/completions"):
+            return httpx.Response(404, json={"object": "error", "message": "Not Found", "code": 404})
+        body: JsonSchema = json.loads(await request.aread())
+        self.requests.append(body)
+        try:
+            text, special_tokens = self._complete(body)
+        except ValueError as e:
+            return _error(str(e))
+
+        max_tokens = body.get("max_completion_tokens", body.get("max_tokens"))
+        chunks = list(self._chunks(text, special_tokens))
+        if max_tokens is not None and len(chunks) > max_tokens:
+            # the server stops mid output and returns the raw text
+            content, tool_calls, finish_reason = "".join(chunks[:max_tokens]), [], "length"
+        else:
+            try:
+                content, tool_calls = self._parse(text)
+            except ValueError as e:
+                return _error(str(e))
+            finish_reason = _finish_reason(tool_calls)
+        deltas = self._deltas(content, tool_calls, special_tokens)
+        if body.get("stream"):
+            return httpx.Response(
+                200,
+                headers={"content-type": "text/event-stream"},
+                stream=_EventStream(self._stream(body, deltas, finish_reason)),
+            )
+        tokens = len(deltas)
+        await anyio.sleep(self.time_to_first_token + self.token_latency * max(tokens - 1, 0))
+        message: JsonSchema = {"role": "assistant", "content": content or None}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        return httpx.Response(
+            200,
+            json={
+                **self._header(body, "chat.completion"),
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+                "usage": _usage(tokens),
+            },
+        )
+
+    def _complete(self, body: JsonSchema) -> tuple[str, list[str]]:
+        """The output for a request, along with the special tokens of its guide."""
+        text = self._outputs(body) if callable(self._outputs) else next(self._outputs)
+        try:
+            grammar = self.backend.request_grammar(body)
+        except (KeyError, TypeError):
+            return text, []
+        if (checker := self._checkers.get(grammar)) is None:
+            raise ValueError("The request grammar is not from a registered guide.")
+        # the server continues a final assistant message, which holds the prefill
+        messages: list[JsonSchema] = body.get("messages", [])
+        prefill = ""
+        if messages and messages[-1].get("role") == "assistant":
+            prefill = messages[-1].get("content") or ""
+        try:
+            checker.check(prefill + text)
+        except ValueError as e:
+            raise ValueError(f"Replayed output can not be generated with the request grammar. {e}") from e
+        return text, [node.token for node in checker.nodes if isinstance(node, Token)]
+
+    def _parse(self, text: str) -> tuple[str, list[JsonSchema]]:
+        """Content and tool calls of an output.
+
+        Raises:
+            ValueError: when a tool call is not a JSON object with a name and arguments, which the grammar
+                rules out but an output replayed without one can still contain
+        """
+        tool_calls: list[JsonSchema] = []
+        for index, match in enumerate(self._tool_call.finditer(text)):
+            try:
+                call = json.loads(match.group(1))
+                name, arguments = call["name"], json.dumps(call["arguments"], ensure_ascii=False)
+            except (ValueError, KeyError, TypeError) as e:
+                raise ValueError(f"Tool call {match.group(1)!r} is not a JSON object with a name and arguments.") from e
+            tool_calls.append(
+                {
+                    "index": index,
+                    "id": f"call_{index}",
+                    "type": "function",
+                    "function": {"name": name, "arguments": arguments},
+                }
+            )
+        return self._tool_call.sub("", text), tool_calls
+
+    def _chunks(self, text: str, special_tokens: Sequence[str] = ()) -> Iterator[str]:
+        """Split text into tokens, special tokens are streamed whole like the server does."""
+        parts = [text]
+        if special_tokens:
+            parts = re.split(f"({'|'.join(map(re.escape, sorted(set(special_tokens), key=len, reverse=True)))})", text)
+        for part in filter(None, parts):
+            if part in special_tokens:
+                yield part
+                continue
+            for start in range(0, len(part), self.chars_per_token):
+                yield part[start : start + self.chars_per_token]
+
+    def _deltas(self, content: str, tool_calls: list[JsonSchema], special_tokens: Sequence[str]) -> list[JsonSchema]:
+        """Stream deltas of a response, one per token."""
+        deltas: list[JsonSchema] = [{"content": chunk} for chunk in self._chunks(content, special_tokens)]
+        for tool_call in tool_calls:
+            # the name comes first, then the arguments a token at a time
+            function = tool_call["function"]
+            deltas.append({"tool_calls": [{**tool_call, "function": {"name": function["name"], "arguments": ""}}]})
+            deltas.extend(
+                {"tool_calls": [{"index": tool_call["index"], "function": {"arguments": chunk}}]}
+                for chunk in self._chunks(function["arguments"])
+            )
+        return deltas
+
+    async def _stream(self, body: JsonSchema, deltas: list[JsonSchema], finish_reason: str) -> AsyncIterator[bytes]:
+        header = self._header(body, "chat.completion.chunk")
+
+        def event(delta: JsonSchema, finish_reason: str | None = None) -> bytes:
+            choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+            return f"data: {json.dumps({**header, 'choices': [choice]})}\n\n".encode()
+
+        await anyio.sleep(self.time_to_first_token)
+        for index, delta in enumerate(deltas):
+            if index:
+                await anyio.sleep(self.token_latency)
+            yield event({"role": "assistant", **delta} if index == 0 else delta)
+        yield event({}, finish_reason)
+        if body.get("stream_options", {}).get("include_usage"):
+            yield f"data: {json.dumps({**header, 'choices': [], 'usage': _usage(len(deltas))})}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+    def _header(self, body: JsonSchema, kind: str) -> JsonSchema:
+        return {"id": f"replay-{len(self.requests)}", "object": kind, "created": 0, "model": body.get("model", "")}
+
+
+def _finish_reason(tool_calls: list[JsonSchema]) -> str:
+    return "tool_calls" if tool_calls else "stop"
+
+
+def _usage(tokens: int) -> JsonSchema:
+    return {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens}
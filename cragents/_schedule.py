@@ -0,0 +1,110 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import copy
+from collections.abc import AsyncGenerator, Callable, Sequence
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, Any, cast
+
+from pydantic_ai import ModelMessage, ModelResponse, RunContext
+from pydantic_ai.models import Model, ModelRequestParameters, StreamedResponse
+from pydantic_ai.models.openai import OpenAIChatModelSettings
+from pydantic_ai.models.wrapper import WrapperModel
+from pydantic_ai.settings import ModelSettings
+
+from ._guide import CompiledGuide, Guide
+from ._types import GenerationSequenceElement
+
+if TYPE_CHECKING:
+    from . import CRAgent
+
+
+class GuideSchedule:
+    """A guide for each model request of a run, so follow-up requests after tool calls can be guided differently.
+
+    For example a long `Think` on the first request, short ones after tool results, then a final answer without
+    `UseTools`. Pass it as the `guide` of `CRAgent.run_stream_segments` or `CRAgent.run_batch`, or run the agent
+    with `CRAgent.scheduled_model`.
+
+    Args:
+        guides: guide of each step, the last one is used for every later step, `None` sends a request without a
+            guide; or a function of the step index and the messages of the request that returns the guide
+    """
+
+    def __init__(
+        self,
+        guides: Sequence[Guide | None] | Callable[[int, Sequence[ModelMessage]], Guide | None],
+    ) -> None:
+        if not callable(guides) and not guides:
+            raise ValueError("At least one guide is required.")
+        self.guides = guides
+
+    def guide(self, step: int, messages: Sequence[ModelMessage]) -> Guide | None:
+        """Guide of a model request, `step` counts the requests of the run from 0."""
+        if callable(self.guides):
+            return self.guides(step, messages)
+        return self.guides[min(step, len(self.guides) - 1)]
+
+
+class ScheduledModel(WrapperModel):
+    """Model that guides each request of a run with the guide the schedule gives for it, see `GuideSchedule`.
+
+    Steps are counted per instance, use a new one for each run with `CRAgent.scheduled_model`.
+
+    Attributes:
+        sequences: generation sequence of each request made so far, `None` for requests without a guide
+    """
+
+    def __init__(self, wrapped: Model, agent: "CRAgent[Any, Any]", schedule: GuideSchedule, deps: Any = None) -> None:
+        super().__init__(wrapped)
+        self.agent = agent
+        self.schedule = schedule
+        self.deps = deps
+        self.sequences: list[Sequence[GenerationSequenceElement] | None] = []
+
+    async def _step_settings(self, messages: list[ModelMessage], model_settings: ModelSettings | None) -> ModelSettings:
+        guide = self.schedule.guide(len(self.sequences), messages)
+        if guide is None:
+            self.sequences.append(None)
+            # the guide of the agent or the run does not apply to this request either
+            settings = cast(ModelSettings, copy.copy(model_settings or {}))
+            settings.pop("extra_body", None)
+            return settings
+        settings = await self.agent.guide_settings(
+            guide, self.deps, cast(OpenAIChatModelSettings | None, model_settings)
+        )
+        self.sequences.append(guide.generation_sequence if isinstance(guide, CompiledGuide) else list(guide))
+        return settings
+
+    async def request(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+    ) -> ModelResponse:
+        settings = await self._step_settings(messages, model_settings)
+        return await super().request(messages, settings, model_request_parameters)
+
+    @asynccontextmanager
+    async def request_stream(
+        self,
+        messages: list[ModelMessage],
+        model_settings: ModelSettings | None,
+        model_request_parameters: ModelRequestParameters,
+        run_context: RunContext[Any] | None = None,
+    ) -> AsyncGenerator[StreamedResponse]:
+        settings = await self._step_settings(messages, model_settings)
+        async with super().request_stream(messages, settings, model_request_parameters, run_context) as stream:
+            yield stream
@@ -0,0 +1,247 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+from collections.abc import Callable, Mapping
+from typing import Any, TypeGuard, cast
+
+from ._types import JsonSchema
+
+# keywords that document a schema without constraining the values it accepts
+ANNOTATION_KEYWORDS = frozenset(
+    ["title", "description", "examples", "default", "$comment", "deprecated", "readOnly", "writeOnly"]
+)
+# keywords whose value is a mapping of names to subschemas
+SUBSCHEMA_MAP_KEYWORDS = frozenset(["properties", "patternProperties", "$defs", "definitions", "dependentSchemas"])
+# keywords whose value is a list of subschemas
+SUBSCHEMA_LIST_KEYWORDS = frozenset(["anyOf", "allOf", "oneOf", "prefixItems"])
+# keywords whose value is a single subschema (or a list of them for legacy `items`)
+SUBSCHEMA_KEYWORDS = frozenset(
+    [
+        "items",
+        "additionalItems",
+        "additionalProperties",
+        "contains",
+        "else",
+        "if",
+        "not",
+        "propertyNames",
+        "then",
+        "unevaluatedItems",
+        "unevaluatedProperties",
+    ]
+)
+# a hoisted subschema is replaced by a `$ref`, so small subschemas are left inline
+MIN_HOISTED_SIZE = 64
+
+
+def is_schema(value: Any) -> TypeGuard[JsonSchema]:
+    return isinstance(value, dict)
+
+
+def is_schema_list(value: Any) -> TypeGuard[list[Any]]:
+    return isinstance(value, list)
+
+
+def map_subschemas(schema: JsonSchema, func: Callable[[Any], Any]) -> JsonSchema:
+    """Return a copy of the schema with `func` applied to each direct subschema."""
+    result: JsonSchema = {}
+    for key, value in schema.items():
+        if key in SUBSCHEMA_MAP_KEYWORDS and is_schema(value):
+            result[key] = {name: func(subschema) for name, subschema in value.items()}
+        elif key in SUBSCHEMA_LIST_KEYWORDS | SUBSCHEMA_KEYWORDS and is_schema_list(value):
+            result[key] = [func(subschema) for subschema in value]
+        elif key in SUBSCHEMA_KEYWORDS and is_schema(value):
+            result[key] = func(value)
+        else:
+            result[key] = value
+    return result
+
+
+def strip_annotations(schema: Any) -> Any:
+    """Remove keywords that do not constrain generation, property names are left untouched."""
+    if not is_schema(schema):
+        return schema
+    stripped = {key: value for key, value in schema.items() if key not in ANNOTATION_KEYWORDS}
+    return map_subschemas(stripped, strip_annotations)
+
+
+def resolve_ref(ref: str, root: Any) -> Any:
+    if not ref.startswith("#"):
+        raise ValueError(f"Unsupported $ref {ref!r}, only references inside the schema are supported.")
+    target: Any = root
+    for key in ref[1:].split("/")[1:]:
+        key = key.replace("~1", "/").replace("~0", "~")
+        if isinstance(target, dict) and key in target:
+            target = cast(dict[str, Any], target)[key]
+        elif isinstance(target, list) and key.isdigit() and int(key) < len(items := cast(list[Any], target)):
+            target = items[int(key)]
+        else:
+            raise ValueError(f"Unresolvable $ref {ref!r}.")
+    return target
+
+
+def _canonical(schema: JsonSchema) -> str:
+    return json.dumps(schema, sort_keys=True, separators=(",", ":"))
+
+
+def hoist_duplicate_subschemas(schema: JsonSchema) -> JsonSchema:
+    """Move subschemas that occur more than once into root `$defs` and reference them with `$ref`."""
+    counts: dict[str, int] = {}
+
+    def count(subschema: Any) -> Any:
+        if is_schema(subschema):
+            key = _canonical(subschema)
+            counts[key] = counts.get(key, 0) + 1
+            # children of a repeated subschema were already counted the first time it was seen
+            if counts[key] == 1:
+                map_subschemas(subschema, count)
+        return subschema
+
+    map_subschemas(schema, count)
+
+    defs: dict[str, JsonSchema] = dict(schema.get("$defs", {}))
+    names: dict[str, str] = {}
+    for key, occurrences in counts.items():
+        if occurrences > 1 and len(key) >= MIN_HOISTED_SIZE and '"$defs"' not in key:
+            name = f"shared_{len(names) + 1}"
+            while name in defs:
+                name += "_"
+            names[key] = name
+    if not names:
+        return schema
+
+    def replace(subschema: Any) -> Any:
+        if not is_schema(subschema):
+            return subschema
+        key = _canonical(subschema)
+        if (name := names.get(key)) is not None:
+            if name not in defs:
+                defs[name] = map_subschemas(subschema, replace)
+            return {"$ref": f"#/$defs/{name}"}
+        return map_subschemas(subschema, replace)
+
+    root = map_subschemas({key: value for key, value in schema.items() if key != "$defs"}, replace)
+    for name, subschema in schema.get("$defs", {}).items():
+        defs[name] = map_subschemas(subschema, replace)
+    root["$defs"] = defs
+    return root
+
+
+def minimize_json_schema(schema: JsonSchema) -> JsonSchema:
+    """Shrink a schema without changing what it accepts.
+
+    Annotation keywords such as titles, descriptions and examples are removed,
+    then identical subschemas are hoisted into `$defs`.
+    """
+    return hoist_duplicate_subschemas(strip_annotations(schema))
+
+
+DEFS_REF = "#/$defs/"
+
+
+def _def_name(ref: str) -> str | None:
+    name = ref.removeprefix(DEFS_REF)
+    if name == ref or "/" in name:
+        return None
+    return name.replace("~1", "/").replace("~0", "~")
+
+
+def _def_ref(name: str) -> str:
+    return DEFS_REF + name.replace("~", "~0").replace("/", "~1")
+
+
+def ref_names(schema: Any, names: set[str | None]) -> set[str | None]:
+    """Names of the `$defs` a schema references, `None` for references elsewhere, added to `names`."""
+
+    def visit(subschema: Any) -> Any:
+        if is_schema(subschema):
+            if isinstance(ref := subschema.get("$ref"), str):
+                names.add(_def_name(ref))
+            map_subschemas(subschema, visit)
+        return subschema
+
+    visit(schema)
+    return names
+
+
+def _rename_refs(schema: Any, renames: dict[str, str]) -> Any:
+    if not is_schema(schema):
+        return schema
+    renamed = map_subschemas(schema, lambda subschema: _rename_refs(subschema, renames))
+    if isinstance(ref := schema.get("$ref"), str) and (name := _def_name(ref)) in renames:
+        renamed["$ref"] = _def_ref(renames[name])
+    return renamed
+
+
+def _reachable_defs(schema: JsonSchema, defs: dict[str, JsonSchema]) -> dict[str, JsonSchema]:
+    pending = ref_names(schema, set())
+    reachable: set[str] = set()
+    while pending:
+        name = pending.pop()
+        if name is not None and name not in reachable and name in defs:
+            reachable.add(name)
+            ref_names(defs[name], pending)
+    return {name: subschema for name, subschema in defs.items() if name in reachable}
+
+
+def merge_schema_defs(schemas: Mapping[str, JsonSchema]) -> dict[str, JsonSchema]:
+    """Give the `$defs` of several schemas one namespace, so equal definitions have the same name in all of them.
+
+    Definitions are compared by their canonical JSON. A definition equal to one seen before takes its name, one
+    that only shares a name is renamed, and the references to it are rewritten. Each schema keeps the definitions
+    it reaches, so it stays self-contained. Schemas that reference anything outside their own `$defs` are left
+    unchanged.
+    """
+    shared: dict[str, JsonSchema] = {}
+    shared_canonical: dict[str, str] = {}
+    canonical_names: dict[str, str] = {}
+    merged: dict[str, JsonSchema] = {}
+    for key, schema in schemas.items():
+        local: dict[str, JsonSchema] = dict(schema.get("$defs", {}))
+        if not local or not ref_names(schema, set()) <= set(local):
+            merged[key] = schema
+            continue
+        renames = {name: name for name in local}
+        # names a definition has had, so each rename moves on and the loop ends
+        tried = {name: {name} for name in local}
+        while True:
+            defs = {name: _rename_refs(subschema, renames) for name, subschema in local.items()}
+            canonical = {name: _canonical(subschema) for name, subschema in defs.items()}
+            conflicts = [
+                name for name in local if shared_canonical.get(renames[name], canonical[name]) != canonical[name]
+            ]
+            if not conflicts:
+                break
+            taken = set(shared) | set(renames.values())
+            for name in conflicts:
+                equal = canonical_names.get(canonical[name])
+                if equal is None or equal in tried[name]:
+                    count = 2
+                    while f"{name}_{count}" in taken:
+                        count += 1
+                    equal = f"{name}_{count}"
+                renames[name] = equal
+                tried[name].add(equal)
+                taken.add(equal)
+        for name, subschema in defs.items():
+            shared[renames[name]] = subschema
+            shared_canonical[renames[name]] = canonical[name]
+            canonical_names.setdefault(canonical[name], renames[name])
+        root = _rename_refs({keyword: value for keyword, value in schema.items() if keyword != "$defs"}, renames)
+        if reachable := _reachable_defs(root, shared):
+            root["$defs"] = reachable
+        merged[key] = root
+    return merged
@@ -0,0 +1,186 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+import random
+import time
+from collections.abc import Callable, Mapping, Sequence
+from typing import TYPE_CHECKING, Any, Literal
+
+from pydantic_ai import AgentRunResult
+from pydantic_ai.messages import UserContent
+from pydantic_ai.models.openai import OpenAIChatModelSettings
+
+from ._guide import Guide
+
+if TYPE_CHECKING:
+    from . import CRAgent
+
+
+@dataclasses.dataclass
+class GuideStats:
+    """Measurements of the runs of one candidate guide.
+
+    Args:
+        runs: number of finished runs
+        output_tokens: completion tokens of all runs
+        seconds: wall time of all runs
+        reported: number of runs with a reported success signal
+        successes: number of reported runs that succeeded
+    """
+
+    runs: int = 0
+    output_tokens: int = 0
+    seconds: float = 0.0
+    reported: int = 0
+    successes: int = 0
+
+    @property
+    def accuracy(self) -> float:
+        """Fraction of reported runs that succeeded, 0 before any run is reported."""
+        return self.successes / self.reported if self.reported else 0.0
+
+    @property
+    def mean_output_tokens(self) -> float:
+        return self.output_tokens / self.runs if self.runs else 0.0
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.seconds / self.runs if self.runs else 0.0
+
+
+@dataclasses.dataclass(frozen=True)
+class SelectedRun:
+    """A run of `GuideSelector.run`, pass it to `GuideSelector.report` with its success signal.
+
+    Args:
+        name: name of the guide the run used
+        result: the run result
+        seconds: wall time of the run
+        output_tokens: completion tokens of the run
+    """
+
+    name: str
+    result: AgentRunResult[Any]
+    seconds: float
+    output_tokens: int
+
+
+class GuideSelector:
+    """Route runs between candidate guides, shifting traffic to the cheapest guide that is accurate enough.
+
+    Every guide is tried until it has `min_reports` reported runs. After that, each run uses the guide with the
+    lowest mean cost among guides with accuracy of at least `accuracy_target`, or the most accurate guide when none
+    qualifies. A fraction `explore` of runs uses a random guide, so estimates keep up with changes.
+
+    Args:
+        agent: the agent that runs the guides
+        guides: candidate guides by name, for example the same sequence with different `Constrain` bounds
+        accuracy_target: lowest acceptable fraction of successful runs
+        cost: what to minimize, mean completion tokens or mean wall time
+        explore: fraction of runs that use a random guide
+        min_reports: reported runs each guide needs before its accuracy is trusted
+        evaluate: computes the success signal of a run result, otherwise call `report`
+        seed: seed for the random choices
+    """
+
+    def __init__(
+        self,
+        agent: "CRAgent[Any, Any]",
+        guides: Mapping[str, Guide],
+        accuracy_target: float = 0.9,
+        *,
+        cost: Literal["output_tokens", "seconds"] = "output_tokens",
+        explore: float = 0.1,
+        min_reports: int = 5,
+        evaluate: Callable[[AgentRunResult[Any]], bool] | None = None,
+        seed: int | None = None,
+    ) -> None:
+        if not guides:
+            raise ValueError("At least one guide is required.")
+        if not 0 <= accuracy_target <= 1:
+            raise ValueError("accuracy_target must be between 0 and 1.")
+        if not 0 <= explore <= 1:
+            raise ValueError("explore must be between 0 and 1.")
+        self.agent = agent
+        self.guides = dict(guides)
+        self.accuracy_target = accuracy_target
+        self.cost = cost
+        self.explore = explore
+        self.min_reports = min_reports
+        self.evaluate = evaluate
+        self.stats = {name: GuideStats() for name in self.guides}
+        self._random = random.Random(seed)
+
+    def _mean_cost(self, name: str) -> float:
+        stats = self.stats[name]
+        return stats.mean_output_tokens if self.cost == "output_tokens" else stats.mean_seconds
+
+    def choose(self) -> str:
+        """Name of the guide for the next run."""
+        untried = [name for name, stats in self.stats.items() if stats.reported < self.min_reports]
+        if untried:
+            return min(untried, key=lambda name: self.stats[name].runs)
+        if self._random.random() < self.explore:
+            return self._random.choice(list(self.guides))
+        qualified = [name for name, stats in self.stats.items() if stats.accuracy >= self.accuracy_target]
+        if not qualified:
+            return max(self.stats, key=lambda name: self.stats[name].accuracy)
+        return min(qualified, key=self._mean_cost)
+
+    def best(self) -> str | None:
+        """The cheapest guide that meets the accuracy target with enough reported runs, if any."""
+        qualified = [
+            name
+            for name, stats in self.stats.items()
+            if stats.reported >= self.min_reports and stats.accuracy >= self.accuracy_target
+        ]
+        return min(qualified, key=self._mean_cost) if qualified else None
+
+    async def run(
+        self,
+        user_prompt: str | Sequence[UserContent] | None = None,
+        *,
+        deps: Any = None,
+        model_settings: OpenAIChatModelSettings | None = None,
+        **kwargs: Any,
+    ) -> SelectedRun:
+        """Run the agent with the guide from `choose`, and record the run's cost.
+
+        Args:
+            user_prompt: user input to start the agent run
+            deps: dependencies for Pydantic AI dependency injection system
+            model_settings: other settings for the run, these are copied and not modified
+            **kwargs: passed to `CRAgent.run`
+        """
+        name = self.choose()
+        settings = await self.agent.guide_settings(self.guides[name], deps, model_settings)
+        start = time.perf_counter()
+        result = await self.agent.run(user_prompt, deps=deps, model_settings=settings, **kwargs)
+        selected = SelectedRun(name, result, time.perf_counter() - start, result.usage().output_tokens)
+
+        stats = self.stats[name]
+        stats.runs += 1
+        stats.output_tokens += selected.output_tokens
+        stats.seconds += selected.seconds
+        if self.evaluate is not None:
+            self.report(selected, self.evaluate(result))
+        return selected
+
+    def report(self, run: SelectedRun, success: bool) -> None:
+        """Record the success signal of a run, such as whether its answer was correct."""
+        stats = self.stats[run.name]
+        stats.reported += 1
+        stats.successes += success
@@ -0,0 +1,201 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+import json
+from contextlib import AsyncExitStack
+from typing import Any
+
+import anyio
+from anyio.abc import TaskGroup
+from pydantic import ValidationError
+from pydantic_ai import RunContext
+from pydantic_ai.messages import AgentStreamEvent, PartDeltaEvent, PartStartEvent, ToolCallPart, ToolCallPartDelta
+from pydantic_ai.toolsets import AbstractToolset, ToolsetTool, WrapperToolset
+
+
+@dataclasses.dataclass
+class _Speculation:
+    name: str
+    args: dict[str, Any]
+    done: anyio.Event = dataclasses.field(default_factory=anyio.Event)
+    result: Any = None
+    error: Exception | None = None
+
+    async def run(self, toolset: AbstractToolset[Any], ctx: RunContext[Any], tool: ToolsetTool[Any]) -> None:
+        try:
+            self.result = await toolset.call_tool(self.name, self.args, ctx, tool)
+        except Exception as e:
+            # raised again to the agent when it asks for the result
+            self.error = e
+        finally:
+            self.done.set()
+
+    async def wait(self) -> Any:
+        await self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+def _is_complete(part: ToolCallPart) -> bool:
+    if not isinstance(part.args, str):
+        return part.args is not None
+    try:
+        json.loads(part.args)
+    except json.JSONDecodeError:
+        return False
+    return True
+
+
+class ToolSpeculator:
+    """Run tool calls while the model is still generating, so the agent finds the result ready when it asks.
+
+    Calls are started from stream events with `feed_event`, and handed over by `SpeculativeToolset`.
+    """
+
+    def __init__(self) -> None:
+        self.started = 0
+        self.reused = 0
+        self._exit_stack: AsyncExitStack | None = None
+        self._task_group: TaskGroup | None = None
+        self._toolset: AbstractToolset[Any] | None = None
+        self._ctx: RunContext[Any] | None = None
+        self._tools: dict[str, ToolsetTool[Any]] = {}
+        self._speculations: dict[str, _Speculation] = {}
+        self._claimed: set[str] = set()
+        self._parts: dict[int, ToolCallPart] = {}
+
+    async def open(self) -> None:
+        self._exit_stack = AsyncExitStack()
+        self._task_group = await self._exit_stack.enter_async_context(anyio.create_task_group())
+
+    async def close(self) -> None:
+        """Cancel calls that are still running, their results will not be used."""
+        if self._exit_stack is None or self._task_group is None:
+            return
+        self._task_group.cancel_scope.cancel()
+        exit_stack = self._exit_stack
+        self._exit_stack = None
+        self._task_group = None
+        self._speculations.clear()
+        await exit_stack.aclose()
+
+    def prepare(self, toolset: AbstractToolset[Any], ctx: RunContext[Any], tools: dict[str, ToolsetTool[Any]]) -> None:
+        """Record the tools available for the current run step."""
+        self._toolset = toolset
+        self._ctx = ctx
+        self._tools = tools
+
+    def feed_event(self, event: AgentStreamEvent) -> None:
+        """Follow tool call parts in a model response stream and start each call as soon as its arguments are complete."""
+        if isinstance(event, PartStartEvent):
+            if event.index == 0:
+                self._parts.clear()
+            if isinstance(event.part, ToolCallPart):
+                self._parts[event.index] = event.part
+        elif isinstance(event, PartDeltaEvent) and isinstance(event.delta, ToolCallPartDelta):
+            if (part := self._parts.get(event.index)) is not None:
+                updated = event.delta.apply(part)
+                if isinstance(updated, ToolCallPart):
+                    self._parts[event.index] = updated
+        else:
+            return
+
+        if (part := self._parts.get(event.index)) is not None and _is_complete(part):
+            del self._parts[event.index]
+            self.speculate(part)
+
+    def speculate(self, call: ToolCallPart) -> bool:
+        """Start running a tool call, returns whether it was started.
+
+        Only function tools that are not sequential are started, and only when their arguments are valid.
+        """
+        task_group, toolset, step_ctx = self._task_group, self._toolset, self._ctx
+        if task_group is None or toolset is None or step_ctx is None:
+            return False
+        if call.tool_call_id in self._speculations or call.tool_call_id in self._claimed:
+            return False
+        tool = self._tools.get(call.tool_name)
+        if tool is None or tool.tool_def.kind != "function" or tool.tool_def.sequential:
+            return False
+
+        ctx = dataclasses.replace(
+            step_ctx,
+            tool_name=call.tool_name,
+            tool_call_id=call.tool_call_id,
+            retry=step_ctx.retries.get(call.tool_name, 0),
+            max_retries=tool.max_retries,
+        )
+        try:
+            args = tool.args_validator.validate_json(call.args_as_json_str(), context=ctx.validation_context)
+        except ValidationError:
+            # left for the agent, which asks the model to retry
+            return False
+
+        speculation = _Speculation(call.tool_name, args)
+        self._speculations[call.tool_call_id] = speculation
+        task_group.start_soon(speculation.run, toolset, ctx, tool)
+        self.started += 1
+        return True
+
+    def take(self, tool_call_id: str, name: str, args: dict[str, Any]) -> _Speculation | None:
+        """Hand over the speculative call matching a call the agent is making, if any.
+
+        The call is claimed either way, so it is not started again later.
+        """
+        self._claimed.add(tool_call_id)
+        speculation = self._speculations.pop(tool_call_id, None)
+        if speculation is None or speculation.name != name or speculation.args != args:
+            return None
+        self.reused += 1
+        return speculation
+
+
+@dataclasses.dataclass
+class SpeculativeToolset(WrapperToolset[Any]):
+    """Toolset that returns the results of calls a `ToolSpeculator` already started.
+
+    Calls that were not started speculatively are passed to the wrapped toolset.
+    Speculative calls still running when the run ends, or fails, are cancelled.
+    """
+
+    speculator: ToolSpeculator = dataclasses.field(default_factory=ToolSpeculator)
+
+    async def __aenter__(self) -> "SpeculativeToolset":
+        await super().__aenter__()
+        await self.speculator.open()
+        return self
+
+    async def __aexit__(self, *args: Any) -> bool | None:
+        try:
+            await self.speculator.close()
+        finally:
+            result = await super().__aexit__(*args)
+        return result
+
+    async def get_tools(self, ctx: RunContext[Any]) -> dict[str, ToolsetTool[Any]]:
+        tools = await super().get_tools(ctx)
+        self.speculator.prepare(self.wrapped, ctx, tools)
+        return tools
+
+    async def call_tool(
+        self, name: str, tool_args: dict[str, Any], ctx: RunContext[Any], tool: ToolsetTool[Any]
+    ) -> Any:
+        if ctx.tool_call_id is not None:
+            speculation = self.speculator.take(ctx.tool_call_id, name, tool_args)
+            if speculation is not None:
+                return await speculation.wait()
+        return await super().call_tool(name, tool_args, ctx, tool)
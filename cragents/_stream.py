@@ -0,0 +1,333 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+import json
+from collections.abc import Sequence
+from typing import Any, Literal
+
+from pydantic_ai.messages import (
+    AgentStreamEvent,
+    PartDeltaEvent,
+    PartStartEvent,
+    TextPart,
+    TextPartDelta,
+    ThinkingPart,
+    ThinkingPartDelta,
+    ToolCallPart,
+    ToolCallPartDelta,
+)
+
+from ._types import Anchor, Constrain, Free, GenerationSequenceElement, Think, UseTools
+
+SegmentKind = Literal["anchor", "constrain", "free", "think", "tool_call"]
+
+
+@dataclasses.dataclass(frozen=True)
+class GuideSegment:
+    """A segment of guided output that is complete.
+
+    Consecutive `Constrain` and `Free` elements with no `Anchor` or token between them
+    can not be told apart, they are reported as one segment for the first element.
+
+    Args:
+        kind: the kind of element that generated the segment
+        text: the generated text, for "think" this is everything between the think tokens
+        index: position of the element in the generation sequence
+        think_index: position of the element inside `Think`, if it is inside `Think`
+    """
+
+    kind: SegmentKind
+    text: str
+    index: int
+    think_index: int | None = None
+
+
+@dataclasses.dataclass(frozen=True)
+class GuideSegmentDelta:
+    """Text generated for a `Constrain`, `Free` or tool call segment that is not complete yet.
+
+    Args:
+        kind: the kind of element that is generating the segment
+        delta: newly generated text
+        index: position of the element in the generation sequence
+        think_index: position of the element inside `Think`, if it is inside `Think`
+    """
+
+    kind: SegmentKind
+    delta: str
+    index: int
+    think_index: int | None = None
+
+
+GuideStreamEvent = GuideSegment | GuideSegmentDelta
+
+
+@dataclasses.dataclass
+class _Slot:
+    """Expected output for one element, or for one of the tokens around `Think` and `UseTools`.
+
+    Slots with a `literal` are matched exactly, slots without one last until the next literal appears.
+    Token slots have no `segment_kind` since they are not reported as segments.
+    """
+
+    segment_kind: SegmentKind | None
+    index: int
+    think_index: int | None = None
+    literal: str | None = None
+    token: Literal["think_start", "think_stop", "tool_start", "tool_stop"] | None = None
+
+
+def _basic_slot(element: Anchor | Constrain | Free, index: int, think_index: int | None) -> _Slot:
+    if isinstance(element, Anchor):
+        return _Slot("anchor", index, think_index, element.text)
+    if isinstance(element, Constrain):
+        return _Slot("constrain", index, think_index)
+    return _Slot("free", index, think_index)
+
+
+def _build_slots(generation_sequence: Sequence[GenerationSequenceElement]) -> list[_Slot]:
+    slots: list[_Slot] = []
+    for index, element in enumerate(generation_sequence):
+        if isinstance(element, Think):
+            slots.append(_Slot(None, index, literal=f"{element.start_token}\n", token="think_start"))
+            for think_index, think_element in enumerate(element.sequence):
+                slots.append(_basic_slot(think_element, index, think_index))
+            slots.append(_Slot(None, index, literal=element.stop_token, token="think_stop"))
+        elif isinstance(element, UseTools):
+            slots.append(_Slot(None, index, literal=element.start_token, token="tool_start"))
+            slots.append(_Slot("tool_call", index))
+            slots.append(_Slot(None, index, literal=element.stop_token, token="tool_stop"))
+        else:
+            slots.append(_basic_slot(element, index, None))
+    return slots
+
+
+class GuideStreamParser:
+    """Split streamed model output into segments that follow a generation sequence.
+
+    Feed raw completion text with `feed`, or Pydantic AI stream events with `feed_event`.
+    Segments are reported as soon as the text that closes them arrives, then call `close` when the stream ends.
+
+    Args:
+        generation_sequence: the sequence that guided the model output
+    """
+
+    def __init__(self, generation_sequence: Sequence[GenerationSequenceElement]) -> None:
+        self._slots = _build_slots(generation_sequence)
+        self._think_tokens = {
+            index: (element.start_token, element.stop_token)
+            for index, element in enumerate(generation_sequence)
+            if isinstance(element, Think)
+        }
+        self._position = 0
+        self._buffer = ""
+        self._literal_matched = 0
+        self._variable_text = ""
+        self._consumed: list[str] = []
+        self._think_start = 0
+        # state for rebuilding raw text from Pydantic AI events
+        self._in_thinking_part = False
+        self._tool_calls: dict[int, tuple[str, str]] = {}
+
+    @property
+    def done(self) -> bool:
+        """Whether output for every element in the generation sequence has been seen."""
+        return self._position >= len(self._slots)
+
+    @property
+    def started(self) -> bool:
+        """Whether any output has been fed."""
+        return bool(self._consumed or self._buffer or self._variable_text or self._literal_matched)
+
+    def feed(self, text: str) -> list[GuideStreamEvent]:
+        """Consume raw completion text.
+
+        Raises:
+            ValueError: when the text does not follow the generation sequence
+        """
+        self._buffer += text
+        events: list[GuideStreamEvent] = []
+        while self._buffer and not self.done:
+            slot = self._slots[self._position]
+            if slot.literal is not None:
+                if not self._feed_literal(slot.literal, events):
+                    break
+            elif not self._feed_variable(events):
+                break
+        while not self.done and self._slots[self._position].literal == "":
+            self._feed_literal("", events)
+        return events
+
+    def feed_event(self, event: AgentStreamEvent) -> list[GuideStreamEvent]:
+        """Consume a Pydantic AI stream event, other events are ignored.
+
+        Thinking parts are turned back into text wrapped in the `Think` tokens, and tool call parts into the
+        text the `UseTools` grammar generates, so the stream can be parsed the same way as raw text.
+        """
+        text = ""
+        if isinstance(event, PartStartEvent):
+            part = event.part
+            if isinstance(part, ThinkingPart):
+                text = self._next_think_tokens()[0] + part.content
+                self._in_thinking_part = True
+            elif isinstance(part, TextPart):
+                text = self._end_thinking_part() + part.content
+            elif isinstance(part, ToolCallPart):
+                text = self._end_thinking_part()
+                self._tool_calls[event.index] = (part.tool_name, part.args_as_json_str() if part.args else "")
+                text += self._complete_tool_call(event.index)
+        elif isinstance(event, PartDeltaEvent):
+            delta = event.delta
+            if isinstance(delta, ThinkingPartDelta):
+                text = delta.content_delta or ""
+            elif isinstance(delta, TextPartDelta):
+                text = delta.content_delta
+            elif isinstance(delta, ToolCallPartDelta) and event.index in self._tool_calls:
+                name, args = self._tool_calls[event.index]
+                name += delta.tool_name_delta or ""
+                if isinstance(delta.args_delta, str):
+                    args += delta.args_delta
+                elif delta.args_delta is not None:
+                    args = json.dumps(delta.args_delta)
+                self._tool_calls[event.index] = (name, args)
+                text = self._complete_tool_call(event.index)
+        return self.feed(text) if text else []
+
+    def close(self) -> list[GuideStreamEvent]:
+        """Report the segment that is still open when the stream ends, if any."""
+        events = self.feed(self._end_thinking_part())
+        if not self.done and self._slots[self._position].literal is None:
+            if self._buffer:
+                events.append(self._delta(self._slots[self._position], self._buffer))
+            text = self._variable_text + self._buffer
+            self._consume(text)
+            events.append(self._segment(self._slots[self._position], text))
+            self._buffer = ""
+            self._variable_text = ""
+            self._position = self._next_literal_position(self._position)
+        return events
+
+    def _next_think_tokens(self) -> tuple[str, str]:
+        for slot in self._slots[self._position :]:
+            if slot.token == "think_start":
+                return self._think_tokens[slot.index]
+        return ("<think>", "</think>")
+
+    def _end_thinking_part(self) -> str:
+        if not self._in_thinking_part:
+            return ""
+        self._in_thinking_part = False
+        for slot in self._slots[self._position :]:
+            if slot.token == "think_stop":
+                return self._think_tokens[slot.index][1]
+        return ""
+
+    def _complete_tool_call(self, part_index: int) -> str:
+        name, args = self._tool_calls[part_index]
+        try:
+            arguments: Any = json.loads(args)
+        except json.JSONDecodeError:
+            return ""
+        del self._tool_calls[part_index]
+        start_token, stop_token = "<tool_call>", "</tool_call>"
+        for slot in self._slots[self._position :]:
+            if slot.token == "tool_start" and slot.literal is not None:
+                start_token = slot.literal
+            if slot.token == "tool_stop" and slot.literal is not None:
+                stop_token = slot.literal
+                break
+        return f"{start_token}{json.dumps({'name': name, 'arguments': arguments})}\n{stop_token}"
+
+    def _consume(self, text: str) -> None:
+        self._consumed.append(text)
+
+    def _feed_literal(self, literal: str, events: list[GuideStreamEvent]) -> bool:
+        remaining = literal[self._literal_matched :]
+        if self._buffer.startswith(remaining):
+            self._buffer = self._buffer[len(remaining) :]
+            self._literal_matched = 0
+            self._complete_literal(events)
+            return True
+        if remaining.startswith(self._buffer):
+            self._literal_matched += len(self._buffer)
+            self._buffer = ""
+            return False
+        slot = self._slots[self._position]
+        raise ValueError(f"Expected {remaining!r} at generation sequence index {slot.index}, got {self._buffer!r}.")
+
+    def _complete_literal(self, events: list[GuideStreamEvent]) -> None:
+        slot = self._slots[self._position]
+        assert slot.literal is not None
+        if slot.token == "think_stop":
+            events.append(GuideSegment("think", "".join(self._consumed)[self._think_start :], slot.index))
+        self._consume(slot.literal)
+        if slot.token == "think_start":
+            self._think_start = sum(len(text) for text in self._consumed)
+        if slot.segment_kind == "anchor":
+            events.append(self._segment(slot, slot.literal))
+        self._position += 1
+
+    def _next_literal_position(self, position: int) -> int:
+        position += 1
+        while position < len(self._slots) and self._slots[position].literal is None:
+            position += 1
+        return position
+
+    def _feed_variable(self, events: list[GuideStreamEvent]) -> bool:
+        slot = self._slots[self._position]
+        next_position = self._next_literal_position(self._position)
+        if next_position >= len(self._slots):
+            # nothing left to close the segment, only `close` can
+            events.append(self._delta(slot, self._buffer))
+            self._variable_text += self._buffer
+            self._buffer = ""
+            return False
+
+        literal = self._slots[next_position].literal
+        assert literal is not None
+        end = self._buffer.find(literal) if literal else 0
+        if end < 0:
+            # hold back text that could be the start of the literal
+            safe = len(self._buffer)
+            for start in range(max(len(self._buffer) - len(literal) + 1, 0), len(self._buffer)):
+                if literal.startswith(self._buffer[start:]):
+                    safe = start
+                    break
+            if safe > 0:
+                events.append(self._delta(slot, self._buffer[:safe]))
+                self._variable_text += self._buffer[:safe]
+                self._buffer = self._buffer[safe:]
+            return False
+
+        if end:
+            events.append(self._delta(slot, self._buffer[:end]))
+        text = self._variable_text + self._buffer[:end]
+        self._consume(text)
+        events.append(self._segment(slot, text))
+        self._buffer = self._buffer[end:]
+        self._variable_text = ""
+        self._position = next_position
+        return True
+
+    @staticmethod
+    def _segment(slot: _Slot, text: str) -> GuideSegment:
+        assert slot.segment_kind is not None
+        return GuideSegment(slot.segment_kind, text, slot.index, slot.think_index)
+
+    @staticmethod
+    def _delta(slot: _Slot, delta: str) -> GuideSegmentDelta:
+        assert slot.segment_kind is not None
+        return GuideSegmentDelta(slot.segment_kind, delta, slot.index, slot.think_index)
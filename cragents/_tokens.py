@@ -0,0 +1,147 @@
+# Copyright 2025 g-eoj
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import dataclasses
+import math
+import os
+from collections.abc import Callable, Iterable
+
+from ._grammar import AnyText, Newline, Paragraphs, Text, Token, lower
+from ._guide import CompiledGuide, Guide
+from ._types import Constrain
+
+
+@dataclasses.dataclass(frozen=True)
+class TokenEstimate:
+    """Token cost of a guide, measured with the served model's tokenizer before running it.
+
+    Args:
+        fixed_tokens: exact tokens of the text the guide forces, such as `Anchor` text and `Think` tokens
+        tokens: fixed tokens plus the expected tokens of every `Constrain` and bounded `Free` at its bound
+        unbounded: whether the guide has a `Free` without `max_chars` or a `UseTools`, not included in `tokens`
+    """
+
+    fixed_tokens: int
+    tokens: float
+    unbounded: bool
+
+
+def _fixed_text(node: Text | Token | Newline) -> str:
+    if isinstance(node, Text):
+        return node.text
+    if isinstance(node, Token):
+        return node.token
+    return "\n"
+
+
+class TokenCounter:
+    """Count tokens the way the served model does, to size guides in tokens instead of characters.
+
+    Load the model's Hugging Face `tokenizer.json` with `from_file`, or wrap any function that counts tokens.
+
+    Args:
+        count: returns the number of tokens in a text, without special tokens such as BOS
+    """
+
+    def __init__(self, count: Callable[[str], int]) -> None:
+        self.count = count
+
+    @classmethod
+    def from_file(cls, path: str | os.PathLike[str]) -> "TokenCounter":
+        """Load a Hugging Face `tokenizer.json`, no network access is needed.
+
+        Requires the `tokenizers` package.
+        """
+        try:
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError('Install the "tokenizers" package to load tokenizer.json files.') from e
+        tokenizer = Tokenizer.from_file(os.fspath(path))
+        return cls(lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids))
+
+    def __call__(self, text: str) -> int:
+        return self.count(text) if text else 0
+
+    def tokens_per_char(self, samples: Iterable[str]) -> float:
+        """Mean tokens per character of sample text, such as previous model output."""
+        samples = list(samples)
+        chars = sum(len(sample) for sample in samples)
+        if not chars:
+            raise ValueError("Samples must not be empty.")
+        return sum(self(sample) for sample in samples) / chars
+
+    def tokens_per_capture(self, samples: Iterable[str], chars_to_capture: str = ".") -> float:
+        """Mean tokens per capture character of sample text, roughly the tokens of one `Constrain` sentence.
+
+        Args:
+            samples: text like the output of the `Constrain` to size, for example from `GuideSegment`s of earlier runs
+            chars_to_capture: the capture characters of the `Constrain`
+        """
+        samples = list(samples)
+        captures = sum(sample.count(char) for sample in samples for char in chars_to_capture)
+        if not captures:
+            raise ValueError("Samples must contain capture characters.")
+        return sum(self(sample) for sample in samples) / captures
+
+    def estimate(self, guide: Guide, tokens_per_capture: float, tokens_per_char: float = 1.0) -> TokenEstimate:
+        """Token cost of a guide when every `Constrain` and bounded `Free` reaches its bound.
+
+        Compare `TokenEstimate.tokens` plus the prompt tokens with the server's `max_model_len`, or use it to size
+        batches by KV cache memory.
+
+        Args:
+            guide: the guide to measure
+            tokens_per_capture: tokens per `Constrain` sentence, see `tokens_per_capture`
+            tokens_per_char: tokens per `Free` character, see `tokens_per_char`, by default one token per character
+        """
+        generation_sequence = guide.generation_sequence if isinstance(guide, CompiledGuide) else guide
+        fixed_tokens, variable_tokens, unbounded = 0, 0.0, False
+        fixed_text = ""
+        for node in lower(generation_sequence):
+            if isinstance(node, Text | Token | Newline):
+                # count runs of fixed text together, tokens can span node boundaries
+                fixed_text += _fixed_text(node)
+                continue
+            fixed_tokens += self(fixed_text)
+            fixed_text = ""
+            if isinstance(node, Paragraphs):
+                paragraph_break = self("\n\n")
+                variable_tokens += node.max_newlines * (node.max_char_captures * tokens_per_capture + paragraph_break)
+            elif isinstance(node, AnyText) and node.max_chars is not None:
+                variable_tokens += node.max_chars * tokens_per_char
+            else:
+                unbounded = True
+        fixed_tokens += self(fixed_text)
+        return TokenEstimate(fixed_tokens, fixed_tokens + variable_tokens, unbounded)
+
+    def fit(self, constrain: Constrain, max_tokens: float, tokens_per_capture: float) -> Constrain:
+        """Copy of `constrain` with the largest bounds whose expected tokens fit `max_tokens`.
+
+        Sentences per paragraph are reduced first, then paragraphs.
+
+        Args:
+            constrain: the element to size, its bounds are upper limits
+            max_tokens: token budget of the element
+            tokens_per_capture: tokens per sentence, see `tokens_per_capture`
+        """
+        paragraph_break = self("\n\n")
+
+        def captures(newlines: int) -> int:
+            return math.floor((max_tokens / newlines - paragraph_break) / tokens_per_capture)
+
+        for newlines in range(constrain.max_newlines, 0, -1):
+            if (max_char_captures := min(constrain.max_char_captures, captures(newlines))) >= 1:
+                return dataclasses.replace(constrain, max_newlines=newlines, max_char_captures=max_char_captures)
+        raise ValueError(f"A Constrain sentence does not fit in {max_tokens} tokens.")
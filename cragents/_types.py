@@ -14,20 +14,117 @@
 
 
 import dataclasses
-from collections.abc import Sequence
-from typing import Any
+import json
+import weakref
+from collections.abc import Mapping, Sequence
+from typing import Any, Literal, NoReturn
 
 JsonSchema = dict[str, Any]
 
 
-@dataclasses.dataclass
+def _immutable(self: object, *args: Any, **kwargs: Any) -> NoReturn:
+    raise TypeError(f"{type(self).__name__} is immutable.")
+
+
+class FrozenList(list[Any]):
+    """JSON array that can not be changed, still a `list` for code that reads schemas."""
+
+    __slots__ = ("_hash",)
+
+    def __init__(self, items: Sequence[Any]) -> None:
+        super().__init__(_freeze(item) for item in items)
+        self._hash = hash(tuple(self))
+
+    def __hash__(self) -> int:  # pyright: ignore[reportIncompatibleVariableOverride]
+        return self._hash
+
+    def __copy__(self) -> "FrozenList":
+        return self
+
+    def __deepcopy__(self, memo: dict[int, Any]) -> "FrozenList":
+        return self
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        return (type(self), (list(self),))
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+
+
+class FrozenJson(dict[str, Any]):
+    """JSON object that can not be changed, nested objects and arrays are frozen too.
+
+    It is still a `dict` for code that reads schemas, and hashable with the hash computed once, so elements
+    holding it can be dict keys. Use `freeze_json` to share one copy of equal schemas.
+    """
+
+    __slots__ = ("__weakref__", "_canonical", "_hash")
+
+    def __init__(self, data: Mapping[str, Any], canonical: str | None = None) -> None:
+        super().__init__((key, _freeze(value)) for key, value in data.items())
+        self._hash = hash(frozenset(self.items()))
+        self._canonical = canonical
+
+    def __hash__(self) -> int:  # pyright: ignore[reportIncompatibleVariableOverride]
+        return self._hash
+
+    @property
+    def canonical(self) -> str:
+        """Canonical JSON text, computed once. Unlike `==`, it tells `1`, `1.0` and `true` apart."""
+        if self._canonical is None:
+            self._canonical = _canonical(self)
+        return self._canonical
+
+    def __copy__(self) -> "FrozenJson":
+        return self
+
+    def __deepcopy__(self, memo: dict[int, Any]) -> "FrozenJson":
+        return self
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        return (type(self), (dict(self),))
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+_interned: "weakref.WeakValueDictionary[str, FrozenJson]" = weakref.WeakValueDictionary()
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, dict) and not isinstance(value, FrozenJson):
+        return FrozenJson(value)  # pyright: ignore[reportUnknownArgumentType]
+    if isinstance(value, list) and not isinstance(value, FrozenList):
+        return FrozenList(value)  # pyright: ignore[reportUnknownArgumentType]
+    return value
+
+
+def _canonical(data: Mapping[str, Any]) -> str:
+    return json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def freeze_json(data: Mapping[str, Any]) -> FrozenJson:
+    """Frozen copy of a JSON object, objects with the same canonical JSON share one instance while one is alive.
+
+    Frozen objects are returned as they are, so freezing again costs nothing.
+    """
+    if isinstance(data, FrozenJson):
+        return data
+    canonical = _canonical(data)
+    if (frozen := _interned.get(canonical)) is None:
+        frozen = FrozenJson(data, canonical)
+        _interned[canonical] = frozen
+    return frozen
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class Anchor:
     """Force the model to generate this text."""
 
     text: str
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class Constrain:
     """Bound model text output based on newlines and character captures.
 
@@ -46,21 +143,28 @@ class Constrain:
     chars_to_capture: str = "."
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class Free:
     """Allow the model to generate anything.
 
-    WARNING: There is no guarantee free generation will stop and the model will
-    continue to the next element in the generation sequence.
+    WARNING: Without `max_chars` there is no guarantee free generation will stop
+    and the model will continue to the next element in the generation sequence.
+
+    Args:
+        max_chars: upper bound on the number of characters the model can generate
     """
 
-    pass
+    max_chars: int | None = None
+
+    def __post_init__(self) -> None:
+        if self.max_chars is not None and self.max_chars < 0:
+            raise ValueError("max_chars must not be negative.")
 
 
 BasicGenerationSequenceElement = Anchor | Constrain | Free
 
 
-@dataclasses.dataclass
+@dataclasses.dataclass(frozen=True, slots=True)
 class Think:
     """Force the model to wrap the sequence with 'think' tokens.
 
@@ -73,9 +177,17 @@ class Think:
     sequence: Sequence[BasicGenerationSequenceElement]
     start_token: str = "<think>"
     stop_token: str = "</think>"
+    _hash: int = dataclasses.field(init=False, repr=False, compare=False)
 
+    def __post_init__(self) -> None:
+        object.__setattr__(self, "sequence", tuple(self.sequence))
+        object.__setattr__(self, "_hash", hash((self.sequence, self.start_token, self.stop_token)))
 
-@dataclasses.dataclass
+    def __hash__(self) -> int:
+        return self._hash
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
 class UseTools:
     """Force the model to generate tool call(s).
 
@@ -87,13 +199,66 @@ class UseTools:
         tool_names: force the model to choose from these tool names
         start_token: force the model to generate this token before any tool calls
         stop_token: force the model to generate this token after all tool calls
+        tools: arguments schema of each tool by name, each tool name is tied to its own arguments,
+            used instead of `json_schema` and narrowed by `tool_names` or `tool_name_regex`
     """
 
     json_schema: JsonSchema | None = None
     tool_name_regex: str = "/[a-zA-Z0-9_]+/"
-    tool_names: list[str] | None = None
+    tool_names: Sequence[str] | None = None
     start_token: str = "<tool_call>"
     stop_token: str = "</tool_call>"
+    tools: Mapping[str, JsonSchema] | None = None
+    _hash: int = dataclasses.field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        if self.json_schema is not None:
+            object.__setattr__(self, "json_schema", freeze_json(self.json_schema))
+        if self.tool_names is not None:
+            object.__setattr__(self, "tool_names", tuple(self.tool_names))
+        if self.tools is not None and not isinstance(self.tools, FrozenJson):
+            tools = {name: freeze_json(schema) for name, schema in self.tools.items()}
+            object.__setattr__(self, "tools", FrozenJson(tools))
+        fields = (
+            self.json_schema,
+            self.tool_name_regex,
+            self.tool_names,
+            self.start_token,
+            self.stop_token,
+            self.tools,
+        )
+        object.__setattr__(self, "_hash", hash(fields))
+
+    def __hash__(self) -> int:
+        return self._hash
 
 
 GenerationSequenceElement = BasicGenerationSequenceElement | Think | UseTools
+
+
+@dataclasses.dataclass(frozen=True)
+class GrammarStats:
+    """Size of a grammar, as a proxy for the inference server's compile time and per-token mask cost.
+
+    Args:
+        size_bytes: UTF-8 encoded size of the grammar text, embedded JSON schemas included
+        rule_count: number of non-empty grammar lines, the grammars cragents emits define one rule or terminal per line
+    """
+
+    size_bytes: int
+    rule_count: int
+
+
+@dataclasses.dataclass(frozen=True)
+class GrammarBudget:
+    """Upper bounds on grammar size, checked whenever a guide is built, including guides that come from the cache.
+
+    Args:
+        max_bytes: upper bound on the grammar size in bytes
+        max_rules: upper bound on `GrammarStats.rule_count`, the number of non-empty grammar lines
+        on_exceed: "warn" to emit a `UserWarning`, "raise" to raise a `ValueError`
+    """
+
+    max_bytes: int | None = None
+    max_rules: int | None = None
+    on_exceed: Literal["warn", "raise"] = "warn"
@@ -13,20 +13,23 @@
 # limitations under the License.
 
 
-import json
-import re
+import dataclasses
+import functools
+import warnings
 from collections.abc import Sequence
 
 from pydantic import TypeAdapter
 from pydantic_ai import BinaryImage, DeferredToolRequests, _output, _utils, output
 
+from ._cache import GrammarCache
+from ._grammar import LARK, GrammarBackend, compile_grammar, prefill_text
+from ._prefill import PREFILL_KEY
+from ._schema import minimize_json_schema
 from ._types import (
-    Anchor,
-    Constrain,
-    Free,
     GenerationSequenceElement,
+    GrammarBudget,
+    GrammarStats,
     JsonSchema,
-    Think,
     UseTools,
 )
 
@@ -85,88 +88,148 @@ def build_json_schema(output_schema: _output.OutputSchema[output.OutputDataT]) -
     return json_schema
 
 
-def build_grammar(generation_sequence: Sequence[GenerationSequenceElement]) -> str:
-    start_def = "start: "
-    custom_defs: list[str] = []
-    default_defs = [
-        "FREE: /[\\S\\s]*/",
-        "NL: /\\n/",
-    ]
+def build_grammar(
+    generation_sequence: Sequence[GenerationSequenceElement], prefill: bool = False, backend: GrammarBackend = LARK
+) -> str:
+    return compile_grammar(generation_sequence, prefill=prefill, backend=backend)
 
-    uid = 0
-    for element in generation_sequence:
-        if isinstance(element, Anchor):
-            start_def += f'"{element.text}" '
-
-        if isinstance(element, Constrain):
-            uid += 1
-            block_uid = f"block_{uid}"
-            p_uid = f"p_{uid}"
-            s_uid = f"s_{uid}"
-
-            start_def += f"{block_uid} "
-
-            capture = " | ".join([f'"{x}"' for x in element.chars_to_capture])
-            custom_defs.append(f"{block_uid}: {p_uid}{{1,{element.max_newlines}}}")
-            custom_defs.append(f"{p_uid}: {s_uid}{{1,{element.max_char_captures}}} NL NL")
-            custom_defs.append(f"{s_uid}[lazy]: /[^{re.escape(element.chars_to_capture)}\\n]+/ ( {capture} )")
-
-        if isinstance(element, Free):
-            start_def += "FREE "
-
-        if isinstance(element, Think):
-            start_def += f"{element.start_token} NL "
-
-            for think_element in element.sequence:
-                if isinstance(think_element, Anchor):
-                    start_def += f'"{think_element.text}" '
 
-                if isinstance(think_element, Constrain):
-                    uid += 1
-                    block_uid = f"block_{uid}"
-                    p_uid = f"p_{uid}"
-                    s_uid = f"s_{uid}"
+def grammar_stats(grammar: str) -> GrammarStats:
+    rule_count = sum(1 for line in grammar.splitlines() if line.strip())
+    return GrammarStats(size_bytes=len(grammar.encode()), rule_count=rule_count)
 
-                    start_def += f"{block_uid} "
 
-                    capture = " | ".join([f'"{x}"' for x in think_element.chars_to_capture])
-                    custom_defs.append(f"{block_uid}: {p_uid}{{1,{think_element.max_newlines}}}")
-                    custom_defs.append(f"{p_uid}: {s_uid}{{1,{think_element.max_char_captures}}} NL NL")
-                    custom_defs.append(
-                        f"{s_uid}[lazy]: /[^{re.escape(think_element.chars_to_capture)}\\n]+/ ( {capture} )"
-                    )
-
-                if isinstance(think_element, Free):
-                    start_def += "FREE "
-
-            start_def += f"{element.stop_token} "
+def minimize_generation_sequence(
+    generation_sequence: Sequence[GenerationSequenceElement],
+) -> list[GenerationSequenceElement]:
+    minimized: list[GenerationSequenceElement] = []
+    for element in generation_sequence:
+        if isinstance(element, UseTools) and (element.json_schema is not None or element.tools is not None):
+            element = dataclasses.replace(
+                element,
+                json_schema=None if element.json_schema is None else minimize_json_schema(element.json_schema),
+                tools=None
+                if element.tools is None
+                else {name: minimize_json_schema(schema) for name, schema in element.tools.items()},
+            )
+        minimized.append(element)
+    return minimized
 
-        if isinstance(element, UseTools):
-            start_def += f"{element.start_token} tool_call {element.stop_token}"
 
-            custom_defs.append(
-                'tool_call: "{\\"name\\": \\"" FUNCTION_NAME "\\", \\"arguments\\": " tool_schema "}\\n"'
-            )
-            custom_defs.append("tool_schema: %json " + json.dumps(element.json_schema))
-            if not element.tool_names:
-                custom_defs.append(f"FUNCTION_NAME: {element.tool_name_regex}")
-            else:
-                tool_names = [f'"{tool_name}"' for tool_name in element.tool_names]
-                custom_defs.append(f"FUNCTION_NAME: ({' | '.join(tool_names)})")
-
-    grammar = "\n".join([start_def.strip()] + custom_defs + default_defs)
+def minimization_stats(
+    generation_sequence: Sequence[GenerationSequenceElement],
+    backend: GrammarBackend = LARK,
+) -> tuple[GrammarStats, GrammarStats]:
+    before = grammar_stats(build_grammar(generation_sequence, backend=backend))
+    after = grammar_stats(build_grammar(minimize_generation_sequence(generation_sequence), backend=backend))
+    return before, after
+
+
+def check_grammar_budget(
+    stats: GrammarStats,
+    budget: GrammarBudget,
+    unminimized_sequence: Sequence[GenerationSequenceElement] | None = None,
+    backend: GrammarBackend = LARK,
+) -> None:
+    exceeded: list[str] = []
+    if budget.max_bytes is not None and stats.size_bytes > budget.max_bytes:
+        exceeded.append(f"{stats.size_bytes} bytes > {budget.max_bytes}")
+    if budget.max_rules is not None and stats.rule_count > budget.max_rules:
+        exceeded.append(f"{stats.rule_count} rules > {budget.max_rules}")
+    if not exceeded:
+        return
+
+    message = f"Grammar exceeds budget: {', '.join(exceeded)}."
+    if unminimized_sequence is not None:
+        before = grammar_stats(build_grammar(unminimized_sequence, backend=backend))
+        message += f" Before minimization: {before.size_bytes} bytes, {before.rule_count} rules."
+    if budget.on_exceed == "raise":
+        raise ValueError(message)
+    warnings.warn(message, stacklevel=2)
+
+
+def build_guided_grammar(
+    generation_sequence: Sequence[GenerationSequenceElement],
+    minimize: bool = False,
+    budget: GrammarBudget | None = None,
+    prefill: bool = False,
+    backend: GrammarBackend = LARK,
+) -> str:
+    if minimize:
+        grammar = build_grammar(minimize_generation_sequence(generation_sequence), prefill=prefill, backend=backend)
+    else:
+        grammar = build_grammar(generation_sequence, prefill=prefill, backend=backend)
+
+    if budget is not None:
+        check_grammar_budget(grammar_stats(grammar), budget, generation_sequence if minimize else None, backend=backend)
     return grammar
 
 
-def make_guided_extra_body(
-    generation_sequence: Sequence[GenerationSequenceElement],
-) -> JsonSchema:
-    grammar = build_grammar(generation_sequence)
-    extra_body = {
+def guided_extra_body(grammar: str, prefill: str | None = None, backend: GrammarBackend = LARK) -> JsonSchema:
+    extra_body: JsonSchema = {
         "chat_template_kwargs": {
             "add_generation_prompt": False,
             "enable_thinking": False,
         },
-        "structured_outputs": {"grammar": grammar},
+        **backend.grammar_body(grammar),
     }
+    if prefill:
+        # continue the assistant message that starts with the prefill, see `PrefillChatModel`
+        if backend.continue_final_message:
+            extra_body["add_generation_prompt"] = False
+            extra_body["continue_final_message"] = True
+        extra_body[PREFILL_KEY] = prefill
+    return extra_body
+
+
+def make_guided_extra_body(
+    generation_sequence: Sequence[GenerationSequenceElement],
+    cache: GrammarCache | None = None,
+    minimize: bool = False,
+    budget: GrammarBudget | None = None,
+    prefill: bool = False,
+    backend: GrammarBackend = LARK,
+) -> JsonSchema:
+    extra_body, _ = make_guided_build(
+        generation_sequence, cache=cache, minimize=minimize, budget=budget, prefill=prefill, backend=backend
+    )
     return extra_body
+
+
+def make_guided_build(
+    generation_sequence: Sequence[GenerationSequenceElement],
+    cache: GrammarCache | None = None,
+    minimize: bool = False,
+    budget: GrammarBudget | None = None,
+    prefill: bool = False,
+    backend: GrammarBackend = LARK,
+) -> tuple[JsonSchema, GrammarStats]:
+    """Guided `extra_body` and the stats of its grammar, which are cached with it so a hit does not rescan it.
+
+    The cache holds the grammar text, never the `extra_body` dict, so each call returns a new dict the caller
+    can change without touching the guides of other agents. The budget is checked on every call, cache hits
+    included, against the cached stats.
+    """
+    if cache is not None:
+        build = functools.partial(_guided_build, minimize=minimize, prefill=prefill, backend=backend)
+        grammar, prefill_str, stats = cache.get_or_build(
+            generation_sequence, build, options=(minimize, prefill, backend.name)
+        )
+    else:
+        grammar, prefill_str, stats = _guided_build(
+            generation_sequence, minimize=minimize, prefill=prefill, backend=backend
+        )
+
+    if budget is not None:
+        check_grammar_budget(stats, budget, generation_sequence if minimize else None, backend=backend)
+    return guided_extra_body(grammar, prefill_str, backend), stats
+
+
+def _guided_build(
+    generation_sequence: Sequence[GenerationSequenceElement],
+    minimize: bool = False,
+    prefill: bool = False,
+    backend: GrammarBackend = LARK,
+) -> tuple[str, str | None, GrammarStats]:
+    grammar = build_guided_grammar(generation_sequence, minimize=minimize, prefill=prefill, backend=backend)
+    return grammar, prefill_text(generation_sequence) if prefill else None, grammar_stats(grammar)
@@ -1 +1 @@
-__version__ = "0.0.0.a1"
+__version__ = "0.1.0.a1"
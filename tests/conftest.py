@@ -0,0 +1,10 @@
+import pytest
+
+
+def pytest_collection_modifyitems(items: list[pytest.Item]) -> None:
+    # pydantic-ai runs agents with asyncio primitives, so tests that run one are skipped on other anyio backends
+    for item in items:
+        callspec = getattr(item, "callspec", None)
+        backend = callspec.params.get("anyio_backend", "asyncio") if callspec is not None else "asyncio"
+        if item.get_closest_marker("agent_run") and backend != "asyncio":
+            item.add_marker(pytest.mark.skip(reason="pydantic-ai runs agents on asyncio only"))
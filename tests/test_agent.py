@@ -1,9 +1,14 @@
+import json
+
+import anyio
 import pytest
 from inline_snapshot import snapshot
-from pydantic_ai import ToolOutput
+from pydantic_ai import ModelMessage, ModelResponse, RunContext, TextPart, ToolDefinition, ToolOutput
+from pydantic_ai.models.function import AgentInfo, FunctionModel
 from pydantic_ai.models.openai import OpenAIChatModel, OpenAIChatModelSettings
 from pydantic_ai.models.test import TestModel
 from pydantic_ai.providers.openai import OpenAIProvider
+from pydantic_ai.toolsets import FunctionToolset
 
 from cragents import Anchor, Constrain, CRAgent, Free, Think, UseTools, vllm_model_profile
 
@@ -72,9 +77,8 @@ s_1[lazy]: /[^\\.\\n]+/ ( "." )
 block_2: p_2{1,2}
 p_2: s_2{1,1} NL NL
 s_2[lazy]: /[^\\.\\n]+/ ( "." )
-tool_call: "{\\"name\\": \\"" FUNCTION_NAME "\\", \\"arguments\\": " tool_schema "}\\n"
-tool_schema: %json {"properties": {"response": {"type": "boolean"}}, "required": ["response"], "type": "object"}
-FUNCTION_NAME: /[a-zA-Z0-9_]+/
+tool_call: tool_object "\\n"
+tool_object: %json {"type": "object", "properties": {"name": {"enum": ["one", "two"]}, "arguments": {"properties": {"response": {"type": "boolean"}}, "required": ["response"], "type": "object"}}, "required": ["name", "arguments"], "additionalProperties": false}
 FREE: /[\\S\\s]*/
 NL: /\\n/\
 """
@@ -100,9 +104,8 @@ s_1[lazy]: /[^\\.\\n]+/ ( "." )
 block_2: p_2{1,2}
 p_2: s_2{1,1} NL NL
 s_2[lazy]: /[^\\.\\n]+/ ( "." )
-tool_call: "{\\"name\\": \\"" FUNCTION_NAME "\\", \\"arguments\\": " tool_schema "}\\n"
-tool_schema: %json {"anyOf": [{"properties": {"response": {"type": "boolean"}}, "required": ["response"], "type": "object"}, {"properties": {"response": {"type": "integer"}}, "required": ["response"], "type": "object"}]}
-FUNCTION_NAME: /[a-zA-Z0-9_]+/
+tool_call: tool_object "\\n"
+tool_object: %json {"anyOf": [{"type": "object", "properties": {"name": {"const": "final_result_bool"}, "arguments": {"properties": {"response": {"type": "boolean"}}, "required": ["response"], "type": "object"}}, "required": ["name", "arguments"], "additionalProperties": false}, {"type": "object", "properties": {"name": {"const": "final_result_int"}, "arguments": {"properties": {"response": {"type": "integer"}}, "required": ["response"], "type": "object"}}, "required": ["name", "arguments"], "additionalProperties": false}]}
 FREE: /[\\S\\s]*/
 NL: /\\n/\
 """
@@ -128,9 +131,8 @@ s_1[lazy]: /[^\\.\\n]+/ ( "." )
 block_2: p_2{1,2}
 p_2: s_2{1,1} NL NL
 s_2[lazy]: /[^\\.\\n]+/ ( "." )
-tool_call: "{\\"name\\": \\"" FUNCTION_NAME "\\", \\"arguments\\": " tool_schema "}\\n"
-tool_schema: %json {"anyOf": [{"type": "string"}, {"properties": {"response": {"type": "boolean"}}, "required": ["response"], "type": "object"}]}
-FUNCTION_NAME: /[a-zA-Z0-9_]+/
+tool_call: tool_object "\\n"
+tool_object: %json {"type": "object", "properties": {"name": {"const": "final_result"}, "arguments": {"properties": {"response": {"type": "boolean"}}, "required": ["response"], "type": "object"}}, "required": ["name", "arguments"], "additionalProperties": false}
 FREE: /[\\S\\s]*/
 NL: /\\n/\
 """
@@ -205,9 +207,8 @@ async def test_set_guide_use_tools_tool_names():
     assert 'FUNCTION_NAME: ("alpha" | "beta")' in grammar
 
 
-async def test_set_guide_merges_toolset_with_anyof_output():
-    # When the output schema already has anyOf (multiple output types) and the agent
-    # also has registered tools, anyOf = toolset_schemas + return_schema["anyOf"]
+async def test_set_guide_ties_tool_names_to_arguments():
+    # function tools and output tools each get their own arguments schema
     agent = CRAgent(model, output_type=[ToolOutput(bool), ToolOutput(int)])
 
     @agent.tool_plain
@@ -216,8 +217,56 @@ async def test_set_guide_merges_toolset_with_anyof_output():
 
     await agent.set_guide([UseTools()])
     grammar = agent.model_settings["extra_body"]["structured_outputs"]["grammar"]
-    assert "tool_schema" in grammar
-    assert "anyOf" in grammar
+    assert grammar.splitlines()[1] == snapshot('tool_call: tool_object "\\n"')
+    call = json.loads(grammar.splitlines()[2].removeprefix("tool_object: %json "))
+    assert [
+        (branch["properties"]["name"], branch["properties"]["arguments"]["required"]) for branch in call["anyOf"]
+    ] == [
+        ({"const": "helper"}, ["x"]),
+        ({"const": "final_result_bool"}, ["response"]),
+        ({"const": "final_result_int"}, ["response"]),
+    ]
+    assert "FUNCTION_NAME" not in grammar
+
+
+async def test_tool_filter_narrows_tools():
+    agent = CRAgent(model, output_type=ToolOutput(bool))
+
+    @agent.tool_plain
+    def alpha(a: int) -> int:
+        return a
+
+    @agent.tool_plain
+    def beta(b: int) -> int:
+        return b
+
+    extra_body = await agent.build_guide([UseTools()], tool_filter=lambda tool_def: tool_def.name != "beta")
+    grammar = extra_body["structured_outputs"]["grammar"]
+    assert '"alpha"' in grammar
+    assert '"final_result"' in grammar
+    assert '"beta"' not in grammar
+    # tool_names narrows the resolved tools the same way
+    grammar = (await agent.build_guide([UseTools(tool_names=["beta"])]))["structured_outputs"]["grammar"]
+    assert '"beta"' in grammar
+    assert '"alpha"' not in grammar
+    with pytest.raises(ValueError, match="No tools left"):
+        await agent.build_guide([UseTools()], tool_filter=lambda tool_def: False)
+
+
+async def test_prepare_tools_narrows_tools():
+    async def only_alpha(ctx: RunContext[None], tool_defs: list[ToolDefinition]) -> list[ToolDefinition]:
+        return [tool_def for tool_def in tool_defs if tool_def.name == "alpha"]
+
+    def alpha(a: int) -> int:
+        return a
+
+    def beta(b: int) -> int:
+        return b
+
+    agent = CRAgent(model, tools=[alpha, beta], prepare_tools=only_alpha)
+    grammar = (await agent.build_guide([UseTools()]))["structured_outputs"]["grammar"]
+    assert '"alpha"' in grammar
+    assert '"beta"' not in grammar
 
 
 # ── vllm_model_profile ─────────────────────────────────────────────────────────
@@ -237,3 +286,177 @@ def test_vllm_profile_json_object_output():
 
 def test_vllm_profile_json_schema_output():
     assert vllm_model_profile.supports_json_schema_output is True
+
+
+# ── per-run guides ─────────────────────────────────────────────────────────────
+
+
+async def test_guide_settings_does_not_modify_agent():
+    agent = CRAgent(model, model_settings=OpenAIChatModelSettings(temperature=0.5))
+    settings = await agent.guide_settings([Anchor("hi")], model_settings=OpenAIChatModelSettings(max_tokens=10))
+    assert agent.model_settings == {"temperature": 0.5}
+    assert settings["max_tokens"] == 10
+    assert "hi" in settings["extra_body"]["structured_outputs"]["grammar"]
+
+
+async def test_build_guide_matches_set_guide():
+    agent = CRAgent(model)
+    extra_body = await agent.build_guide(generation_sequence)
+    await agent.set_guide(generation_sequence)
+    assert agent.model_settings["extra_body"] == extra_body
+
+
+async def test_cached_guide_not_shared_between_agents():
+    first, second = CRAgent(model), CRAgent(model)
+    await first.set_guide(generation_sequence)
+    first.model_settings["extra_body"]["top_k"] = 20
+    first.model_settings["extra_body"]["chat_template_kwargs"]["enable_thinking"] = True
+    await second.set_guide(generation_sequence)
+    assert "top_k" not in second.model_settings["extra_body"]
+    assert second.model_settings["extra_body"]["chat_template_kwargs"]["enable_thinking"] is False
+    assert await second.build_guide(generation_sequence) == second.model_settings["extra_body"]
+
+
+@pytest.mark.agent_run
+async def test_concurrent_runs_use_their_own_guide():
+    agent = CRAgent(model)
+    await agent.set_guide([Anchor("agent ")])
+
+    def respond(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        assert info.model_settings is not None
+        return ModelResponse(parts=[TextPart(info.model_settings["extra_body"]["structured_outputs"]["grammar"])])
+
+    async def run(text: str) -> str:
+        settings = await agent.guide_settings([Anchor(text)])
+        result = await agent.run("hi", model=FunctionModel(respond), model_settings=settings)
+        return result.output
+
+    outputs: dict[str, str] = {}
+
+    async def collect(text: str) -> None:
+        outputs[text] = await run(text)
+
+    async with anyio.create_task_group() as tg:
+        for i in range(20):
+            tg.start_soon(collect, f"run {i} ")
+
+    assert len(outputs) == 20
+    for text, output in outputs.items():
+        assert f'start: "{text}"' in output
+    assert "agent " in agent.model_settings["extra_body"]["structured_outputs"]["grammar"]
+
+
+# ── toolset schema memoization ─────────────────────────────────────────────────
+
+
+async def test_toolset_schemas_frozen_once_while_tools_unchanged():
+    agent = CRAgent(model)
+
+    @agent.tool_plain
+    def my_tool(x: int) -> str:
+        return str(x)
+
+    agent.grammar_cache = None
+    first = await agent._process_generation_sequence([UseTools()], None)
+    second = await agent._process_generation_sequence([UseTools()], None)
+    # the toolset builds new tool definitions, the schemas are not frozen or serialized again
+    assert agent._tool_schema_memo.frozen == 1
+    assert isinstance(first[0], UseTools) and isinstance(second[0], UseTools)
+    assert first[0].tools is second[0].tools
+
+
+async def test_toolset_schemas_rebuilt_when_tools_change():
+    agent = CRAgent(model)
+
+    @agent.tool_plain
+    def first_tool(x: int) -> str:
+        return str(x)
+
+    await agent.build_guide([UseTools()])
+
+    @agent.tool_plain
+    def second_tool(y: str) -> str:
+        return y
+
+    grammar = (await agent.build_guide([UseTools()]))["structured_outputs"]["grammar"]
+    assert '"x"' in grammar
+    assert '"y"' in grammar
+    assert agent._tool_schema_memo.frozen == 2
+
+
+async def test_static_toolsets_not_listed_again(monkeypatch: pytest.MonkeyPatch):
+    get_tools = FunctionToolset.get_tools
+    calls = 0
+
+    async def counting_get_tools(self: FunctionToolset[None], ctx: RunContext[None]):
+        nonlocal calls
+        calls += 1
+        return await get_tools(self, ctx)
+
+    monkeypatch.setattr(FunctionToolset, "get_tools", counting_get_tools)
+    agent = CRAgent(model)
+
+    @agent.tool_plain
+    def my_tool(x: int) -> str:
+        return str(x)
+
+    first = await agent.build_guide([UseTools()])
+    second = await agent.build_guide([UseTools()])
+    assert first == second
+    assert first["structured_outputs"]["grammar"] is second["structured_outputs"]["grammar"]
+    assert calls == 1
+
+
+async def test_tools_with_prepare_listed_on_every_guide():
+    agent = CRAgent(model)
+    calls = 0
+
+    async def prepare(ctx: RunContext[None], tool_def: ToolDefinition) -> ToolDefinition:
+        nonlocal calls
+        calls += 1
+        return tool_def
+
+    @agent.tool_plain(prepare=prepare)
+    def my_tool(x: int) -> str:
+        return str(x)
+
+    await agent.build_guide([UseTools()])
+    await agent.build_guide([UseTools()])
+    assert calls == 2
+
+
+async def test_toolsets_resolved_in_registration_order():
+    def alpha(a: int) -> int:
+        return a
+
+    def beta(b: int) -> int:
+        return b
+
+    first = FunctionToolset([alpha])
+    second = FunctionToolset([beta])
+    agent = CRAgent(model, toolsets=[first, second])
+    grammar = (await agent.build_guide([UseTools()]))["structured_outputs"]["grammar"]
+    assert grammar.index('"a"') < grammar.index('"b"')
+
+
+# ── schema minimization ────────────────────────────────────────────────────────
+
+
+async def test_minimize_schemas():
+    agent = CRAgent(model, output_type=ToolOutput(int))
+    agent.minimize_schemas = True
+
+    @agent.tool_plain
+    def my_tool(x: int) -> str:
+        """Describe my tool.
+
+        Args:
+            x: a number that is described at length in the tool schema
+        """
+        return str(x)
+
+    before, after = await agent.guide_stats([UseTools()])
+    assert after.size_bytes < before.size_bytes
+    grammar = (await agent.build_guide([UseTools()]))["structured_outputs"]["grammar"]
+    assert len(grammar.encode()) == after.size_bytes
+    assert "described at length" not in grammar
@@ -0,0 +1,138 @@
+from contextlib import aclosing
+
+import anyio
+import httpx
+import pytest
+from openai import AsyncOpenAI
+from pydantic_ai import ModelHTTPError, ModelMessage, ModelResponse, TextPart, UserPromptPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import (
+    Anchor,
+    BatchResult,
+    CRAgent,
+    Free,
+    GuideBuildMetrics,
+    GuideObserver,
+    ReplayTransport,
+    vllm_model_profile,
+)
+
+pytestmark = pytest.mark.anyio
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="..."),
+    profile=vllm_model_profile,
+)
+
+guide = [Anchor("Label: "), Free()]
+
+
+class BuildCounter(GuideObserver):
+    def __init__(self) -> None:
+        self.builds = 0
+
+    def guide_built(self, metrics: GuideBuildMetrics) -> None:
+        self.builds += 1
+
+
+def echo_model(in_flight: list[int], peak: list[int]) -> FunctionModel:
+    async def echo(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await anyio.sleep(0.001)
+        in_flight[0] -= 1
+        prompt = next(part.content for part in messages[0].parts if isinstance(part, UserPromptPart))
+        if prompt == "fail":
+            raise RuntimeError("bad prompt")
+        assert info.model_settings is not None
+        assert "Label" in info.model_settings["extra_body"]["structured_outputs"]["grammar"]  # pyright: ignore
+        return ModelResponse(parts=[TextPart(f"Label: {prompt}")])
+
+    return FunctionModel(echo)
+
+
+@pytest.mark.agent_run
+async def test_run_batch():
+    counter = BuildCounter()
+    agent = CRAgent(model)
+    agent.observers = [counter]
+    in_flight, peak = [0], [0]
+    prompts = [str(i) for i in range(20)]
+
+    results = [
+        result
+        async for result in agent.run_batch(prompts, guide=guide, concurrency=3, model=echo_model(in_flight, peak))
+    ]
+
+    assert sorted(result.index for result in results) == list(range(20))
+    assert all(result.output == f"Label: {result.index}" for result in results)
+    assert peak[0] == 3
+    assert counter.builds == 1
+    assert agent.model_settings is None
+
+
+@pytest.mark.agent_run
+async def test_run_batch_failures_do_not_stop_batch():
+    agent = CRAgent(model)
+    await agent.set_guide(guide)
+    results = {
+        result.index: result
+        async for result in agent.run_batch(["a", "fail", "b"], concurrency=2, model=echo_model([0], [0]))
+    }
+    assert results[0].output == "Label: a"
+    assert isinstance(results[1].error, RuntimeError)
+    with pytest.raises(RuntimeError, match="bad prompt"):
+        results[1].output
+    assert results[2].output == "Label: b"
+
+
+@pytest.mark.agent_run
+async def test_run_batch_stops_early():
+    agent = CRAgent(model)
+    read: list[int] = []
+
+    def prompts():
+        for i in range(1000):
+            read.append(i)
+            yield str(i)
+
+    first: BatchResult | None = None
+    async with aclosing(agent.run_batch(prompts(), guide=guide, concurrency=4, model=echo_model([0], [0]))) as results:
+        async for result in results:
+            first = result
+            break
+    assert first is not None
+    assert len(read) < 1000
+
+
+async def test_run_batch_concurrency_must_be_positive():
+    agent = CRAgent(model)
+    with pytest.raises(ValueError, match="concurrency"):
+        async for _ in agent.run_batch(["a"], guide=guide, concurrency=0):
+            pass
+
+
+async def test_warm_guides():
+    guides = [[Anchor("Label: "), Free(max_chars=10 + i)] for i in range(4)]
+    transport = ReplayTransport(["Label: spam"], guides=guides[:3], time_to_first_token=0.05)
+    client = AsyncOpenAI(api_key="...", base_url="http://replay/v1", http_client=httpx.AsyncClient(transport=transport))
+    agent = CRAgent(OpenAIChatModel("m", provider=OpenAIProvider(openai_client=client), profile=vllm_model_profile))
+
+    warmups = [warmup async for warmup in agent.warm_guides(guides, concurrency=4)]
+
+    assert sorted(warmup.index for warmup in warmups) == [0, 1, 2, 3]
+    by_index = {warmup.index: warmup for warmup in warmups}
+    assert all((by_index[i].latency_seconds or 0) >= 0.05 and by_index[i].error is None for i in range(3))
+    # the server rejected the grammar it did not know
+    assert isinstance(by_index[3].error, ModelHTTPError)
+    assert all(body["max_completion_tokens"] == 1 for body in transport.requests)
+
+
+async def test_warm_guides_rejects_invalid_concurrency():
+    with pytest.raises(ValueError, match="concurrency"):
+        async for _ in CRAgent(model).warm_guides([guide], concurrency=0):
+            pass
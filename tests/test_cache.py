@@ -0,0 +1,148 @@
+import copy
+import dataclasses
+import json
+import pickle
+
+import pytest
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import Anchor, Constrain, CRAgent, Free, GrammarCache, Think, UseTools, vllm_model_profile
+from cragents._cache import hash_generation_sequence
+from cragents._utils import make_guided_extra_body
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="..."),
+    profile=vllm_model_profile,
+)
+
+
+# ── hash_generation_sequence ───────────────────────────────────────────────────
+
+
+def test_hash_is_stable_for_equal_sequences():
+    first = [Think([Anchor("a "), Constrain(1, 2)]), UseTools(json_schema={"type": "string", "title": "x"})]
+    second = [Think([Anchor("a "), Constrain(1, 2)]), UseTools(json_schema={"title": "x", "type": "string"})]
+    assert hash_generation_sequence(first) == hash_generation_sequence(second)
+
+
+def test_hash_distinguishes_element_types_and_fields():
+    hashes = {
+        hash_generation_sequence([Anchor("a")]),
+        hash_generation_sequence([Anchor("b")]),
+        hash_generation_sequence([Free()]),
+        hash_generation_sequence([Think([Free()])]),
+        hash_generation_sequence([Constrain(1, 2)]),
+        hash_generation_sequence([Constrain(2, 1)]),
+        hash_generation_sequence([UseTools(json_schema={"type": "string"})]),
+        hash_generation_sequence([UseTools(json_schema={"type": "number"})]),
+    }
+    assert len(hashes) == 8
+
+
+# ── frozen elements ────────────────────────────────────────────────────────────
+
+
+def test_elements_are_frozen_and_hashable():
+    tools = UseTools(json_schema={"type": "object", "required": ["city"]}, tool_names=["weather"])
+    think = Think([Anchor("a "), Free(10)])
+    assert {think: 1, tools: 2}[Think([Anchor("a "), Free(10)])] == 1
+    assert hash(tools) == hash(UseTools(json_schema={"required": ["city"], "type": "object"}, tool_names=["weather"]))
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        tools.json_schema = {}  # type: ignore[misc]
+    assert tools.json_schema is not None
+    with pytest.raises(TypeError, match="immutable"):
+        tools.json_schema["type"] = "string"
+    with pytest.raises(TypeError, match="immutable"):
+        tools.json_schema["required"].append("country")
+    assert copy.deepcopy(tools) == tools
+    assert pickle.loads(pickle.dumps(tools)) == tools
+
+
+def test_equal_schemas_are_interned():
+    schema = {"type": "object", "properties": {"city": {"type": "string"}}}
+    first = UseTools(json_schema=schema)
+    second = UseTools(json_schema=dict(schema), tools={"weather": schema})
+    assert first.json_schema is second.json_schema
+    assert second.tools is not None and second.tools["weather"] is first.json_schema
+    assert json.loads(json.dumps(first.json_schema)) == schema
+
+
+def test_frozen_schemas_are_not_frozen_again():
+    tools = UseTools(tools={"weather": {"type": "object", "properties": {"city": {"type": "string"}}}})
+    assert tools.tools is not None
+    assert dataclasses.replace(tools, tool_names=["weather"]).tools is tools.tools
+
+
+def test_cache_tells_json_values_apart():
+    cache = GrammarCache()
+    make_guided_extra_body([UseTools(json_schema={"const": 1})], cache=cache)
+    grammar = make_guided_extra_body([UseTools(json_schema={"const": True})], cache=cache)
+    assert cache.misses == 2
+    assert '%json {"const": true}' in grammar["structured_outputs"]["grammar"]
+
+
+# ── GrammarCache ───────────────────────────────────────────────────────────────
+
+
+def test_cache_hit_returns_prebuilt_grammar():
+    cache = GrammarCache()
+    first = make_guided_extra_body([Anchor("hi")], cache=cache)
+    second = make_guided_extra_body([Anchor("hi")], cache=cache)
+    assert first["structured_outputs"]["grammar"] is second["structured_outputs"]["grammar"]
+    # each caller gets its own extra_body, so changing one does not change the cached guide
+    assert first is not second
+    first["chat_template_kwargs"]["enable_thinking"] = True
+    assert make_guided_extra_body([Anchor("hi")], cache=cache)["chat_template_kwargs"]["enable_thinking"] is False
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 1, 0)
+    assert second == make_guided_extra_body([Anchor("hi")])
+
+
+def test_cache_evicts_least_recently_used():
+    cache = GrammarCache(maxsize=2)
+    make_guided_extra_body([Anchor("a")], cache=cache)
+    make_guided_extra_body([Anchor("b")], cache=cache)
+    make_guided_extra_body([Anchor("a")], cache=cache)
+    make_guided_extra_body([Anchor("c")], cache=cache)
+    assert len(cache) == 2
+    assert cache.evictions == 1
+    make_guided_extra_body([Anchor("a")], cache=cache)
+    assert cache.hits == 2
+    make_guided_extra_body([Anchor("b")], cache=cache)
+    assert cache.misses == 4
+
+
+def test_cache_clear_resets_counters():
+    cache = GrammarCache()
+    make_guided_extra_body([Free()], cache=cache)
+    make_guided_extra_body([Free()], cache=cache)
+    cache.clear()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses, cache.evictions) == (0, 0, 0)
+
+
+def test_cache_rejects_invalid_maxsize():
+    with pytest.raises(ValueError, match="maxsize"):
+        GrammarCache(maxsize=0)
+
+
+# ── CRAgent integration ────────────────────────────────────────────────────────
+
+
+@pytest.mark.anyio
+async def test_set_guide_uses_agent_cache():
+    agent = CRAgent(model)
+    agent.grammar_cache = GrammarCache()
+    await agent.set_guide([Anchor("hi"), UseTools()])
+    await agent.set_guide([Anchor("hi"), UseTools()])
+    assert (agent.grammar_cache.hits, agent.grammar_cache.misses) == (1, 1)
+
+
+@pytest.mark.anyio
+async def test_set_guide_without_cache():
+    agent = CRAgent(model)
+    agent.grammar_cache = None
+    await agent.set_guide([Anchor("hi")])
+    assert agent.model_settings is not None
+    assert "hi" in agent.model_settings["extra_body"]["structured_outputs"]["grammar"]
@@ -0,0 +1,125 @@
+import pytest
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import (
+    Anchor,
+    Constrain,
+    CRAgent,
+    Free,
+    GuideChecker,
+    Think,
+    UseTools,
+    compile_guide,
+    vllm_model_profile,
+)
+from cragents._check import check_json_schema
+
+pytestmark = pytest.mark.anyio
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="..."),
+    profile=vllm_model_profile,
+)
+
+weather_schema = {
+    "type": "object",
+    "properties": {"city": {"type": "string"}, "days": {"type": "integer", "minimum": 1}},
+    "required": ["city"],
+    "additionalProperties": False,
+}
+
+
+def test_checker_matches_outputs():
+    checker = GuideChecker([Think([Anchor("I think "), Constrain(2, 2)]), Anchor("Answer: "), Free(max_chars=5)])
+    assert checker.matches("<think>\nI think it is. Yes.\n\nOk.\n\n</think>Answer: sunny")
+    # too many sentences in a paragraph
+    assert not checker.matches("<think>\nI think a. b. c.\n\n</think>Answer: sunny")
+    # too many characters
+    assert not checker.matches("<think>\nI think a.\n\n</think>Answer: sunny!")
+
+
+def test_checker_reports_position():
+    checker = GuideChecker([Anchor("Answer: "), Free()])
+    with pytest.raises(ValueError, match=r"at position 0: expected 'Answer: ', got 'Result: x'"):
+        checker.check("Result: x")
+
+
+def test_checker_tool_calls():
+    checker = GuideChecker([Free(), UseTools(json_schema=weather_schema, tool_names=["weather"])])
+    assert checker.matches('Let me check.<tool_call>{"name": "weather", "arguments": {"city": "Paris"}}\n</tool_call>')
+    assert not checker.matches('<tool_call>{"name": "news", "arguments": {"city": "Paris"}}\n</tool_call>')
+    with pytest.raises(ValueError, match="arguments/days violates minimum 1"):
+        checker.check('<tool_call>{"name": "weather", "arguments": {"city": "Paris", "days": 0}}\n</tool_call>')
+    with pytest.raises(ValueError, match="not valid JSON"):
+        checker.check('<tool_call>{"name": "weather", "arguments": {"city": }}\n</tool_call>')
+
+
+def test_checker_ties_tool_names_to_arguments():
+    checker = GuideChecker([UseTools(tools={"weather": weather_schema, "news": {"type": "object"}})])
+    assert checker.matches('<tool_call>{"name": "weather", "arguments": {"city": "Paris"}}\n</tool_call>')
+    assert checker.matches('<tool_call>{"name": "news", "arguments": {"topic": "rain"}}\n</tool_call>')
+    with pytest.raises(ValueError, match="arguments is missing required property 'city'"):
+        checker.check('<tool_call>{"name": "weather", "arguments": {"topic": "rain"}}\n</tool_call>')
+
+
+def test_checker_tool_choice_allows_json_whitespace():
+    # Lark writes a tool choice as one JSON object, so the whitespace between its keys is not fixed
+    checker = GuideChecker([UseTools(tools={"weather": weather_schema})])
+    assert checker.matches('<tool_call>{"name":"weather","arguments":{"city":"Paris"}}\n</tool_call>')
+    assert checker.matches('<tool_call>{ "name" : "weather",\n"arguments": {"city": "Paris"} }\n</tool_call>')
+    assert not checker.matches('<tool_call>{"arguments": {"city": "Paris"}, "name": "weather"}\n</tool_call>')
+    with pytest.raises(ValueError, match="names an unknown tool 'news'"):
+        checker.check('<tool_call>{"name": "news", "arguments": {}}\n</tool_call>')
+
+
+def test_checker_compiled_guide():
+    guide = compile_guide([Anchor("Answer: "), UseTools(json_schema=weather_schema)])
+    checker = GuideChecker(guide)
+    assert checker.matches('Answer: <tool_call>{"name": "any_tool", "arguments": {"city": "Rome"}}\n</tool_call>')
+
+
+def test_checker_rejects_invalid_guides():
+    with pytest.raises(ValueError, match="json_schema is required"):
+        GuideChecker([UseTools()])
+    with pytest.raises(ValueError, match="references undefined"):
+        GuideChecker([UseTools(json_schema=weather_schema, tool_name_regex="tool_name")])
+    with pytest.raises(ValueError, match="Unresolvable \\$ref '#/\\$defs/City'"):
+        GuideChecker([UseTools(json_schema={"anyOf": [{"$ref": "#/$defs/City"}]})])
+
+
+def test_check_json_schema():
+    check_json_schema({"$defs": {"A": {"type": ["string", "null"]}}, "items": {"$ref": "#/$defs/A"}})
+    with pytest.raises(ValueError, match="Unknown type 'str' at #/properties/x"):
+        check_json_schema({"properties": {"x": {"type": "str"}}})
+    with pytest.raises(ValueError, match="anyOf must be a list"):
+        check_json_schema({"anyOf": {"type": "string"}})
+    # every subschema keyword the schema tools know is checked
+    with pytest.raises(ValueError, match="Unknown type 'str' at #/dependentSchemas/x"):
+        check_json_schema({"dependentSchemas": {"x": {"type": "str"}}})
+    with pytest.raises(ValueError, match="Unknown type 'str' at #/items/1"):
+        check_json_schema({"items": [{"type": "string"}, {"type": "str"}]})
+
+
+def test_checker_one_of_needs_exactly_one_match():
+    schema = {"oneOf": [{"type": "integer"}, {"type": "number"}, {"type": "string"}]}
+    checker = GuideChecker([UseTools(tools={"pick": {"type": "object", "properties": {"x": schema}}})])
+    assert checker.matches('<tool_call>{"name": "pick", "arguments": {"x": "a"}}\n</tool_call>')
+    assert checker.matches('<tool_call>{"name": "pick", "arguments": {"x": 1.5}}\n</tool_call>')
+    with pytest.raises(ValueError, match="arguments/x matches 2 schemas in oneOf, exactly one must match"):
+        checker.check('<tool_call>{"name": "pick", "arguments": {"x": 1}}\n</tool_call>')
+    with pytest.raises(ValueError, match="matches 0 schemas in oneOf"):
+        checker.check('<tool_call>{"name": "pick", "arguments": {"x": null}}\n</tool_call>')
+
+
+async def test_agent_check_guide():
+    agent = CRAgent(model)
+
+    @agent.tool_plain
+    def weather(city: str) -> str:
+        return "sunny"
+
+    checker = await agent.check_guide([UseTools()])
+    assert checker.matches('<tool_call>{"name": "weather", "arguments": {"city": "Paris"}}\n</tool_call>')
+    assert not checker.matches('<tool_call>{"name": "weather", "arguments": {"town": "Paris"}}\n</tool_call>')
@@ -0,0 +1,191 @@
+from typing import Literal
+
+import pytest
+from inline_snapshot import snapshot
+from pydantic import BaseModel, Field
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import (
+    Anchor,
+    CompiledGuide,
+    Constrain,
+    CRAgent,
+    Free,
+    GBNFBackend,
+    GuideChecker,
+    GuidedModelProfile,
+    Think,
+    UseTools,
+    XGrammarBackend,
+    compile_guide,
+    llama_cpp_model_profile,
+    sglang_model_profile,
+    vllm_model_profile,
+)
+from cragents._gbnf import validate_gbnf
+from cragents._utils import build_grammar, make_guided_extra_body
+
+pytestmark = pytest.mark.anyio
+
+gbnf = GBNFBackend()
+
+
+class Location(BaseModel):
+    city: str
+    country: str | None = None
+    tags: list[str] = []
+
+
+class Tree(BaseModel):
+    kind: Literal["leaf", "node"]
+    name: str = Field(max_length=8)
+    children: list["Tree"] = Field(max_length=2)
+
+
+def json_lines(grammar: str) -> str:
+    return "\n".join(line for line in grammar.splitlines() if line.startswith("tool-schema"))
+
+
+def test_gbnf_think_and_constrain():
+    grammar = build_grammar(
+        [Think([Anchor("I think "), Constrain(2, 3, '.!-]"')]), Anchor('Say "hi"\n'), Free(max_chars=20)],
+        backend=gbnf,
+    )
+    assert grammar == snapshot("""\
+root ::= "<think>" "\\n" "I think " block-1 "</think>" "Say \\"hi\\"\\n" free-20
+block-1 ::= p-1{1,2}
+p-1 ::= s-1{1,3} "\\n\\n"
+s-1 ::= [^.!\\]"\\n-]+ ( "." | "!" | "-" | "]" | "\\"" )
+free-20 ::= [^\\x00]{0,20}
+free ::= [^\\x00]*\
+""")
+
+
+def test_gbnf_tool_call():
+    grammar = build_grammar([UseTools(json_schema=Location.model_json_schema(), tool_names=["weather"])], backend=gbnf)
+    assert "\n".join(grammar.splitlines()[:3]) == snapshot("""\
+root ::= "<tool_call>" tool-call "</tool_call>"
+tool-call ::= "{\\"name\\": \\"" function-name "\\", \\"arguments\\": " tool-schema "}\\n"
+function-name ::= ("weather")\
+""")
+    # optional properties keep schema order, with a comma before every property after the first
+    assert json_lines(grammar) == snapshot("""\
+tool-schema-1 ::= ( json-string | "null" )
+tool-schema-2 ::= "[" ws ( json-string ( "," ws json-string )* )? "]"
+tool-schema-3 ::= ( "," ws "\\"tags\\":" ws tool-schema-2 )?
+tool-schema-4 ::= ( "," ws "\\"country\\":" ws tool-schema-1 tool-schema-3 | tool-schema-3 )
+tool-schema ::= "{" ws "\\"city\\":" ws json-string tool-schema-4 "}"\
+""")
+
+
+def test_gbnf_tool_choice():
+    tools = {"weather": Location.model_json_schema(), "echo": {"type": "string"}}
+    grammar = build_grammar([UseTools(tools=tools)], backend=gbnf)
+    assert grammar.splitlines()[1] == snapshot(
+        'tool-call ::= "{\\"name\\": \\"weather\\", \\"arguments\\": " tool-args-1 "}\\n" | "{\\"name\\": \\"echo\\", \\"arguments\\": " tool-args-2 "}\\n"'
+    )
+    assert "tool-args-2 ::= json-string" in grammar
+    validate_gbnf(grammar)
+
+
+class Order(BaseModel):
+    ship_to: Location
+
+
+class Invoice(BaseModel):
+    bill_to: Location
+    total: float
+
+
+def test_gbnf_tool_choice_shares_definitions():
+    tools = {"order": Order.model_json_schema(), "invoice": Invoice.model_json_schema()}
+    grammar = build_grammar([UseTools(tools=tools)], backend=gbnf)
+    # the location rule is written once and used by both tools
+    assert [line.split(" ::= ")[0] for line in grammar.splitlines() if "Location ::=" in line] == [
+        "tool-args-1-1-Location"
+    ]
+    assert "tool-args-2 ::= " in grammar and grammar.count("tool-args-1-1-Location") == 3
+    validate_gbnf(grammar)
+
+
+def test_gbnf_tool_choice_keeps_json_values_apart():
+    def tool(value: object) -> dict[str, object]:
+        return {"properties": {"x": {"$ref": "#/$defs/X"}}, "required": ["x"], "$defs": {"X": {"const": value}}}
+
+    grammar = build_grammar([UseTools(tools={"a": tool(1), "b": tool(True)})], backend=gbnf)
+    assert 'tool-args-1-1-X ::= "1"' in grammar
+    assert 'tool-args-2-1-X-2 ::= "true"' in grammar
+
+
+def test_gbnf_recursive_schema():
+    grammar = build_grammar([UseTools(json_schema=Tree.model_json_schema())], backend=gbnf)
+    assert json_lines(grammar) == snapshot("""\
+tool-schema-2 ::= ( "\\"leaf\\"" | "\\"node\\"" )
+tool-schema-3 ::= "\\"" json-char{0,8} "\\""
+tool-schema-4 ::= "[" ws ( tool-schema-1-Tree ( "," ws tool-schema-1-Tree ){0,1} )? "]"
+tool-schema-1-Tree ::= "{" ws "\\"kind\\":" ws tool-schema-2 "," ws "\\"name\\":" ws tool-schema-3 "," ws "\\"children\\":" ws tool-schema-4 "}"
+tool-schema ::= tool-schema-1-Tree\
+""")
+
+
+def test_gbnf_tool_name_regex():
+    grammar = build_grammar([UseTools(json_schema={}, tool_name_regex="/get_[a-z]+/")], backend=gbnf)
+    assert 'function-name ::= "g" "e" "t" "_" [a-z]+' in grammar
+    with pytest.raises(ValueError, match="use tool_names instead"):
+        build_grammar([UseTools(json_schema={}, tool_name_regex="/(a|b)/")], backend=gbnf)
+
+
+def test_gbnf_rejects_unsupported_schema():
+    with pytest.raises(ValueError, match="'pattern' can not be written in GBNF"):
+        build_grammar([UseTools(json_schema={"type": "string", "pattern": "^a$"})], backend=gbnf)
+
+
+def test_validate_gbnf():
+    validate_gbnf('root ::= "a" rule-1\nrule-1 ::= [a-z]{1,2}')
+    with pytest.raises(ValueError, match="references undefined 'rule-2'"):
+        validate_gbnf('root ::= "a" rule-2')
+    with pytest.raises(ValueError, match="no root rule"):
+        validate_gbnf('rule-1 ::= "a"')
+
+
+def test_backend_extra_body():
+    sequence = [Think([Anchor("I think "), Free()]), Free()]
+    llama_cpp = make_guided_extra_body(sequence, backend=gbnf, prefill=True)
+    assert llama_cpp["grammar"] == build_grammar(sequence, backend=gbnf, prefill=True)
+    assert llama_cpp["cragents_prefill"] == "<think>\nI think "
+    # llama.cpp continues a final assistant message without being asked
+    assert "continue_final_message" not in llama_cpp
+    assert "structured_outputs" not in llama_cpp
+
+    sglang = make_guided_extra_body(sequence, backend=XGrammarBackend(), prefill=True)
+    assert sglang["ebnf"] == llama_cpp["grammar"]
+    assert sglang["continue_final_message"] is True
+
+
+def test_compiled_guide_backend():
+    guide = compile_guide([Anchor("Answer: "), Free()], backend=gbnf)
+    assert guide.metadata["backend"] == "llama_cpp"
+    assert guide.extra_body["grammar"] == guide.grammar
+    assert CompiledGuide.from_dict(guide.to_dict()) == guide
+    # same grammar text, sent to a different server
+    assert compile_guide([Anchor("Answer: "), Free()], backend=XGrammarBackend()) != guide
+
+
+async def test_agent_uses_profile_backend():
+    def agent_for(profile: GuidedModelProfile) -> CRAgent[None, str]:
+        provider = OpenAIProvider(api_key="...", base_url="...")
+        return CRAgent(OpenAIChatModel(model_name="...", provider=provider, profile=profile))
+
+    sequence = [Anchor("Answer: "), Constrain(1, 1)]
+    assert "structured_outputs" in await agent_for(vllm_model_profile).build_guide(sequence)
+    assert (await agent_for(llama_cpp_model_profile).build_guide(sequence))["grammar"].startswith("root ::= ")
+    sglang = agent_for(sglang_model_profile)
+    assert (await sglang.compile_guide(sequence)).metadata["backend"] == "sglang"
+    with pytest.raises(ValueError, match="compiled for the 'vllm' grammar backend, the model uses 'sglang'"):
+        await sglang.build_guide(compile_guide(sequence))
+
+
+def test_checker_validates_compiled_gbnf():
+    guide = compile_guide([Anchor("Answer: "), Constrain(1, 1)], backend=gbnf)
+    assert GuideChecker(guide).matches("Answer: Yes.\n\n")
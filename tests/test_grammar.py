@@ -1,7 +1,12 @@
+import json
+import warnings
+from typing import Any
+
+import pytest
 from inline_snapshot import snapshot
 
-from cragents import Anchor, Constrain, Free, Think, UseTools
-from cragents._utils import build_grammar, make_guided_extra_body
+from cragents import Anchor, Constrain, Free, GrammarBudget, GrammarCache, GrammarStats, Think, UseTools
+from cragents._utils import build_grammar, grammar_stats, make_guided_extra_body, minimization_stats
 
 # ── build_grammar ──────────────────────────────────────────────────────────────
 
@@ -17,7 +22,7 @@ NL: /\\n/""")
 def test_grammar_multiple_anchors():
     grammar = build_grammar([Anchor("foo "), Anchor("bar ")])
     assert grammar == snapshot("""\
-start: "foo " "bar "
+start: "foo bar "
 FREE: /[\\S\\s]*/
 NL: /\\n/\
 """)
@@ -202,6 +207,110 @@ FREE: /[\\S\\s]*/
 NL: /\\n/""")
 
 
+def test_grammar_identical_constrains_share_rules():
+    grammar = build_grammar([Constrain(1, 1), Think([Constrain(1, 1), Constrain(2, 3)]), Constrain(2, 3)])
+    assert grammar == snapshot("""\
+start: block_1 <think> NL block_1 block_2 </think> block_2
+block_1: p_1{1,1}
+p_1: s_1{1,1} NL NL
+s_1[lazy]: /[^\\.\\n]+/ ( "." )
+block_2: p_2{1,2}
+p_2: s_2{1,3} NL NL
+s_2[lazy]: /[^\\.\\n]+/ ( "." )
+FREE: /[\\S\\s]*/
+NL: /\\n/\
+""")
+
+
+def test_grammar_identical_use_tools_share_rules():
+    use_tools = UseTools(json_schema={"type": "string"})
+    grammar = build_grammar([use_tools, Anchor("then "), use_tools])
+    assert grammar == snapshot("""\
+start: <tool_call> tool_call </tool_call> "then " <tool_call> tool_call </tool_call>
+tool_call: "{\\"name\\": \\"" FUNCTION_NAME "\\", \\"arguments\\": " tool_schema "}\\n"
+tool_schema: %json {"type": "string"}
+FUNCTION_NAME: /[a-zA-Z0-9_]+/
+FREE: /[\\S\\s]*/
+NL: /\\n/\
+""")
+
+
+def test_grammar_different_use_tools_get_own_rules():
+    grammar = build_grammar(
+        [UseTools(json_schema={"type": "string"}), UseTools(json_schema={"type": "string"}, tool_names=["a"])]
+    )
+    assert grammar == snapshot("""\
+start: <tool_call> tool_call </tool_call> <tool_call> tool_call_2 </tool_call>
+tool_call: "{\\"name\\": \\"" FUNCTION_NAME "\\", \\"arguments\\": " tool_schema "}\\n"
+tool_schema: %json {"type": "string"}
+FUNCTION_NAME: /[a-zA-Z0-9_]+/
+tool_call_2: "{\\"name\\": \\"" FUNCTION_NAME_2 "\\", \\"arguments\\": " tool_schema_2 "}\\n"
+tool_schema_2: %json {"type": "string"}
+FUNCTION_NAME_2: ("a")
+FREE: /[\\S\\s]*/
+NL: /\\n/\
+""")
+
+
+def test_grammar_use_tools_ties_names_to_arguments():
+    tools = {"search": {"type": "string"}, "fetch": {"type": "integer"}, "find": {"type": "string"}}
+    grammar = build_grammar([UseTools(tools=tools)])
+    assert grammar == snapshot("""\
+start: <tool_call> tool_call </tool_call>
+tool_call: tool_object "\\n"
+tool_object: %json {"anyOf": [{"type": "object", "properties": {"name": {"enum": ["search", "find"]}, "arguments": {"type": "string"}}, "required": ["name", "arguments"], "additionalProperties": false}, {"type": "object", "properties": {"name": {"const": "fetch"}, "arguments": {"type": "integer"}}, "required": ["name", "arguments"], "additionalProperties": false}]}
+FREE: /[\\S\\s]*/
+NL: /\\n/\
+""")
+    # tool_names and tool_name_regex narrow the tools
+    assert build_grammar([UseTools(tools=tools, tool_names=["fetch"])]).splitlines()[1:3] == snapshot(
+        [
+            'tool_call: tool_object "\\n"',
+            'tool_object: %json {"type": "object", "properties": {"name": {"const": "fetch"}, "arguments": {"type": "integer"}}, "required": ["name", "arguments"], "additionalProperties": false}',
+        ]
+    )
+    assert "fetch" not in build_grammar([UseTools(tools=tools, tool_name_regex="/s.*/")])
+    with pytest.raises(ValueError, match="allows none of its tools"):
+        build_grammar([UseTools(tools=tools, tool_names=["other"])])
+
+
+def test_grammar_tools_share_defs():
+    address = {
+        "type": "object",
+        "properties": {f"field_{i}": {"type": "string", "description": f"Line {i} of the address."} for i in range(40)},
+    }
+
+    def tools(count: int) -> dict[str, dict[str, Any]]:
+        return {
+            f"tool_{i}": {
+                "type": "object",
+                "properties": {f"arg_{i}": {"$ref": "#/$defs/Address"}},
+                "$defs": {"Address": address},
+            }
+            for i in range(count)
+        }
+
+    one, many = build_grammar([UseTools(tools=tools(1))]), build_grammar([UseTools(tools=tools(20))])
+    # the model is written once, each more tool only adds its own branch
+    assert many.count("Line 0 of the address.") == 1
+    assert len(many) < 3 * len(one)
+    call = json.loads(many.splitlines()[2].removeprefix("tool_object: %json "))
+    assert list(call["$defs"]) == ["Address"]
+    assert call["anyOf"][19]["properties"]["arguments"]["properties"] == {"arg_19": {"$ref": "#/$defs/Address"}}
+
+
+def test_grammar_tools_with_outside_refs_keep_own_schema():
+    # a reference to the arguments root would resolve to the tool call object, so each tool keeps its schema
+    tools = {"tree": {"type": "object", "properties": {"child": {"$ref": "#"}}}, "leaf": {"type": "string"}}
+    assert build_grammar([UseTools(tools=tools)]).splitlines()[1:4] == snapshot(
+        [
+            'tool_call: "{\\"name\\": \\"tree\\", \\"arguments\\": " tool_args_1 "}\\n" | "{\\"name\\": \\"leaf\\", \\"arguments\\": " tool_args_2 "}\\n"',
+            'tool_args_1: %json {"type": "object", "properties": {"child": {"$ref": "#"}}}',
+            'tool_args_2: %json {"type": "string"}',
+        ]
+    )
+
+
 # ── make_guided_extra_body ─────────────────────────────────────────────────────
 
 
@@ -221,3 +330,132 @@ def test_extra_body_disable_thinking_and_prompt():
     extra_body = make_guided_extra_body([Free()])
     assert extra_body["chat_template_kwargs"]["add_generation_prompt"] is False
     assert extra_body["chat_template_kwargs"]["enable_thinking"] is False
+
+
+# ── minimization and budget ────────────────────────────────────────────────────
+
+described_schema = {
+    "type": "object",
+    "title": "Args",
+    "description": "A long description that does not constrain anything at all.",
+    "properties": {"x": {"type": "integer", "title": "X", "examples": [1, 2, 3]}},
+}
+
+
+def test_grammar_stats():
+    stats = grammar_stats(build_grammar([Anchor("héllo ")]))
+    assert stats == GrammarStats(size_bytes=len(build_grammar([Anchor("héllo ")]).encode()), rule_count=3)
+
+
+def test_minimization_stats():
+    before, after = minimization_stats([UseTools(json_schema=described_schema)])
+    assert after.size_bytes < before.size_bytes
+    assert after.rule_count == before.rule_count
+
+
+def test_extra_body_minimize():
+    extra_body = make_guided_extra_body([UseTools(json_schema=described_schema)], minimize=True)
+    assert extra_body["structured_outputs"]["grammar"] == build_grammar(
+        [UseTools(json_schema={"type": "object", "properties": {"x": {"type": "integer"}}})]
+    )
+
+
+def test_extra_body_budget_warns():
+    with pytest.warns(UserWarning, match="Grammar exceeds budget: 3 rules > 2"):
+        make_guided_extra_body([Anchor("hi")], budget=GrammarBudget(max_rules=2))
+
+
+def test_extra_body_budget_raises_with_stats_before_minimization():
+    budget = GrammarBudget(max_bytes=10, on_exceed="raise")
+    with pytest.raises(ValueError, match="bytes > 10. Before minimization: .* bytes, 6 rules"):
+        make_guided_extra_body([UseTools(json_schema=described_schema)], minimize=True, budget=budget)
+
+
+def test_extra_body_budget_checked_on_cache_hits():
+    cache = GrammarCache()
+    make_guided_extra_body([Anchor("hi")], cache=cache)
+    with pytest.warns(UserWarning, match="Grammar exceeds budget: 3 rules > 2"):
+        make_guided_extra_body([Anchor("hi")], cache=cache, budget=GrammarBudget(max_rules=2))
+    assert cache.hits == 1
+    with pytest.raises(ValueError, match="3 rules > 2"):
+        make_guided_extra_body([Anchor("hi")], cache=cache, budget=GrammarBudget(max_rules=2, on_exceed="raise"))
+    assert cache.hits == 2
+
+
+def test_extra_body_within_budget():
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        make_guided_extra_body([Anchor("hi")], budget=GrammarBudget(max_bytes=1000, max_rules=3))
+
+
+def test_cache_key_includes_build_options():
+    cache = GrammarCache()
+    plain = make_guided_extra_body([UseTools(json_schema=described_schema)], cache=cache)
+    minimized = make_guided_extra_body([UseTools(json_schema=described_schema)], cache=cache, minimize=True)
+    assert plain != minimized
+    assert cache.misses == 2
+
+
+# ── bounded Free ───────────────────────────────────────────────────────────────
+
+
+def test_grammar_bounded_free():
+    grammar = build_grammar([Anchor("Result: "), Free(max_chars=200)])
+    assert grammar == snapshot("""\
+start: "Result: " FREE_200
+FREE_200: /[\\S\\s]{0,200}/
+FREE: /[\\S\\s]*/
+NL: /\\n/\
+""")
+
+
+def test_grammar_bounded_free_in_think_shares_terminal():
+    grammar = build_grammar(
+        [Think([Free(max_chars=50), Anchor(" so "), Free(max_chars=50)]), Free(max_chars=10), Free()]
+    )
+    assert grammar == snapshot("""\
+start: <think> NL FREE_50 " so " FREE_50 </think> FREE_10 FREE
+FREE_50: /[\\S\\s]{0,50}/
+FREE_10: /[\\S\\s]{0,10}/
+FREE: /[\\S\\s]*/
+NL: /\\n/\
+""")
+
+
+def test_free_rejects_negative_max_chars():
+    with pytest.raises(ValueError, match="max_chars"):
+        Free(max_chars=-1)
+
+
+# ── passes and validation ──────────────────────────────────────────────────────
+
+
+def test_grammar_folds_empty_elements():
+    grammar = build_grammar(
+        [Anchor("a"), Anchor(""), Constrain(max_newlines=0, max_char_captures=3), Free(max_chars=0), Anchor("b")]
+    )
+    assert grammar == snapshot("""\
+start: "ab"
+FREE: /[\\S\\s]*/
+NL: /\\n/\
+""")
+
+
+def test_grammar_escapes_anchor_text():
+    grammar = build_grammar([Anchor('say "hi"\n')])
+    assert grammar.splitlines()[0] == 'start: "say \\"hi\\"\\n"'
+
+
+def test_grammar_rejects_undefined_tool_name_rule():
+    with pytest.raises(ValueError, match="references undefined 'foo'"):
+        build_grammar([UseTools(tool_name_regex="foo")])
+
+
+def test_grammar_rejects_empty_chars_to_capture():
+    with pytest.raises(ValueError, match="chars_to_capture must not be empty"):
+        build_grammar([Constrain(2, 2, chars_to_capture="")])
+
+
+def test_grammar_rejects_token_with_space():
+    with pytest.raises(ValueError, match="Invalid special token"):
+        build_grammar([Think([Free()], start_token="<th ink>")])
@@ -0,0 +1,112 @@
+import json
+from pathlib import Path
+
+import pytest
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import (
+    Anchor,
+    CompiledGuide,
+    Constrain,
+    CRAgent,
+    Free,
+    Think,
+    UseTools,
+    compile_guide,
+    load_guides,
+    save_guides,
+    vllm_model_profile,
+)
+from cragents._utils import build_grammar, make_guided_extra_body
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="..."),
+    profile=vllm_model_profile,
+)
+
+generation_sequence = [
+    Think([Anchor("I think "), Constrain(1, 2), Free()], start_token="<t>"),
+    Anchor("Response: "),
+    UseTools(json_schema={"type": "object", "title": "Args"}, tool_names=["a", "b"]),
+]
+
+
+def test_compile_guide():
+    guide = compile_guide(generation_sequence)
+    assert guide.grammar == build_grammar(generation_sequence)
+    assert guide.extra_body == make_guided_extra_body(generation_sequence)
+    assert guide.metadata["grammar_bytes"] == len(guide.grammar.encode())
+    assert guide.metadata["minimized"] is False
+    assert len(guide.hash) == 64
+
+
+def test_compile_guide_is_hashable_and_immutable():
+    first = compile_guide(generation_sequence)
+    second = compile_guide(list(generation_sequence))
+    assert first == second
+    assert len({first, second}) == 1
+    assert first != compile_guide(generation_sequence, minimize=True)
+    with pytest.raises(AttributeError):
+        first.grammar = ""  # type: ignore[misc]
+    with pytest.raises(TypeError):
+        first.metadata["minimized"] = True  # type: ignore[index]
+
+
+def test_compile_guide_requires_resolved_tool_schema():
+    with pytest.raises(ValueError, match="UseTools json_schema is required"):
+        compile_guide([UseTools()])
+
+
+def test_round_trip(tmp_path: Path):
+    guides = {"full": compile_guide(generation_sequence), "short": compile_guide([Anchor("hi"), Free()])}
+    path = tmp_path / "guides.json"
+    save_guides(path, guides)
+    loaded = load_guides(path)
+    assert loaded == guides
+    assert loaded["full"].generation_sequence == tuple(generation_sequence)
+    assert loaded["full"].metadata == guides["full"].metadata
+
+
+def test_load_rejects_tampered_grammar():
+    data = compile_guide([Anchor("hi")]).to_dict()
+    data["grammar"] += "\nEXTRA: /x/"
+    with pytest.raises(ValueError, match="does not match its hash"):
+        CompiledGuide.from_dict(data)
+
+
+def test_load_rejects_unknown_format():
+    data = compile_guide([Anchor("hi")]).to_dict()
+    with pytest.raises(ValueError, match="Not a cragents.guide v1 document"):
+        CompiledGuide.from_dict({**data, "format_version": 2})
+
+
+def test_load_rejects_unknown_element():
+    data = json.loads(json.dumps(compile_guide([Anchor("hi")]).to_dict()))
+    data["generation_sequence"][0]["type"] = "Nope"
+    with pytest.raises(ValueError, match="Unknown generation sequence element type: 'Nope'"):
+        CompiledGuide.from_dict(data)
+
+
+@pytest.mark.anyio
+async def test_agent_compile_guide_resolves_tools():
+    agent = CRAgent(model)
+
+    @agent.tool_plain
+    def my_tool(x: int) -> str:
+        return str(x)
+
+    guide = await agent.compile_guide([Anchor("hi "), UseTools()])
+    assert '"x"' in guide.grammar
+    assert await agent.build_guide(guide) == await agent.build_guide([Anchor("hi "), UseTools()])
+
+
+@pytest.mark.anyio
+async def test_set_guide_with_compiled_guide():
+    agent = CRAgent(model)
+    guide = compile_guide([Anchor("hi ")])
+    await agent.set_guide(guide)
+    assert agent.model_settings == {"extra_body": guide.extra_body}
+    settings = await agent.guide_settings(guide)
+    assert settings["extra_body"] == guide.extra_body
@@ -0,0 +1,136 @@
+import anyio
+import httpx
+import pytest
+from pydantic_ai import ModelMessage, ModelResponse, TextPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import (
+    Anchor,
+    Constrain,
+    CRAgent,
+    Free,
+    GuideLadder,
+    GuideSegment,
+    Think,
+    VLLMMetricsLoad,
+    compile_guide,
+    vllm_model_profile,
+)
+
+pytestmark = pytest.mark.anyio
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="..."),
+    profile=vllm_model_profile,
+)
+
+full = compile_guide([Think([Free()]), Anchor("Answer: "), Free()])
+light = compile_guide([Anchor("Answer: "), Constrain(1, 1)])
+
+metrics = """\
+# HELP vllm:num_requests_waiting Number of requests waiting to be processed.
+# TYPE vllm:num_requests_waiting gauge
+vllm:num_requests_waiting{engine="0",model_name="qwen"} 3.0
+vllm:num_requests_waiting{engine="1",model_name="qwen"} 4.0
+vllm:num_requests_running{engine="0",model_name="qwen"} 12.0
+"""
+
+
+def answer(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+    grammar = info.model_settings["extra_body"]["structured_outputs"]["grammar"]  # pyright: ignore
+    return ModelResponse(parts=[TextPart("full" if grammar == full.grammar else "light")])
+
+
+async def test_ladder_thresholds():
+    load = 0.0
+    ladder = GuideLadder([full, light, [Free()]], thresholds=[4, 8], load=lambda: load)
+    for load, expected in [(0, 0), (3.9, 0), (4, 1), (7, 1), (8, 2), (100, 2)]:
+        assert await ladder.select() == expected
+    async with ladder.rung() as guide:
+        assert guide == [Free()]
+        assert ladder.in_flight == 1
+    assert ladder.in_flight == 0
+    assert ladder.selections == [0, 0, 1]
+
+
+def test_ladder_rejects_bad_thresholds():
+    with pytest.raises(ValueError, match="one fewer"):
+        GuideLadder([full, light], thresholds=[])
+    with pytest.raises(ValueError, match="increasing"):
+        GuideLadder([full, light, light], thresholds=[5, 1])
+
+
+async def test_vllm_metrics_load():
+    scrapes: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        scrapes.append(str(request.url))
+        return httpx.Response(200, text=metrics)
+
+    load = VLLMMetricsLoad("http://vllm/metrics", client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    assert await load() == 7
+    assert await load() == 7
+    # reused until it is too old
+    assert scrapes == ["http://vllm/metrics"]
+    assert VLLMMetricsLoad("", metrics=["vllm:num_requests_running", "vllm:num_requests_waiting"]).parse(metrics) == 19
+
+
+async def test_vllm_metrics_load_keeps_last_value_on_error():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(503)
+
+    load = VLLMMetricsLoad("http://vllm/metrics", client=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    with pytest.warns(UserWarning, match="Failed to read vLLM metrics"):
+        assert await load() == 0
+
+
+async def test_vllm_metrics_load_closes_its_client(monkeypatch: pytest.MonkeyPatch):
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, text=metrics))
+    async_client = httpx.AsyncClient
+    monkeypatch.setattr(httpx, "AsyncClient", lambda: async_client(transport=transport))
+    async with VLLMMetricsLoad("http://vllm/metrics") as load:
+        assert await load() == 7
+        client = load.client
+    assert client is not None and client.is_closed
+    assert load.client is None
+    # a client that is passed in belongs to the caller
+    passed = async_client(transport=transport)
+    async with VLLMMetricsLoad("http://vllm/metrics", client=passed) as load:
+        assert await load() == 7
+    assert not passed.is_closed
+    await passed.aclose()
+
+
+@pytest.mark.agent_run
+async def test_agent_ladder_sheds_load_in_batch():
+    async def slow_answer(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        await anyio.sleep(0.01)
+        return answer(messages, info)
+
+    agent = CRAgent(model)
+    # the default load is the number of runs in flight
+    agent.guide_ladder = GuideLadder([full, light], thresholds=[2])
+    outputs = [
+        item.output async for item in agent.run_batch(["a", "b", "c"], concurrency=3, model=FunctionModel(slow_answer))
+    ]
+    assert sorted(outputs) == ["full", "full", "light"]
+    assert agent.guide_ladder.in_flight == 0
+
+
+@pytest.mark.agent_run
+async def test_agent_ladder_stream_segments():
+    agent = CRAgent(model)
+    agent.guide_ladder = GuideLadder([full, light], thresholds=[1], load=lambda: 5)
+    segments = [
+        event
+        async for event in agent.run_stream_segments("hi", model=FunctionModel(stream_function=stream_light))
+        if isinstance(event, GuideSegment)
+    ]
+    assert segments == [GuideSegment("anchor", "Answer: ", 0), GuideSegment("constrain", "Short.\n\n", 1)]
+
+
+async def stream_light(messages: list[ModelMessage], info: AgentInfo):
+    yield "Answer: Short.\n\n"
@@ -0,0 +1,111 @@
+from collections.abc import AsyncIterator
+
+import pytest
+from pydantic_ai import ModelMessage
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import (
+    Anchor,
+    Constrain,
+    CRAgent,
+    Free,
+    GrammarCache,
+    GuideBuildMetrics,
+    GuideObserver,
+    GuideRunMetrics,
+    GuideSegment,
+    SegmentMetrics,
+    UseTools,
+    compile_guide,
+    vllm_model_profile,
+)
+
+pytestmark = pytest.mark.anyio
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="..."),
+    profile=vllm_model_profile,
+)
+
+
+class RecordingObserver(GuideObserver):
+    def __init__(self) -> None:
+        self.builds: list[GuideBuildMetrics] = []
+        self.runs: list[GuideRunMetrics] = []
+
+    def guide_built(self, metrics: GuideBuildMetrics) -> None:
+        self.builds.append(metrics)
+
+    def run_finished(self, metrics: GuideRunMetrics) -> None:
+        self.runs.append(metrics)
+
+
+def make_agent() -> tuple[CRAgent[None, str], RecordingObserver]:
+    observer = RecordingObserver()
+    agent = CRAgent(model)
+    agent.grammar_cache = GrammarCache()
+    agent.observers = [observer]
+
+    @agent.tool_plain
+    def weather(city: str) -> str:
+        return "sunny"
+
+    return agent, observer
+
+
+async def test_build_metrics():
+    agent, observer = make_agent()
+    generation_sequence = [Anchor("Answer: "), UseTools()]
+    await agent.set_guide(generation_sequence)
+    await agent.guide_settings(generation_sequence)
+
+    first, second = observer.builds
+    assert first.cache_hit is False
+    assert second.cache_hit is True
+    assert first.grammar.size_bytes == len(agent.model_settings["extra_body"]["structured_outputs"]["grammar"])  # pyright: ignore
+    assert first.toolsets_seconds > 0
+    assert first.schema_seconds > 0
+    assert first.total_seconds >= first.grammar_seconds
+
+
+async def test_build_metrics_without_cache():
+    agent, observer = make_agent()
+    agent.grammar_cache = None
+    await agent.build_guide([UseTools()])
+    await agent.build_guide(compile_guide([Free()]))
+    assert [metrics.cache_hit for metrics in observer.builds] == [None, None]
+    assert observer.builds[1].toolsets_seconds == 0
+
+
+def test_segment_metrics():
+    assert SegmentMetrics.from_segment(GuideSegment("constrain", "a.\n\nb.\n\n", 1)) == SegmentMetrics(
+        "constrain", 1, None, 8, 2
+    )
+    assert SegmentMetrics.from_segment(GuideSegment("free", "a.\n\nb.\n\n", 2, 0)).paragraphs == 0
+
+
+@pytest.mark.agent_run
+async def test_run_metrics():
+    async def stream_answer(messages: list[ModelMessage], info: AgentInfo) -> AsyncIterator[str]:
+        for chunk in ["Answer: ", "It is sunny.\n\n", "Really sunny.\n\n", "Done: ", "bye"]:
+            yield chunk
+
+    agent, observer = make_agent()
+    await agent.set_guide([Anchor("Answer: "), Constrain(2, 1), Anchor("Done: "), Free()])
+    async for _ in agent.run_stream_segments("hi", model=FunctionModel(stream_function=stream_answer)):
+        pass
+
+    (metrics,) = observer.runs
+    assert metrics.build == observer.builds[0]
+    assert metrics.responses == 1
+    assert metrics.constrain_paragraphs == 2
+    assert metrics.thinking_chars == 0
+    assert metrics.segments == (
+        SegmentMetrics("anchor", 0, None, 8, 0),
+        SegmentMetrics("constrain", 1, None, 29, 2),
+        SegmentMetrics("anchor", 2, None, 6, 0),
+        SegmentMetrics("free", 3, None, 3, 0),
+    )
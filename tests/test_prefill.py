@@ -0,0 +1,145 @@
+import dataclasses
+import json
+from typing import Any
+
+import httpx
+import pytest
+from openai import AsyncOpenAI
+from pydantic_ai import ModelResponse, TextPart, ThinkingPart
+from pydantic_ai.models.openai import OpenAIChatModel, OpenAIStreamedResponse
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import (
+    Anchor,
+    CompiledGuide,
+    Constrain,
+    CRAgent,
+    Free,
+    GuideSegment,
+    PrefillChatModel,
+    Think,
+    compile_guide,
+    vllm_model_profile,
+)
+from cragents._utils import make_guided_extra_body
+
+pytestmark = pytest.mark.anyio
+
+generation_sequence = [Think([Anchor("I think "), Constrain(1, 2)]), Anchor("Answer: "), Free()]
+completion = "it is.\n\n</think>Answer: sunny"
+
+
+def make_agent(requests: list[dict[str, Any]], stream: bool) -> CRAgent[None, str]:
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(json.loads(request.content))
+        if not stream:
+            message = {"role": "assistant", "content": completion}
+            return httpx.Response(
+                200,
+                json={
+                    "id": "1",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": "m",
+                    "choices": [{"index": 0, "finish_reason": "stop", "message": message}],
+                },
+            )
+        chunks = [
+            {
+                "id": "1",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "m",
+                "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+            }
+            for content in ["it is.\n\n", "</think>", "Answer: ", "sunny"]
+        ]
+        body = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks) + "data: [DONE]\n\n"
+        return httpx.Response(200, text=body, headers={"content-type": "text/event-stream"})
+
+    client = AsyncOpenAI(
+        api_key="...", base_url="http://vllm/v1", http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    model = PrefillChatModel("m", provider=OpenAIProvider(openai_client=client), profile=vllm_model_profile)
+    agent = CRAgent(model)
+    agent.prefill_guide_prefix = True
+    return agent
+
+
+def test_prefill_pydantic_ai_hooks_exist():
+    # PrefillChatModel overrides private pydantic-ai hooks, fail loudly here rather than silently stop prefilling
+    hooks = [
+        (OpenAIChatModel, "_process_response"),
+        (OpenAIChatModel, "_streamed_response_cls"),
+        (OpenAIStreamedResponse, "_validate_response"),
+    ]
+    for cls, name in hooks:
+        assert hasattr(cls, name), f"pydantic-ai no longer has {cls.__name__}.{name}, which PrefillChatModel overrides"
+    fields = {field.name for field in dataclasses.fields(OpenAIStreamedResponse)}
+    assert "_model_profile" in fields, "pydantic-ai no longer has OpenAIStreamedResponse._model_profile"
+
+
+def test_prefill_extra_body():
+    extra_body = make_guided_extra_body(generation_sequence, prefill=True)
+    assert extra_body["cragents_prefill"] == "<think>\nI think "
+    assert extra_body["continue_final_message"] is True
+    assert extra_body["structured_outputs"]["grammar"].splitlines()[0] == 'start: block_1 </think> "Answer: " FREE'
+    # nothing to prefill
+    assert "cragents_prefill" not in make_guided_extra_body([Free(), Anchor("x")], prefill=True)
+
+
+@pytest.mark.agent_run
+async def test_prefill_request():
+    requests: list[dict[str, Any]] = []
+    agent = make_agent(requests, stream=False)
+    await agent.set_guide(generation_sequence)
+    result = await agent.run("weather?")
+
+    (body,) = requests
+    assert body["messages"][-1] == {"role": "assistant", "content": "<think>\nI think "}
+    assert body["continue_final_message"] is True
+    assert "cragents_prefill" not in body
+    assert result.output == "Answer: sunny"
+    response = result.all_messages()[-1]
+    assert isinstance(response, ModelResponse)
+    assert [type(part) for part in response.parts] == [ThinkingPart, TextPart]
+    assert response.parts[0].content == "\nI think it is.\n\n"  # pyright: ignore[reportAttributeAccessIssue]
+
+
+@pytest.mark.agent_run
+async def test_prefill_stream_segments():
+    requests: list[dict[str, Any]] = []
+    agent = make_agent(requests, stream=True)
+    segments = [
+        event
+        async for event in agent.run_stream_segments("weather?", guide=generation_sequence)
+        if isinstance(event, GuideSegment)
+    ]
+    assert requests[0]["messages"][-1] == {"role": "assistant", "content": "<think>\nI think "}
+    assert segments == [
+        GuideSegment("anchor", "I think ", 0, 0),
+        GuideSegment("constrain", "it is.\n\n", 0, 1),
+        GuideSegment("think", "I think it is.\n\n", 0),
+        GuideSegment("anchor", "Answer: ", 1),
+        GuideSegment("free", "sunny", 2),
+    ]
+
+
+async def test_prefill_requires_prefill_model():
+    agent = CRAgent(
+        OpenAIChatModel("m", provider=OpenAIProvider(api_key="...", base_url="..."), profile=vllm_model_profile)
+    )
+    agent.prefill_guide_prefix = True
+    with pytest.raises(RuntimeError, match="PrefillChatModel required"):
+        await agent.build_guide(generation_sequence)
+
+
+def test_prefill_compiled_guide():
+    guide = compile_guide(generation_sequence, prefill=True)
+    assert guide.prefill == "<think>\nI think "
+    assert guide.extra_body["cragents_prefill"] == guide.prefill
+    assert CompiledGuide.from_dict(guide.to_dict()) == guide
+    # same grammar, different prefill
+    other = compile_guide([Think([Anchor("We think "), Constrain(1, 2)]), Anchor("Answer: "), Free()], prefill=True)
+    assert other.grammar == guide.grammar
+    assert other != guide
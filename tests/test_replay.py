@@ -0,0 +1,117 @@
+import time
+
+import anyio
+import httpx
+import pytest
+from openai import AsyncOpenAI
+from pydantic_ai import ModelHTTPError, ToolOutput
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import (
+    Anchor,
+    Constrain,
+    CRAgent,
+    Free,
+    GuideSegment,
+    PrefillChatModel,
+    ReplayTransport,
+    Think,
+    UseTools,
+    vllm_model_profile,
+)
+
+pytestmark = pytest.mark.anyio
+
+answer_guide = [Think([Anchor("I think "), Constrain(1, 1)]), Anchor("Answer: "), Free(max_chars=20)]
+
+
+def make_model(transport: ReplayTransport, model_class: type[OpenAIChatModel] = OpenAIChatModel) -> OpenAIChatModel:
+    client = AsyncOpenAI(api_key="...", base_url="http://replay/v1", http_client=httpx.AsyncClient(transport=transport))
+    return model_class("m", provider=OpenAIProvider(openai_client=client), profile=vllm_model_profile)
+
+
+@pytest.mark.agent_run
+async def test_replay_tool_calls():
+    outputs = [
+        '<think>\nI think I should look.\n\n</think><tool_call>{"name": "weather", "arguments": {"city": "Paris"}}\n'
+        "</tool_call>",
+        '<think>\nI think it rains.\n\n</think><tool_call>{"name": "final_result", "arguments": {"response": true}}\n'
+        "</tool_call>",
+    ]
+    transport = ReplayTransport(outputs)
+    agent = CRAgent(make_model(transport), output_type=ToolOutput(bool))
+
+    @agent.tool_plain
+    def weather(city: str) -> str:
+        return f"Rain in {city}."
+
+    # tool schemas are resolved by the agent, so the guide is registered once compiled
+    guide = await agent.compile_guide([Think([Anchor("I think "), Constrain(1, 1)]), UseTools()])
+    transport.add_guide(guide)
+
+    result = await agent.run("Will it rain?", model_settings={"extra_body": guide.extra_body})
+    assert result.output is True
+    assert len(transport.requests) == 2
+    assert transport.requests[1]["messages"][-1] == {
+        "role": "tool",
+        "tool_call_id": "call_0",
+        "content": "Rain in Paris.",
+    }
+
+
+@pytest.mark.agent_run
+async def test_replay_rejects_outputs_the_grammar_forbids():
+    transport = ReplayTransport(["<think>\nI think a. b.\n\n</think>Answer: yes"], guides=[answer_guide])
+    agent = CRAgent(make_model(transport))
+    await agent.set_guide(answer_guide)
+    with pytest.raises(ModelHTTPError, match="can not be generated with the request grammar"):
+        await agent.run("hi")
+
+    await agent.set_guide([Anchor("Other: "), Free()])
+    with pytest.raises(ModelHTTPError, match="not from a registered guide"):
+        await agent.run("hi")
+
+
+async def test_replay_rejects_malformed_tool_calls():
+    # without a grammar the output is not checked, so a broken tool call reaches the parser
+    outputs = [
+        '<tool_call>{"name": "weather", "arguments": {"city": </tool_call>',
+        '<tool_call>{"city": "Paris"}</tool_call>',
+    ]
+    async with httpx.AsyncClient(transport=ReplayTransport(outputs), base_url="http://replay/v1") as client:
+        for _ in outputs:
+            response = await client.post("/chat/completions", json={"model": "m", "messages": []})
+            assert response.status_code == 400
+            assert "is not a JSON object with a name and arguments" in response.json()["message"]
+
+
+@pytest.mark.agent_run
+async def test_replay_stream_latency():
+    # the server continues the prefill, so it is left out of the output
+    output = "it is sunny.\n\n</think>Answer: sunny"
+    transport = ReplayTransport([output], guides=[answer_guide], token_latency=0.01, chars_per_token=4)
+    agent = CRAgent(make_model(transport, PrefillChatModel))
+    agent.prefill_guide_prefix = True
+    await agent.set_guide(answer_guide)
+
+    results: list[list[GuideSegment]] = []
+
+    async def run() -> None:
+        results.append([event async for event in agent.run_stream_segments("hi") if isinstance(event, GuideSegment)])
+
+    start = time.perf_counter()
+    async with anyio.create_task_group() as tg:
+        for _ in range(4):
+            tg.start_soon(run)
+    # 9 tokens, runs are concurrent
+    assert time.perf_counter() - start >= 0.08
+    assert len(results) == 4
+    assert results[0] == [
+        GuideSegment("anchor", "I think ", 0, 0),
+        GuideSegment("constrain", "it is sunny.\n\n", 0, 1),
+        GuideSegment("think", "I think it is sunny.\n\n", 0),
+        GuideSegment("anchor", "Answer: ", 1),
+        GuideSegment("free", "sunny", 2),
+    ]
+    assert all(result == results[0] for result in results)
@@ -0,0 +1,80 @@
+import httpx
+import pytest
+from openai import AsyncOpenAI
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import (
+    Anchor,
+    CompiledGuide,
+    Constrain,
+    CRAgent,
+    Free,
+    GuideSchedule,
+    GuideSegment,
+    ReplayTransport,
+    Think,
+    UseTools,
+    compile_guide,
+    vllm_model_profile,
+)
+
+pytestmark = pytest.mark.anyio
+
+outputs = [
+    '<think>\nI think I should look. Then answer.\n\n</think><tool_call>{"name": "weather", "arguments": {"city": "Paris"}}'
+    "\n</tool_call>",
+    "<think>\nI think it rains.\n\n</think>Answer: rain",
+]
+answer_guide = compile_guide([Think([Anchor("I think "), Constrain(1, 1)]), Anchor("Answer: "), Free()])
+
+
+async def make_agent() -> tuple[CRAgent[None, str], ReplayTransport, CompiledGuide]:
+    transport = ReplayTransport(outputs, guides=[answer_guide])
+    client = AsyncOpenAI(api_key="...", base_url="http://replay/v1", http_client=httpx.AsyncClient(transport=transport))
+    agent = CRAgent(OpenAIChatModel("m", provider=OpenAIProvider(openai_client=client), profile=vllm_model_profile))
+
+    @agent.tool_plain
+    def weather(city: str) -> str:
+        return f"Rain in {city}."
+
+    tool_guide = await agent.compile_guide([Think([Anchor("I think "), Constrain(1, 2)]), UseTools()])
+    transport.add_guide(tool_guide)
+    return agent, transport, tool_guide
+
+
+def test_schedule_steps():
+    schedule = GuideSchedule([[Anchor("a")], [Anchor("b")]])
+    assert [schedule.guide(step, []) for step in range(3)] == [[Anchor("a")], [Anchor("b")], [Anchor("b")]]
+    assert GuideSchedule(lambda step, messages: None).guide(0, []) is None
+    with pytest.raises(ValueError, match="At least one guide"):
+        GuideSchedule([])
+
+
+@pytest.mark.agent_run
+async def test_scheduled_run():
+    agent, transport, tool_guide = await make_agent()
+    # the agent's guide is replaced on every request
+    await agent.set_guide([Anchor("Never: "), Free()])
+    result = await agent.run("Rain?", model=agent.scheduled_model(GuideSchedule([tool_guide, answer_guide])))
+    assert result.output == "Answer: rain"
+    grammars = [request["structured_outputs"]["grammar"] for request in transport.requests]
+    assert grammars == [tool_guide.grammar, answer_guide.grammar]
+
+
+@pytest.mark.agent_run
+async def test_scheduled_stream_segments():
+    agent, transport, tool_guide = await make_agent()
+    schedule = GuideSchedule(lambda step, messages: tool_guide if step == 0 else None)
+    segments = [
+        event
+        async for event in agent.run_stream_segments("Rain?", guide=schedule)
+        if isinstance(event, GuideSegment) and event.kind != "think"
+    ]
+    # the unguided answer is not parsed
+    assert "structured_outputs" not in transport.requests[1]
+    assert segments == [
+        GuideSegment("anchor", "I think ", 0, 0),
+        GuideSegment("constrain", "I should look. Then answer.\n\n", 0, 1),
+        GuideSegment("tool_call", '{"name": "weather", "arguments": {"city": "Paris"}}\n', 1),
+    ]
@@ -0,0 +1,142 @@
+from inline_snapshot import snapshot
+
+from cragents._schema import hoist_duplicate_subschemas, merge_schema_defs, minimize_json_schema, strip_annotations
+
+
+def test_strip_annotations_keeps_property_names():
+    schema = {
+        "title": "Args",
+        "description": "Arguments.",
+        "type": "object",
+        "properties": {
+            "title": {"type": "string", "description": "A property named title.", "examples": ["x"]},
+            "default": {"type": "integer", "default": 3},
+        },
+        "required": ["title"],
+    }
+    assert strip_annotations(schema) == snapshot(
+        {
+            "type": "object",
+            "properties": {"title": {"type": "string"}, "default": {"type": "integer"}},
+            "required": ["title"],
+        }
+    )
+
+
+def test_strip_annotations_nested_keywords():
+    schema = {
+        "anyOf": [{"type": "string", "title": "S"}, {"type": "array", "items": {"type": "integer", "title": "I"}}],
+        "$defs": {"Thing": {"type": "object", "title": "Thing", "additionalProperties": {"title": "V"}}},
+    }
+    assert strip_annotations(schema) == snapshot(
+        {
+            "anyOf": [{"type": "string"}, {"type": "array", "items": {"type": "integer"}}],
+            "$defs": {"Thing": {"type": "object", "additionalProperties": {}}},
+        }
+    )
+
+
+def test_strip_annotations_does_not_modify_input():
+    schema = {"title": "T", "properties": {"x": {"title": "X", "type": "string"}}}
+    strip_annotations(schema)
+    assert schema == {"title": "T", "properties": {"x": {"title": "X", "type": "string"}}}
+
+
+address = {
+    "type": "object",
+    "properties": {"street": {"type": "string"}, "city": {"type": "string"}},
+    "required": ["street", "city"],
+}
+
+
+def test_hoist_duplicate_subschemas():
+    schema = {
+        "anyOf": [
+            {"type": "object", "properties": {"home": address, "work": address}},
+            {"type": "object", "properties": {"office": address}},
+        ]
+    }
+    assert hoist_duplicate_subschemas(schema) == snapshot(
+        {
+            "anyOf": [
+                {
+                    "type": "object",
+                    "properties": {"home": {"$ref": "#/$defs/shared_1"}, "work": {"$ref": "#/$defs/shared_1"}},
+                },
+                {"type": "object", "properties": {"office": {"$ref": "#/$defs/shared_1"}}},
+            ],
+            "$defs": {
+                "shared_1": {
+                    "type": "object",
+                    "properties": {"street": {"type": "string"}, "city": {"type": "string"}},
+                    "required": ["street", "city"],
+                }
+            },
+        }
+    )
+
+
+def test_hoist_keeps_small_and_unique_subschemas_inline():
+    schema = {"type": "object", "properties": {"a": {"type": "string"}, "b": {"type": "string"}, "c": address}}
+    assert hoist_duplicate_subschemas(schema) is schema
+
+
+def test_hoist_avoids_existing_def_names():
+    schema = {
+        "type": "object",
+        "properties": {"a": address, "b": address, "c": {"$ref": "#/$defs/shared_1"}},
+        "$defs": {"shared_1": {"type": "integer"}},
+    }
+    result = hoist_duplicate_subschemas(schema)
+    assert result["$defs"]["shared_1"] == {"type": "integer"}
+    assert result["properties"]["a"] == {"$ref": "#/$defs/shared_1_"}
+    assert result["$defs"]["shared_1_"] == address
+
+
+def test_minimize_dedupes_after_stripping():
+    described = {**address, "title": "Address", "description": "Where."}
+    schema = {"type": "object", "properties": {"home": described, "work": {**address, "title": "Other"}}}
+    result = minimize_json_schema(schema)
+    assert result["properties"] == {"home": {"$ref": "#/$defs/shared_1"}, "work": {"$ref": "#/$defs/shared_1"}}
+    assert result["$defs"] == {"shared_1": address}
+
+
+def test_merge_schema_defs_shares_equal_and_renames_colliding_definitions():
+    address = {"type": "object", "properties": {"city": {"type": "string"}}}
+    schemas = {
+        "ship": {"properties": {"to": {"$ref": "#/$defs/Address"}}, "$defs": {"Address": address}},
+        "bill": {"properties": {"to": {"$ref": "#/$defs/Address"}}, "$defs": {"Address": address}},
+        "legacy": {
+            "properties": {"to": {"$ref": "#/$defs/Address"}, "items": {"$ref": "#/$defs/Items"}},
+            "$defs": {"Address": {"type": "string"}, "Items": {"type": "array", "items": {"$ref": "#/$defs/Address"}}},
+        },
+        "tree": {"properties": {"up": {"$ref": "#"}}},
+    }
+    merged = merge_schema_defs(schemas)
+    assert merged["ship"] == merged["bill"] == schemas["ship"]
+    assert merged["legacy"] == snapshot(
+        {
+            "properties": {"to": {"$ref": "#/$defs/Address_2"}, "items": {"$ref": "#/$defs/Items"}},
+            "$defs": {
+                "Address_2": {"type": "string"},
+                "Items": {"type": "array", "items": {"$ref": "#/$defs/Address_2"}},
+            },
+        }
+    )
+    # references outside `$defs` are left alone
+    assert merged["tree"] is schemas["tree"]
+
+
+def test_merge_schema_defs_compares_canonical_json_and_reuses_renamed_definitions():
+    def tool(definition: dict[str, object]) -> dict[str, object]:
+        return {"properties": {"a": {"$ref": "#/$defs/A"}}, "$defs": {"A": definition}}
+
+    merged = merge_schema_defs(
+        {"x": tool({"const": 1}), "y": tool({"const": True}), "z": tool({"const": True}), "w": tool({"const": 1})}
+    )
+    assert [schema["properties"]["a"]["$ref"] for schema in merged.values()] == [
+        "#/$defs/A",
+        "#/$defs/A_2",
+        "#/$defs/A_2",
+        "#/$defs/A",
+    ]
@@ -0,0 +1,84 @@
+from collections import Counter
+
+import pytest
+from pydantic_ai import ModelMessage, ModelResponse, TextPart
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import Anchor, Constrain, CRAgent, GuideSelector, compile_guide, vllm_model_profile
+
+pytestmark = pytest.mark.anyio
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="..."),
+    profile=vllm_model_profile,
+)
+
+guides = {
+    "short": compile_guide([Anchor("Answer: "), Constrain(1, 1)]),
+    "long": compile_guide([Anchor("Answer: "), Constrain(3, 3)]),
+}
+
+
+def answer(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+    # the longer guide allows more words
+    grammar = info.model_settings["extra_body"]["structured_outputs"]["grammar"]  # pyright: ignore
+    words = 30 if grammar == guides["long"].grammar else 3
+    return ModelResponse(parts=[TextPart("Answer: " + " ".join(["word"] * words))])
+
+
+async def run_many(selector: GuideSelector, count: int) -> Counter[str]:
+    names: Counter[str] = Counter()
+    for _ in range(count):
+        selected = await selector.run("question", model=FunctionModel(answer))
+        names[selected.name] += 1
+    return names
+
+
+@pytest.mark.agent_run
+async def test_selector_prefers_cheapest_accurate_guide():
+    selector = GuideSelector(CRAgent(model), guides, evaluate=lambda result: True, explore=0, min_reports=3)
+    names = await run_many(selector, 20)
+    # each guide is tried, then only the cheaper one is used
+    assert names == {"short": 17, "long": 3}
+    assert selector.best() == "short"
+    assert selector.stats["short"].mean_output_tokens < selector.stats["long"].mean_output_tokens
+
+
+@pytest.mark.agent_run
+async def test_selector_keeps_accuracy_target():
+    selector = GuideSelector(
+        CRAgent(model),
+        guides,
+        accuracy_target=0.9,
+        evaluate=lambda result: len(result.output) > 100,
+        explore=0,
+        min_reports=3,
+    )
+    names = await run_many(selector, 20)
+    assert names == {"short": 3, "long": 17}
+    assert selector.stats["short"].accuracy == 0
+    assert selector.best() == "long"
+
+
+@pytest.mark.agent_run
+async def test_selector_reported_success():
+    selector = GuideSelector(CRAgent(model), guides, explore=0, min_reports=1)
+    first = await selector.run("question", model=FunctionModel(answer))
+    second = await selector.run("question", model=FunctionModel(answer))
+    assert {first.name, second.name} == {"short", "long"}
+    assert selector.best() is None
+
+    selector.report(first, success=first.name == "long")
+    selector.report(second, success=second.name == "long")
+    assert selector.best() == "long"
+    assert selector.choose() == "long"
+
+
+def test_selector_rejects_bad_arguments():
+    with pytest.raises(ValueError, match="At least one guide"):
+        GuideSelector(CRAgent(model), {})
+    with pytest.raises(ValueError, match="accuracy_target"):
+        GuideSelector(CRAgent(model), guides, accuracy_target=2)
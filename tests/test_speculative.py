@@ -0,0 +1,130 @@
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+
+import anyio
+import pytest
+from pydantic_ai import AgentRunResultEvent, ModelMessage, ToolReturnPart
+from pydantic_ai.models.function import AgentInfo, DeltaToolCall, DeltaToolCalls, FunctionModel
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+
+from cragents import CRAgent, Free, UseTools, vllm_model_profile
+
+pytestmark = pytest.mark.anyio
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="..."),
+    profile=vllm_model_profile,
+)
+
+guide = [Free(), UseTools()]
+
+
+def make_agent(log: list[str], speculative_tools: bool) -> CRAgent[None, str]:
+    agent = CRAgent(model)
+    agent.speculative_tools = speculative_tools
+
+    @agent.tool_plain
+    async def weather(city: str) -> str:
+        log.append(f"weather {city}")
+        return "sunny"
+
+    return agent
+
+
+def make_stream_function(log: list[str]):
+    async def stream_function(messages: list[ModelMessage], info: AgentInfo) -> AsyncIterator[str | DeltaToolCalls]:
+        if any(isinstance(part, ToolReturnPart) for message in messages for part in message.parts):
+            yield "It is sunny."
+            return
+        yield {0: DeltaToolCall(name="weather", json_args='{"city": ')}
+        yield {0: DeltaToolCall(json_args='"Paris"}')}
+        # the rest of the generation
+        for _ in range(5):
+            await anyio.sleep(0)
+        yield {1: DeltaToolCall(name="weather", json_args='{"city": "Rome"}')}
+        log.append("response done")
+
+    return stream_function
+
+
+async def run(agent: CRAgent[None, str], log: list[str]) -> str:
+    output = ""
+    async for event in agent.run_stream_segments(
+        "weather?", guide=guide, model=FunctionModel(stream_function=make_stream_function(log))
+    ):
+        if isinstance(event, AgentRunResultEvent):
+            output = event.result.output
+    return output
+
+
+@pytest.mark.agent_run
+async def test_tool_calls_start_before_response_ends():
+    log: list[str] = []
+    agent = make_agent(log, speculative_tools=True)
+    assert await run(agent, log) == "It is sunny."
+    # every call runs once, the first one before the model is done
+    assert log[0] == "weather Paris"
+    assert sorted(log) == ["response done", "weather Paris", "weather Rome"]
+
+
+@pytest.mark.agent_run
+async def test_tool_calls_wait_for_response_by_default():
+    log: list[str] = []
+    agent = make_agent(log, speculative_tools=False)
+    assert await run(agent, log) == "It is sunny."
+    assert log == ["response done", "weather Paris", "weather Rome"]
+
+
+@pytest.mark.agent_run
+async def test_speculative_calls_cancelled_when_run_fails():
+    log: list[str] = []
+    agent = CRAgent(model)
+    agent.speculative_tools = True
+
+    @agent.tool_plain
+    async def slow() -> str:
+        try:
+            await anyio.sleep(10)
+        except anyio.get_cancelled_exc_class():
+            log.append("cancelled")
+            raise
+        return ""
+
+    async def stream_function(messages: list[ModelMessage], info: AgentInfo) -> AsyncIterator[DeltaToolCalls]:
+        yield {0: DeltaToolCall(name="slow", json_args="{}")}
+        await anyio.sleep(0.01)
+        raise RuntimeError("connection lost")
+
+    with pytest.raises(RuntimeError, match="connection lost"):
+        async for _ in agent.run_stream_segments(
+            "hi", guide=guide, model=FunctionModel(stream_function=stream_function)
+        ):
+            pass
+    assert log == ["cancelled"]
+
+
+@pytest.mark.agent_run
+async def test_speculative_run_does_not_override_the_callers_toolsets():
+    log: list[str] = []
+    agent = make_agent(log, speculative_tools=True)
+    toolsets = agent.toolsets
+    async for _ in agent.run_stream_segments(
+        "weather?", guide=guide, model=FunctionModel(stream_function=make_stream_function(log))
+    ):
+        # the caller sees the agent's own toolsets while the run is in progress
+        assert agent.toolsets == toolsets
+
+
+@pytest.mark.agent_run
+async def test_speculative_run_stopped_early():
+    log: list[str] = []
+    agent = make_agent(log, speculative_tools=True)
+    toolsets = agent.toolsets
+    events = agent.run_stream_segments(
+        "weather?", guide=guide, model=FunctionModel(stream_function=make_stream_function(log))
+    )
+    async with aclosing(events):
+        await anext(events)
+    assert agent.toolsets == toolsets
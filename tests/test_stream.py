@@ -0,0 +1,192 @@
+from collections.abc import AsyncIterator
+
+import pytest
+from pydantic_ai import ModelMessage, ToolReturnPart
+from pydantic_ai.messages import (
+    FunctionToolResultEvent,
+    PartDeltaEvent,
+    PartStartEvent,
+    TextPart,
+    ThinkingPart,
+    ThinkingPartDelta,
+)
+from pydantic_ai.models.function import AgentInfo, DeltaToolCall, DeltaToolCalls, FunctionModel
+from pydantic_ai.models.openai import OpenAIChatModel
+from pydantic_ai.providers.openai import OpenAIProvider
+from pydantic_ai.toolsets import FunctionToolset
+
+from cragents import (
+    Anchor,
+    Constrain,
+    CRAgent,
+    Free,
+    GuideSegment,
+    GuideSegmentDelta,
+    GuideStreamParser,
+    Think,
+    UseTools,
+    compile_guide,
+    vllm_model_profile,
+)
+
+pytestmark = pytest.mark.anyio
+
+model = OpenAIChatModel(
+    model_name="...",
+    provider=OpenAIProvider(api_key="...", base_url="..."),
+    profile=vllm_model_profile,
+)
+
+generation_sequence = [
+    Think([Anchor("I think "), Constrain(1, 1), Anchor("So "), Free()]),
+    Anchor("Response: "),
+    Free(),
+    UseTools(),
+]
+
+completion = (
+    "<think>\nI think it is sunny.\n\nSo done</think>"
+    'Response: calling<tool_call>{"name": "weather", "arguments": {"city": "Paris"}}\n</tool_call>'
+)
+
+
+def segments(events: list[GuideSegment | GuideSegmentDelta]) -> list[GuideSegment]:
+    return [event for event in events if isinstance(event, GuideSegment)]
+
+
+def expected_segments() -> list[GuideSegment]:
+    return [
+        GuideSegment("anchor", "I think ", 0, 0),
+        GuideSegment("constrain", "it is sunny.\n\n", 0, 1),
+        GuideSegment("anchor", "So ", 0, 2),
+        GuideSegment("free", "done", 0, 3),
+        GuideSegment("think", "I think it is sunny.\n\nSo done", 0),
+        GuideSegment("anchor", "Response: ", 1),
+        GuideSegment("free", "calling", 2),
+        GuideSegment("tool_call", '{"name": "weather", "arguments": {"city": "Paris"}}\n', 3),
+    ]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, len(completion)])
+def test_feed_chunks(chunk_size: int):
+    parser = GuideStreamParser(generation_sequence)
+    events: list[GuideSegment | GuideSegmentDelta] = []
+    for start in range(0, len(completion), chunk_size):
+        events.extend(parser.feed(completion[start : start + chunk_size]))
+    events.extend(parser.close())
+
+    assert segments(events) == expected_segments()
+    assert parser.done
+    # deltas add up to the segment text
+    free_deltas = [event.delta for event in events if isinstance(event, GuideSegmentDelta) and event.index == 2]
+    assert "".join(free_deltas) == "calling"
+
+
+def test_segment_reported_when_closed():
+    parser = GuideStreamParser(generation_sequence)
+    events = parser.feed("<think>\nI think it is sunny.\n\nSo done</thi")
+    # the free text can not be closed until the stop token is complete
+    assert segments(events) == expected_segments()[:3]
+    assert [event.delta for event in events if isinstance(event, GuideSegmentDelta)] == ["it is sunny.\n\n", "done"]
+
+    events = parser.feed("nk>")
+    assert segments(events) == expected_segments()[3:5]
+
+
+def test_trailing_free_closed_by_close():
+    parser = GuideStreamParser([Anchor("A: "), Free()])
+    assert segments(parser.feed("A: some text")) == [GuideSegment("anchor", "A: ", 0)]
+    assert not parser.done
+    assert parser.close() == [GuideSegment("free", "some text", 1)]
+    assert parser.done
+
+
+def test_feed_rejects_output_that_does_not_follow_guide():
+    parser = GuideStreamParser(generation_sequence)
+    with pytest.raises(ValueError, match="index 0"):
+        parser.feed("Response: ")
+
+
+def test_feed_events_rebuilds_thinking():
+    parser = GuideStreamParser(generation_sequence[:3])
+    events = parser.feed_event(PartStartEvent(index=0, part=ThinkingPart(content="\nI think ")))
+    events += parser.feed_event(
+        PartDeltaEvent(index=0, delta=ThinkingPartDelta(content_delta="it is sunny.\n\nSo done"))
+    )
+    events += parser.feed_event(PartStartEvent(index=1, part=TextPart(content="Response: calling")))
+    events += parser.close()
+    assert segments(events) == expected_segments()[:7]
+
+
+async def stream_weather(messages: list[ModelMessage], info: AgentInfo) -> AsyncIterator[str | DeltaToolCalls]:
+    if any(isinstance(part, ToolReturnPart) for message in messages for part in message.parts):
+        for chunk in ["Answer: ", "It is ", "sunny."]:
+            yield chunk
+        return
+    yield {0: DeltaToolCall(name="weather", json_args='{"city": ')}
+    yield {0: DeltaToolCall(json_args='"Paris"}')}
+
+
+@pytest.mark.agent_run
+async def test_run_stream_segments():
+    agent = CRAgent(model)
+
+    @agent.tool_plain
+    def weather(city: str) -> str:
+        return "sunny"
+
+    events = [
+        event
+        async for event in agent.run_stream_segments(
+            "weather?", guide=[Free(), UseTools()], model=FunctionModel(stream_function=stream_weather)
+        )
+    ]
+    # the guide is matched again for every model response
+    assert [event for event in events if isinstance(event, GuideSegment)] == [
+        GuideSegment("free", "", 0),
+        GuideSegment("tool_call", '{"name": "weather", "arguments": {"city": "Paris"}}\n', 1),
+        GuideSegment("free", "Answer: It is sunny.", 0),
+    ]
+    assert agent.model_settings is None
+
+
+@pytest.mark.agent_run
+async def test_run_stream_segments_uses_set_guide():
+    async def stream_answer(messages: list[ModelMessage], info: AgentInfo) -> AsyncIterator[str]:
+        for chunk in ["Answer: ", "It is ", "sunny."]:
+            yield chunk
+
+    agent = CRAgent(model)
+    await agent.set_guide(compile_guide([Anchor("Answer: "), Free()]))
+    events = [
+        event async for event in agent.run_stream_segments("hi", model=FunctionModel(stream_function=stream_answer))
+    ]
+    assert [event for event in events if isinstance(event, GuideSegment)] == [
+        GuideSegment("anchor", "Answer: ", 0),
+        GuideSegment("free", "It is sunny.", 1),
+    ]
+
+
+async def test_run_stream_segments_requires_guide():
+    agent = CRAgent(model)
+    with pytest.raises(RuntimeError, match="No guide"):
+        async for _ in agent.run_stream_segments("hi"):
+            pass
+
+
+@pytest.mark.agent_run
+async def test_run_stream_segments_with_run_toolsets():
+    def weather(city: str) -> str:
+        return "sunny"
+
+    agent = CRAgent(model)
+    events = [
+        event
+        async for event in agent.run_stream_segments(
+            "weather?",
+            guide=[Free(), UseTools()],
+            model=FunctionModel(stream_function=stream_weather),
+            toolsets=[FunctionToolset([weather])],
+        )
+    ]
+    assert any(isinstance(event, FunctionToolResultEvent) for event in events)
@@ -0,0 +1,71 @@
+import json
+import re
+from pathlib import Path
+
+import pytest
+
+from cragents import Anchor, Constrain, Free, Think, TokenCounter, TokenEstimate, UseTools, compile_guide
+
+# one token per word, punctuation mark, newline or special token
+counter = TokenCounter(lambda text: len(re.findall(r"<[a-z/_]+>|\w+|[^\w\s]|\n", text)))
+
+samples = ["It is blue.", "Rain is likely. Take a coat."]
+
+
+def test_calibration():
+    # 12 tokens, 3 sentences
+    assert counter.tokens_per_capture(samples) == 4
+    assert counter.tokens_per_capture(samples, chars_to_capture=".T") == 3
+    assert counter.tokens_per_char(["ab cd"]) == 0.4
+    with pytest.raises(ValueError, match="capture characters"):
+        counter.tokens_per_capture(["no sentences"])
+    with pytest.raises(ValueError, match="must not be empty"):
+        counter.tokens_per_char([""])
+
+
+def test_estimate():
+    guide = [Think([Anchor("I think "), Constrain(2, 3)]), Anchor("Answer: "), Free(max_chars=10)]
+    estimate = counter.estimate(guide, tokens_per_capture=3.5, tokens_per_char=0.25)
+    # "<think>", "\n", "I", "think" and "</think>", "Answer", ":"
+    assert estimate == TokenEstimate(fixed_tokens=7, tokens=7 + 2 * (3 * 3.5 + 2) + 10 * 0.25, unbounded=False)
+    assert counter.estimate(compile_guide(guide), tokens_per_capture=3.5, tokens_per_char=0.25) == estimate
+
+    assert counter.estimate([Anchor("Hi"), Free()], tokens_per_capture=3.5).unbounded
+    assert counter.estimate([UseTools(json_schema={})], tokens_per_capture=3.5) == TokenEstimate(2, 2, True)
+
+
+def test_fit():
+    constrain = Constrain(max_newlines=3, max_char_captures=4, chars_to_capture=".!")
+    assert counter.fit(constrain, max_tokens=1000, tokens_per_capture=10) == constrain
+    # (60 / 3 - 2) // 10 sentences per paragraph
+    assert counter.fit(constrain, max_tokens=60, tokens_per_capture=10) == Constrain(3, 1, ".!")
+    assert counter.fit(constrain, max_tokens=25, tokens_per_capture=10) == Constrain(2, 1, ".!")
+    with pytest.raises(ValueError, match="does not fit in 5 tokens"):
+        counter.fit(constrain, max_tokens=5, tokens_per_capture=10)
+
+
+def test_from_file(tmp_path: Path):
+    pytest.importorskip("tokenizers")
+    vocab = {"[UNK]": 0, "<think>": 1, "hello": 2, "world": 3, ".": 4}
+    tokenizer = {
+        "version": "1.0",
+        "added_tokens": [
+            {
+                "id": 1,
+                "content": "<think>",
+                "single_word": False,
+                "lstrip": False,
+                "rstrip": False,
+                "normalized": False,
+                "special": True,
+            }
+        ],
+        "normalizer": None,
+        "pre_tokenizer": {"type": "Whitespace"},
+        "post_processor": None,
+        "decoder": None,
+        "model": {"type": "WordLevel", "vocab": vocab, "unk_token": "[UNK]"},
+    }
+    path = tmp_path / "tokenizer.json"
+    path.write_text(json.dumps(tokenizer))
+    assert TokenCounter.from_file(path)("<think>hello world.") == 4